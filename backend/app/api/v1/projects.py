@@ -1,5 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, status
-from sqlalchemy import select
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy import Select, and_, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import func
 
@@ -12,6 +16,9 @@ from app.schemas.user import MessageResponse
 
 router = APIRouter(prefix="/api/projects", tags=["Projects"])
 
+# Заголовок ответа со ссылкой на следующую страницу списка проектов
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
 
 async def _get_project_or_404(
     project_id: int,
@@ -31,21 +38,67 @@ async def _get_project_or_404(
     return project
 
 
+def encode_cursor(updated_at: Optional[datetime], project_id: int) -> str:
+    """Курсор страницы: ключ (updated_at, id) последнего проекта на ней"""
+    raw = f"{updated_at.isoformat() if updated_at else ''}|{project_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        updated_at, project_id = raw.rsplit("|", 1)
+        return (datetime.fromisoformat(updated_at) if updated_at else None), int(project_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def project_list_query(user_id: int, limit: Optional[int] = None, cursor: Optional[str] = None) -> Select:
+    """Список проектов пользователя: только колонки ProjectListItem, новые сначала.
+
+    data (JSON лендинга) не выбирается вовсе. Страницы — по ключу
+    (updated_at, id): следующая начинается строго после последнего проекта
+    предыдущей, без OFFSET и без пропусков при одновременных правках.
+    """
+    query = (
+        select(Project.id, Project.title, Project.preview_url, Project.updated_at)
+        .where(Project.user_id == user_id, Project.deleted_at.is_(None))
+        .order_by(Project.updated_at.desc().nulls_last(), Project.id.desc())
+    )
+    if cursor is not None:
+        updated_at, project_id = decode_cursor(cursor)
+        if updated_at is None:
+            query = query.where(Project.updated_at.is_(None), Project.id < project_id)
+        else:
+            query = query.where(or_(
+                Project.updated_at < updated_at,
+                and_(Project.updated_at == updated_at, Project.id < project_id),
+                Project.updated_at.is_(None),
+            ))
+    if limit is not None:
+        # Лишняя строка показывает, есть ли следующая страница
+        query = query.limit(limit + 1)
+    return query
+
+
 @router.get("", response_model=list[ProjectListItem])
 async def list_projects(
+    response: Response,
     user_id: int = Query(..., alias="userId"),
+    limit: Optional[int] = Query(None, ge=1, le=100, description="Размер страницы; без него — все проекты"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor предыдущей страницы"),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ) -> list[ProjectListItem]:
     if user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
 
-    result = await db.execute(
-        select(Project)
-            .where(Project.user_id == current_user.id, Project.deleted_at.is_(None))
-            .order_by(Project.updated_at.desc())
-    )
-    return result.scalars().all()
+    result = await db.execute(project_list_query(current_user.id, limit, cursor))
+    rows = result.all()
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].updated_at, rows[-1].id)
+    return rows
 
 
 @router.post("", response_model=ProjectResponse, status_code=status.HTTP_201_CREATED)
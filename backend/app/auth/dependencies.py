@@ -1,8 +1,8 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.auth.identity_cache import identity_cache
 from app.auth.security import decode_token
 from app.core.database import get_db
 from app.models.user import User
@@ -44,8 +44,7 @@ async def get_current_user(
             detail="Недействительный токен",
         )
 
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
+    user = await identity_cache.get_user(user_id, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
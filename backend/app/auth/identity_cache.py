@@ -0,0 +1,139 @@
+"""Кэш аутентифицированных пользователей по subject токена.
+
+REST-зависимость ``get_current_user`` и WebSocket-подключение к комнате
+раньше делали ``SELECT User`` на каждую проверку токена. Кэш хранит
+значения колонок пользователя ``AUTH_IDENTITY_CACHE_TTL_SECONDS`` секунд
+(не больше ``AUTH_IDENTITY_CACHE_SIZE`` записей, вытесняются давно не
+использованные) и собирает из них объект ``User``, прикрепленный к сессии
+запроса без запроса в БД (``merge(load=False)``), — изменения профиля в
+обработчиках сохраняются как обычно.
+
+Одновременные промахи по одному пользователю (переподключение сотни
+вкладок после деплоя) выполняют один SELECT на всех.
+
+Запись сбрасывается при любом изменении или удалении пользователя через
+ORM — смене пароля, настройке и отключении TOTP, правке профиля — в момент
+flush и еще раз после commit. Кэш свой у каждого процесса, поэтому другие
+воркеры увидят изменения не позже чем через TTL.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from app.core.config import settings
+from app.models.user import User
+
+
+def _columns(user: User) -> dict:
+    return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+
+class IdentityCache:
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self.ttl = ttl if ttl is not None else settings.AUTH_IDENTITY_CACHE_TTL_SECONDS
+        self.max_entries = max_entries if max_entries is not None else settings.AUTH_IDENTITY_CACHE_SIZE
+        # user_id → (истекает в, значения колонок)
+        self._entries: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+        self._loading: Dict[int, asyncio.Future] = {}
+        # Растет при сбросе: загрузка, начатая до сброса, не кладет устаревшие данные
+        self._generation: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get_user(self, user_id: int, db: AsyncSession) -> Optional[User]:
+        """Пользователь, прикрепленный к сессии db; None — пользователя нет"""
+        columns = self._lookup(user_id)
+        if columns is None:
+            columns = await self._load(user_id, db)
+            if columns is None:
+                return None
+        user = User(**columns)
+        make_transient_to_detached(user)
+        return await db.merge(user, load=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+        self._generation[user_id] = self._generation.get(user_id, 0) + 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._generation.clear()
+
+    def _lookup(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, columns = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return columns
+
+    async def _load(self, user_id: int, db: AsyncSession) -> Optional[dict]:
+        pending = self._loading.get(user_id)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except BaseException:
+                if not pending.done():
+                    # Отменили сам ожидающий запрос
+                    raise
+                # Загрузка у другого запроса не удалась — пробуем сами
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[user_id] = future
+        generation = self._generation.get(user_id, 0)
+        try:
+            result = await db.execute(select(User).where(User.id == user_id))
+            user = result.scalar_one_or_none()
+            columns = _columns(user) if user is not None else None
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Этот future может никто не ждать — помечаем исключение полученным
+            future.exception()
+            raise
+        finally:
+            if self._loading.get(user_id) is future:
+                del self._loading[user_id]
+
+        future.set_result(columns)
+        if columns is not None and self._generation.get(user_id, 0) == generation:
+            self._store(user_id, columns)
+        return columns
+
+    def _store(self, user_id: int, columns: dict) -> None:
+        self._entries[user_id] = (time.monotonic() + self.ttl, columns)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+identity_cache = IdentityCache()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_on_flush(mapper, connection, target: User) -> None:
+    identity_cache.invalidate(target.id)
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault("identity_cache_dirty", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session: Session) -> None:
+    # Между flush и commit другой запрос мог прочитать и закэшировать старую строку
+    for user_id in session.info.pop("identity_cache_dirty", ()):
+        identity_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_on_rollback(session: Session) -> None:
+    session.info.pop("identity_cache_dirty", None)
@@ -22,6 +22,31 @@ def create_access_token(subject: Union[str, int], expires_delta: Optional[timede
     return jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
 
 
+def create_view_token(
+    room_id: str,
+    issuer_id: int,
+    project_id: Optional[int] = None,
+    expires_delta: Optional[timedelta] = None,
+) -> str:
+    """Токен зрителя комнаты: только просмотр, только этой комнаты.
+
+    subject не число, поэтому как токен пользователя он не принимается.
+    issuer и project — кто выдал токен и к какому проекту была привязана
+    комната: при подключении и привязке комнаты права выдавшего проверяются
+    заново.
+    """
+    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(seconds=settings.WS_VIEW_TOKEN_TTL_SECONDS))
+    to_encode = {
+        "sub": "view",
+        "scope": "view",
+        "room": room_id,
+        "issuer": issuer_id,
+        "project": project_id,
+        "exp": expire,
+    }
+    return jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+
+
 def decode_token(token: str) -> dict:
     try:
         return jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
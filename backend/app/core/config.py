@@ -25,6 +25,82 @@ class Settings(BaseSettings):
     JWT_SECRET_KEY: str = "change_me"
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 30
+    # Кэш пользователей по subject токена (REST и WebSocket)
+    AUTH_IDENTITY_CACHE_TTL_SECONDS: float = 30.0
+    AUTH_IDENTITY_CACHE_SIZE: int = 10000
+
+    # Очередь отправки WebSocket-соединения и политика при ее переполнении:
+    # drop_cursor — выбрасывать устаревшие курсоры, coalesce — схлопывать
+    # документные сообщения в один sync_state, disconnect — отключать клиента
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SEND_QUEUE_POLICY: str = "coalesce"
+    # Частота рассылки пакетных кадров присутствия (курсоры, выделения)
+    WS_PRESENCE_TICK_HZ: float = 20.0
+    # Шина комнат между воркерами: redis://host:6379/0 или пусто (один процесс)
+    WS_ROOM_BUS_URL: Optional[str] = None
+    # Время жизни ключа владения комнатой в Redis, продлевается владельцем
+    WS_ROOM_OWNER_TTL_MS: int = 10000
+    # Автосохранение комнаты: не чаще раза в N секунд или сразу после M операций
+    WS_AUTOSAVE_INTERVAL_SECONDS: float = 5.0
+    WS_AUTOSAVE_MAX_OPS: int = 200
+    # Сколько последних операций комнаты хранить для догоняния при переподключении
+    WS_OPLOG_SIZE: int = 1000
+    # Пустые комнаты выгружаются из памяти через TTL; при превышении общего
+    # бюджета состояний — раньше, начиная с давно неактивных (LRU)
+    WS_ROOM_IDLE_TTL_SECONDS: float = 300.0
+    WS_ROOMS_MEMORY_BUDGET_BYTES: int = 256 * 1024 * 1024
+    WS_ROOM_SWEEP_INTERVAL_SECONDS: float = 30.0
+    # Состояние, пришедшее целиком (sync_state), хранится деревом dict и
+    # переводится в компактную модель, когда комната простаивает столько секунд
+    WS_ROOM_COMPACT_AFTER_SECONDS: float = 60.0
+    # Кадры не меньше этого размера сжимаются zstd у клиентов с compress=zstd
+    WS_COMPRESS_MIN_BYTES: int = 8192
+    WS_COMPRESS_LEVEL: int = 3
+    # Потоковая начальная синхронизация (?sync=chunked): блоков в одном кадре sync_blocks
+    WS_SYNC_CHUNK_BLOCKS: int = 20
+    # Сколько операций из очереди актор комнаты применяет перед одной рассылкой
+    WS_ROOM_ACTOR_BATCH_OPS: int = 64
+    # Наибольшее число операций в одном сообщении batch
+    WS_BATCH_MAX_OPS: int = 500
+    # Журнал комнат на диске для восстановления после рестарта: каталог или пусто (выключен)
+    WS_JOURNAL_DIR: Optional[str] = None
+    # Снимок комнаты в журнале (с обрезкой журнала) после стольких операций
+    WS_JOURNAL_SNAPSHOT_OPS: int = 500
+    # Задержка снимка журнала: sync_state подряд за это время дают один снимок
+    WS_JOURNAL_SNAPSHOT_DELAY_SECONDS: float = 1.0
+    # Зрители комнаты: время жизни токена просмотра и частота рассылки им изменений
+    WS_VIEW_TOKEN_TTL_SECONDS: int = 60 * 60 * 24
+    WS_SPECTATOR_RATE_HZ: float = 2.0
+    # Входящий кадр больше этого размера отклоняется до разбора, соединение закрывается (1009)
+    WS_MAX_FRAME_BYTES: int = 4 * 1024 * 1024
+    # Лимиты частоты входящих сообщений соединения по классам: токенов в секунду и запас
+    WS_RATE_PRESENCE_PER_SECOND: float = 30.0
+    WS_RATE_PRESENCE_BURST: float = 60.0
+    WS_RATE_OPS_PER_SECOND: float = 50.0
+    WS_RATE_OPS_BURST: float = 200.0
+    # sync: клиент шлет sync_state не чаще раза в 500 мс после правки — лимит выше этого темпа
+    WS_RATE_SYNC_PER_SECOND: float = 4.0
+    WS_RATE_SYNC_BURST: float = 10.0
+    WS_RATE_SAVE_PER_SECOND: float = 1.0
+    WS_RATE_SAVE_BURST: float = 5.0
+    # Лимиты комнаты на воркере — лимиты соединения, умноженные на этот коэффициент
+    WS_ROOM_RATE_FACTOR: float = 4.0
+    # ...но не меньше этой доли лимитов соединения на каждого редактора комнаты на воркере:
+    # десять вкладок с sync_state раз в 500 мс не упираются в лимит комнаты
+    WS_ROOM_RATE_PER_EDITOR: float = 0.75
+    # Соединение закрывается (1008) после стольких отклоненных подряд сообщений
+    WS_THROTTLE_DISCONNECT_AFTER: int = 500
+    # Heartbeat: ping соединению, молчащему дольше интервала; отключение после таймаута
+    WS_HEARTBEAT_INTERVAL_SECONDS: float = 20.0
+    WS_HEARTBEAT_TIMEOUT_SECONDS: float = 60.0
+    # Остановка сервера: сколько ждать отправки reconnect, прежде чем закрыть сокеты,
+    # и в каком окне клиенты разносят переподключения (против одновременного наплыва)
+    WS_DRAIN_TIMEOUT_SECONDS: float = 5.0
+    WS_DRAIN_RECONNECT_JITTER_SECONDS: float = 10.0
+    # Глубина серверной истории undo/redo участника (записей в каждом стеке)
+    WS_UNDO_DEPTH: int = 100
+    # Историй undo/redo в комнате: сверх этого вытесняется давно не использованная
+    WS_UNDO_MAX_USERS: int = 50
 
     class Config:
         env_file = ".env"
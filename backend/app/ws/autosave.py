@@ -0,0 +1,172 @@
+"""Отложенное (write-behind) автосохранение состояния комнаты в БД.
+
+Вместо записи проекта на каждое сообщение ``save_project`` комната помечается
+грязной при каждой примененной операции владельца проекта (правки остальных
+участников от его имени не сохраняются, см. ``commit_op``), а ``RoomSaver`` сбрасывает состояние
+в ``Project.data`` не чаще раза в ``WS_AUTOSAVE_INTERVAL_SECONDS``, сразу после
+``WS_AUTOSAVE_MAX_OPS`` операций, при уходе последнего участника и при
+остановке сервера. Если содержимое не изменилось с прошлой записи (по хешу),
+запись пропускается.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Optional, Tuple
+
+from sqlalchemy import update
+
+from app.core.config import settings
+from app.core.database import async_session_maker
+from app.models.project import Project
+from app.ws.document import json_default
+from app.ws.metrics import AUTOSAVE_LATENCY, AUTOSAVE_OPS, AUTOSAVE_OPS_PER_WRITE, AUTOSAVE_WRITES
+
+logger = logging.getLogger(__name__)
+
+
+# persist(project_id, user_id, state) → True, если проект найден и обновлен
+Persist = Callable[[int, int, dict], Awaitable[bool]]
+
+
+async def persist_project_state(project_id: int, user_id: int, state: dict) -> bool:
+    """Записать состояние комнаты в проект владельца одним UPDATE, без SELECT"""
+    values = {"data": state}
+    if isinstance(state.get("projectName"), str) and state["projectName"]:
+        values["title"] = state["projectName"][:255]
+    async with async_session_maker() as db:
+        result = await db.execute(
+            update(Project)
+            .where(
+                Project.id == project_id,
+                Project.user_id == user_id,
+                Project.deleted_at.is_(None),
+            )
+            .values(**values)
+        )
+        await db.commit()
+        return result.rowcount > 0
+
+
+class RoomSaver:
+    def __init__(
+        self,
+        get_state: Callable[[], dict],
+        on_saved: Optional[Callable[[int], None]] = None,
+        persist: Optional[Persist] = None,
+        interval: Optional[float] = None,
+        max_ops: Optional[int] = None,
+    ):
+        self._get_state = get_state
+        self._on_saved = on_saved
+        self._persist = persist or persist_project_state
+        self.interval = interval if interval is not None else settings.WS_AUTOSAVE_INTERVAL_SECONDS
+        self.max_ops = max_ops if max_ops is not None else settings.WS_AUTOSAVE_MAX_OPS
+        # Проект, в который сохраняется комната, и его владелец
+        self.project_id: Optional[int] = None
+        self.user_id: Optional[int] = None
+        self.pending_ops = 0
+        self.dirty = False
+        self._last_hash: Optional[str] = None
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def bound(self) -> bool:
+        return self.project_id is not None and self.user_id is not None
+
+    def bind(self, project_id: int, user_id: int, clean: bool = False) -> None:
+        """Привязать комнату к проекту; первая привязка сразу планирует запись.
+
+        clean — состояние только что загружено из этого проекта: записывать
+        нечего, пока его не изменят.
+        """
+        if clean:
+            self.project_id = project_id
+            self.user_id = user_id
+            self._last_hash = self._serialize()[1]
+            self.dirty = False
+            self.pending_ops = 0
+        elif (project_id, user_id) != (self.project_id, self.user_id):
+            self.project_id = project_id
+            self.user_id = user_id
+            self._last_hash = None
+            self.dirty = True
+            self._schedule()
+
+    def mark_dirty(self) -> None:
+        """Отметить примененную операцию"""
+        self.dirty = True
+        self.pending_ops += 1
+        AUTOSAVE_OPS.inc()
+        if self.pending_ops >= self.max_ops:
+            self.flush_soon()
+        else:
+            self._schedule()
+
+    def flush_soon(self) -> None:
+        """Сбросить состояние в фоне, не дожидаясь таймера"""
+        asyncio.create_task(self.flush())
+
+    def close(self) -> None:
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+
+    async def flush(self) -> bool:
+        """Записать состояние, если оно изменилось; True — запись выполнена"""
+        async with self._lock:
+            if not self.dirty or not self.bound:
+                return False
+            ops = self.pending_ops
+            self.dirty = False
+            self.pending_ops = 0
+
+            serialized, content_hash = self._serialize()
+            if content_hash == self._last_hash:
+                AUTOSAVE_WRITES.labels(result="unchanged").inc()
+                return False
+
+            started = time.perf_counter()
+            try:
+                # Пишем ровно то, что захешировали: состояние могут менять во время записи
+                saved = await self._persist(self.project_id, self.user_id, json.loads(serialized))
+            except Exception:
+                logger.exception("Autosave of project %s failed", self.project_id)
+                AUTOSAVE_WRITES.labels(result="failed").inc()
+                self.dirty = True
+                self.pending_ops += ops
+                self._schedule()
+                return False
+            AUTOSAVE_LATENCY.observe(time.perf_counter() - started)
+
+            if not saved:
+                # Проект удален или принадлежит другому пользователю
+                logger.warning("Autosave target project %s not found, unbinding room", self.project_id)
+                AUTOSAVE_WRITES.labels(result="missing").inc()
+                self.project_id = None
+                self.user_id = None
+                return False
+
+            AUTOSAVE_WRITES.labels(result="written").inc()
+            AUTOSAVE_OPS_PER_WRITE.observe(ops)
+            self._last_hash = content_hash
+            if self._on_saved is not None:
+                self._on_saved(self.project_id)
+            return True
+
+    def _serialize(self) -> Tuple[str, str]:
+        """JSON состояния и его хеш"""
+        serialized = json.dumps(self._get_state(), sort_keys=True, ensure_ascii=False, default=json_default)
+        return serialized, hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _schedule(self) -> None:
+        if self.bound and (self._timer is None or self._timer.done()):
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.interval)
+        # Таймер отработал: новые операции во время записи заведут следующий
+        self._timer = None
+        await self.flush()
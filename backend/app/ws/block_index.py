@@ -0,0 +1,188 @@
+"""Индекс блоков комнаты: id блока → (блок, родитель, слот).
+
+Блоки лежат в трех видах контейнеров:
+
+* ``state["blocks"]`` — корневой список (родитель ``None``);
+* ``block["children"]`` — дети контейнера;
+* ``cell["block"]`` — содержимое ячейки сетки.
+
+Для списков слот — позиция в списке, для ячейки сетки — сам словарь
+ячейки. Индекс поддерживается при add/delete/move и полностью
+перестраивается при ``sync_state``, поэтому update и delete не обходят
+дерево.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from app.ws.document import OBJECT_TYPES
+
+
+# Контейнер, в котором лежит блок: список блоков или ячейка сетки
+Container = Union[List[dict], dict]
+
+
+class BlockRef:
+    __slots__ = ("block", "parent_id", "container", "slot")
+
+    def __init__(self, block: dict, parent_id: Optional[str], container: Container, slot: Optional[int]):
+        self.block = block
+        self.parent_id = parent_id
+        self.container = container
+        # Позиция в списке; None для ячейки сетки
+        self.slot = slot
+
+
+def iter_child_slots(block: dict) -> Iterator[Tuple[Container, Optional[int], dict]]:
+    """Перечислить прямых потомков блока как (контейнер, слот, блок)"""
+    if block.get("type") == "container" and isinstance(block.get("children"), list):
+        children = block["children"]
+        for i, child in enumerate(children):
+            if isinstance(child, OBJECT_TYPES):
+                yield children, i, child
+    if block.get("type") == "grid" and isinstance(block.get("cells"), list):
+        for cell in block["cells"]:
+            if isinstance(cell, OBJECT_TYPES) and isinstance(cell.get("block"), OBJECT_TYPES):
+                yield cell, None, cell["block"]
+
+
+class BlockIndex:
+    def __init__(self) -> None:
+        self._refs: Dict[str, BlockRef] = {}
+        # id(блок) → ссылка: перенумерация после вставки не читает id блоков.
+        # Ссылка держит блок, поэтому его id() не переиспользуется, пока запись жива
+        self._by_object: Dict[int, BlockRef] = {}
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+    def __contains__(self, block_id: Any) -> bool:
+        return block_id in self._refs
+
+    def rebuild(self, state: dict) -> None:
+        """Полностью перестроить индекс по состоянию комнаты"""
+        self._refs = {}
+        self._by_object = {}
+        blocks = state.get("blocks") if isinstance(state, OBJECT_TYPES) else None
+        if isinstance(blocks, list):
+            for i, block in enumerate(blocks):
+                if isinstance(block, OBJECT_TYPES):
+                    self._add_subtree(block, None, blocks, i)
+
+    def get(self, block_id: Any) -> Optional[BlockRef]:
+        if not isinstance(block_id, str):
+            return None
+        return self._refs.get(block_id)
+
+    def slot_of(self, block_id: Any) -> Optional[int]:
+        """Позиция блока в его списке; None для ячейки сетки и неизвестного блока"""
+        ref = self.get(block_id)
+        if ref is None or ref.slot is None:
+            return None
+        return self._slot_of(ref)
+
+    def children_container(self, parent_id: Optional[str], state: dict) -> Optional[List[dict]]:
+        """Список, в который добавляются дети родителя (корень или container.children)"""
+        if parent_id is None:
+            blocks = state.get("blocks")
+            return blocks if isinstance(blocks, list) else None
+        ref = self._refs.get(parent_id)
+        if ref is None or ref.block.get("type") != "container":
+            return None
+        return ref.block.setdefault("children", [])
+
+    def insert(self, block: dict, parent_id: Optional[str], container: List[dict], position: int) -> None:
+        """Вставить блок в список и проиндексировать его поддерево"""
+        position = max(0, min(position, len(container)))
+        container.insert(position, block)
+        self._renumber(container, position + 1)
+        self._add_subtree(block, parent_id, container, position)
+
+    def place_in_cell(self, block: dict, parent_id: str, cell: dict) -> None:
+        """Положить блок в ячейку сетки, заменив прежнее содержимое"""
+        previous = cell.get("block")
+        if isinstance(previous, OBJECT_TYPES):
+            self._remove_subtree(previous)
+        cell["block"] = block
+        self._add_subtree(block, parent_id, cell, None)
+
+    def move_within(self, container: List[dict], from_index: int, to_index: int) -> None:
+        """Переставить блок внутри одного списка"""
+        moved = container.pop(from_index)
+        container.insert(to_index, moved)
+        self._renumber(container, min(from_index, to_index))
+
+    def detach(self, block_id: str) -> Optional[BlockRef]:
+        """Извлечь блок из дерева вместе с поддеревом; вернуть его ссылку"""
+        ref = self._refs.get(block_id)
+        if ref is None:
+            return None
+        if ref.slot is None:
+            ref.container["block"] = None
+        else:
+            slot = self._slot_of(ref)
+            ref.container.pop(slot)
+            self._renumber(ref.container, slot)
+        self._remove_subtree(ref.block)
+        return ref
+
+    def reindex_children(self, block_id: str) -> None:
+        """Переиндексировать потомков блока после замены children/cells"""
+        ref = self._refs.get(block_id)
+        if ref is None:
+            return
+        stale = [
+            bid for bid, child in self._refs.items()
+            if bid != block_id and self._is_descendant(child, block_id)
+        ]
+        for bid in stale:
+            self._by_object.pop(id(self._refs.pop(bid).block), None)
+        for container, slot, child in iter_child_slots(ref.block):
+            self._add_subtree(child, block_id, container, slot)
+
+    def _is_descendant(self, ref: BlockRef, ancestor_id: str) -> bool:
+        parent_id = ref.parent_id
+        while parent_id is not None:
+            if parent_id == ancestor_id:
+                return True
+            parent = self._refs.get(parent_id)
+            parent_id = parent.parent_id if parent else None
+        return False
+
+    def _slot_of(self, ref: BlockRef) -> int:
+        slot = ref.slot
+        container = ref.container
+        if slot is not None and slot < len(container) and container[slot] is ref.block:
+            return slot
+        # Индекс рассинхронизировался со списком (правка в обход индекса)
+        for i, candidate in enumerate(container):
+            if candidate is ref.block:
+                ref.slot = i
+                return i
+        raise LookupError(ref.block.get("id"))
+
+    def _renumber(self, container: List[dict], start: int) -> None:
+        by_object = self._by_object
+        for i in range(start, len(container)):
+            block = container[i]
+            ref = by_object.get(id(block))
+            if ref is not None and ref.block is block:
+                ref.slot = i
+
+    def _add_subtree(self, block: dict, parent_id: Optional[str], container: Container, slot: Optional[int]) -> None:
+        block_id = block.get("id")
+        if isinstance(block_id, str):
+            previous = self._refs.get(block_id)
+            if previous is not None:
+                self._by_object.pop(id(previous.block), None)
+            ref = self._refs[block_id] = BlockRef(block, parent_id, container, slot)
+            self._by_object[id(block)] = ref
+        for child_container, child_slot, child in iter_child_slots(block):
+            self._add_subtree(child, block_id, child_container, child_slot)
+
+    def _remove_subtree(self, block: dict) -> None:
+        block_id = block.get("id")
+        ref = self._refs.get(block_id)
+        if ref is not None and ref.block is block:
+            del self._refs[block_id]
+            self._by_object.pop(id(block), None)
+        for _, _, child in iter_child_slots(block):
+            self._remove_subtree(child)
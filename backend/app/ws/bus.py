@@ -0,0 +1,311 @@
+"""Шина комнат: доставка операций и присутствия между воркерами.
+
+Комнаты живут в памяти процесса, поэтому при нескольких воркерах uvicorn
+или нескольких репликах бэкенда участники одной комнаты могут оказаться в
+разных процессах. Воркеры, у которых есть локальные участники комнаты,
+подписываются на ее канал в шине и обмениваются конвертами::
+
+    {"event": "...", "origin": "<worker_id>", ...}
+
+У каждой комнаты ровно один владелец — воркер, чье состояние считается
+авторитетным: он применяет операции и присваивает версии, остальные
+держат реплики.
+
+* ``InProcessRoomBus`` — шина внутри одного процесса (по умолчанию).
+  Несколько экземпляров с общим ``InProcessBroker`` ведут себя как
+  отдельные воркеры — это удобно в тестах.
+* ``RedisRoomBus`` — Redis Pub/Sub для каналов и ``SET NX PX`` для
+  владения комнатой. Включается настройкой ``WS_ROOM_BUS_URL``.
+"""
+import abc
+import asyncio
+import json
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from app.core.config import settings
+from app.ws.document import json_default
+
+logger = logging.getLogger(__name__)
+
+
+BusHandler = Callable[[dict], Awaitable[None]]
+
+
+class RoomBus(abc.ABC):
+    """Интерфейс шины комнат.
+
+    ``publish`` не ждет доставки: конверты складываются в исходящую очередь
+    и отправляются одной задачей строго в порядке публикации — порядок
+    операций комнаты между воркерами важен.
+    """
+
+    def __init__(self, worker_id: Optional[str] = None):
+        self.worker_id = worker_id or f"worker-{uuid.uuid4().hex[:12]}"
+        self._outbox: Optional[asyncio.Queue] = None
+        self._sender: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        if self._outbox is not None:
+            try:
+                await asyncio.wait_for(self.flush(), timeout=2.0)
+            except asyncio.TimeoutError:
+                logger.warning("Room bus stopped with %d unsent envelopes", self._outbox.qsize())
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
+
+    @abc.abstractmethod
+    async def subscribe(self, room_id: str, handler: BusHandler) -> None:
+        """Получать конверты комнаты от других воркеров"""
+
+    @abc.abstractmethod
+    async def unsubscribe(self, room_id: str) -> None:
+        """Перестать получать конверты комнаты"""
+
+    @abc.abstractmethod
+    async def acquire_owner(self, room_id: str) -> bool:
+        """Стать владельцем комнаты, если у нее нет владельца; True — владеем"""
+
+    @abc.abstractmethod
+    async def release_owner(self, room_id: str) -> None:
+        """Отдать владение комнатой"""
+
+    @abc.abstractmethod
+    def is_owner(self, room_id: str) -> bool:
+        """Владеет ли этот воркер комнатой (по последним сведениям)"""
+
+    def publish(self, room_id: str, envelope: dict) -> None:
+        """Поставить конверт в очередь для других воркеров комнаты"""
+        if self._outbox is None:
+            self._outbox = asyncio.Queue()
+        self._outbox.put_nowait((room_id, {**envelope, "origin": self.worker_id}))
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.create_task(self._send_loop())
+
+    async def flush(self) -> None:
+        """Дождаться отправки всех опубликованных конвертов"""
+        if self._outbox is not None:
+            await self._outbox.join()
+
+    @abc.abstractmethod
+    async def _send(self, room_id: str, envelope: dict) -> None:
+        """Отправить конверт другим воркерам (вызывается задачей отправки по порядку)"""
+
+    async def _send_loop(self) -> None:
+        while True:
+            room_id, envelope = await self._outbox.get()
+            try:
+                await self._send(room_id, envelope)
+            except Exception:
+                logger.exception("Room bus publish failed for room %s", room_id)
+            finally:
+                self._outbox.task_done()
+
+
+class InProcessBroker:
+    """Общая точка встречи нескольких InProcessRoomBus в одном процессе"""
+
+    def __init__(self) -> None:
+        self.subscribers: Dict[str, Dict[str, BusHandler]] = {}
+        self.owners: Dict[str, str] = {}
+
+
+class InProcessRoomBus(RoomBus):
+    def __init__(self, broker: Optional[InProcessBroker] = None, worker_id: Optional[str] = None):
+        super().__init__(worker_id)
+        self.broker = broker or InProcessBroker()
+
+    async def subscribe(self, room_id: str, handler: BusHandler) -> None:
+        self.broker.subscribers.setdefault(room_id, {})[self.worker_id] = handler
+
+    async def unsubscribe(self, room_id: str) -> None:
+        handlers = self.broker.subscribers.get(room_id)
+        if handlers is not None:
+            handlers.pop(self.worker_id, None)
+            if not handlers:
+                del self.broker.subscribers[room_id]
+
+    async def _send(self, room_id: str, envelope: dict) -> None:
+        handlers = [
+            handler for worker_id, handler in self.broker.subscribers.get(room_id, {}).items()
+            if worker_id != self.worker_id
+        ]
+        if not handlers:
+            return
+        # Копия, как после Redis: состояние sync_state хранится комнатой без
+        # копирования, и реплика не должна делить его объекты с владельцем
+        encoded = json.dumps(envelope, default=json_default)
+        for handler in handlers:
+            await handler(json.loads(encoded))
+
+    async def acquire_owner(self, room_id: str) -> bool:
+        owner = self.broker.owners.setdefault(room_id, self.worker_id)
+        return owner == self.worker_id
+
+    async def release_owner(self, room_id: str) -> None:
+        if self.broker.owners.get(room_id) == self.worker_id:
+            del self.broker.owners[room_id]
+
+    def is_owner(self, room_id: str) -> bool:
+        return self.broker.owners.get(room_id, self.worker_id) == self.worker_id
+
+
+# Продлить владение, только если ключ все еще наш
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Снять владение, только если ключ все еще наш
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisRoomBus(RoomBus):
+    CHANNEL_PREFIX = "ws:room:"
+    OWNER_PREFIX = "ws:room-owner:"
+
+    def __init__(self, url: str, worker_id: Optional[str] = None, owner_ttl_ms: Optional[int] = None):
+        super().__init__(worker_id)
+        self.url = url
+        self.owner_ttl_ms = owner_ttl_ms or settings.WS_ROOM_OWNER_TTL_MS
+        self._handlers: Dict[str, BusHandler] = {}
+        self._owned: Set[str] = set()
+        self._redis = None
+        self._pubsub = None
+        self._subscribed = asyncio.Event()
+        self._tasks: list = []
+
+    def _channel(self, room_id: str) -> str:
+        return f"{self.CHANNEL_PREFIX}{room_id}"
+
+    def _owner_key(self, room_id: str) -> str:
+        return f"{self.OWNER_PREFIX}{room_id}"
+
+    async def start(self) -> None:
+        # redis нужен только при включенной шине, поэтому импортируем лениво
+        from redis import asyncio as aioredis
+
+        self._redis = aioredis.from_url(self.url, decode_responses=True)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._renew = self._redis.register_script(_RENEW_SCRIPT)
+        self._release = self._redis.register_script(_RELEASE_SCRIPT)
+        self._tasks = [
+            asyncio.create_task(self._read_loop()),
+            asyncio.create_task(self._renew_loop()),
+        ]
+
+    async def stop(self) -> None:
+        await super().stop()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for room_id in list(self._owned):
+            await self.release_owner(room_id)
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    async def subscribe(self, room_id: str, handler: BusHandler) -> None:
+        self._handlers[room_id] = handler
+        await self._pubsub.subscribe(self._channel(room_id))
+        self._subscribed.set()
+
+    async def unsubscribe(self, room_id: str) -> None:
+        self._handlers.pop(room_id, None)
+        await self._pubsub.unsubscribe(self._channel(room_id))
+
+    async def _send(self, room_id: str, envelope: dict) -> None:
+        await self._redis.publish(self._channel(room_id), json.dumps(envelope, default=json_default))
+
+    async def acquire_owner(self, room_id: str) -> bool:
+        key = self._owner_key(room_id)
+        acquired = await self._redis.set(key, self.worker_id, nx=True, px=self.owner_ttl_ms)
+        if not acquired:
+            acquired = await self._redis.get(key) == self.worker_id
+        if acquired:
+            self._owned.add(room_id)
+        else:
+            self._owned.discard(room_id)
+        return bool(acquired)
+
+    async def release_owner(self, room_id: str) -> None:
+        self._owned.discard(room_id)
+        await self._release(keys=[self._owner_key(room_id)], args=[self.worker_id])
+
+    def is_owner(self, room_id: str) -> bool:
+        return room_id in self._owned
+
+    async def _read_loop(self) -> None:
+        # get_message нельзя вызывать до первой подписки
+        await self._subscribed.wait()
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Room bus read failed")
+                await asyncio.sleep(1.0)
+                continue
+            if message is None or message.get("type") != "message":
+                continue
+            room_id = message["channel"][len(self.CHANNEL_PREFIX):]
+            handler = self._handlers.get(room_id)
+            if handler is None:
+                continue
+            try:
+                envelope = json.loads(message["data"])
+                if envelope.get("origin") != self.worker_id:
+                    await handler(envelope)
+            except Exception:
+                logger.exception("Room bus handler failed for room %s", room_id)
+
+    async def _renew_loop(self) -> None:
+        interval = self.owner_ttl_ms / 3000
+        while True:
+            await asyncio.sleep(interval)
+            for room_id in list(self._owned):
+                if room_id not in self._handlers:
+                    # Комнаты здесь больше нет или она не слушает шину: продлевать ее
+                    # владение — значит навсегда оставить чужих участников без ответа
+                    logger.warning("Releasing ownership of unsubscribed room %s", room_id)
+                    try:
+                        await self.release_owner(room_id)
+                    except Exception:
+                        logger.exception("Failed to release ownership of room %s", room_id)
+                    continue
+                try:
+                    renewed = await self._renew(
+                        keys=[self._owner_key(room_id)],
+                        args=[self.worker_id, self.owner_ttl_ms],
+                    )
+                except Exception:
+                    logger.exception("Failed to renew ownership of room %s", room_id)
+                    continue
+                if not renewed:
+                    logger.warning("Lost ownership of room %s", room_id)
+                    self._owned.discard(room_id)
+
+
+def create_room_bus(url: Optional[str] = None) -> RoomBus:
+    """Шина по настройке WS_ROOM_BUS_URL: redis://… или внутрипроцессная"""
+    url = url if url is not None else settings.WS_ROOM_BUS_URL
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisRoomBus(url)
+    return InProcessRoomBus()
+
+
+room_bus: RoomBus = create_room_bus()
@@ -0,0 +1,175 @@
+"""Кодирование кадров WebSocket: текстовый JSON, orjson, MessagePack, zstd.
+
+Клиент выбирает кодек при подключении параметрами запроса::
+
+    /ws/rooms/{room_id}?name=...&encoding=msgpack&compress=zstd
+
+* ``encoding=json`` (по умолчанию) — текстовые кадры JSON, как раньше;
+* ``encoding=orjson`` — бинарные кадры с JSON в UTF-8;
+* ``encoding=msgpack`` — бинарные кадры MessagePack;
+* ``compress=zstd`` — кадры больше ``WS_COMPRESS_MIN_BYTES`` сжимаются zstd
+  и уходят бинарными (начинаются с магии zstd ``28 b5 2f fd``), меньшие —
+  как обычно.
+
+Текстовый кадр в любую сторону — всегда JSON, поэтому старые клиенты
+ничего не замечают. Если нужной библиотеки на сервере нет, соединение
+остается на текстовом JSON. orjson, msgpack и zstandard импортируются
+лениво; orjson, если установлен, ускоряет и текстовый JSON.
+
+Кодеки общие для всех соединений с одинаковыми параметрами: рассылка по
+комнате кодирует сообщение один раз на кодек, а не на соединение.
+"""
+import importlib
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple, Union
+
+from app.core.config import settings
+from app.ws.document import json_default
+from app.ws.metrics import ENCODED_FRAME_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+ENCODING_JSON = "json"
+ENCODING_ORJSON = "orjson"
+ENCODING_MSGPACK = "msgpack"
+ENCODINGS = (ENCODING_JSON, ENCODING_ORJSON, ENCODING_MSGPACK)
+COMPRESSION_ZSTD = "zstd"
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+Frame = Union[str, bytes]
+
+_modules: Dict[str, Any] = {}
+
+
+class CodecUnavailable(ValueError):
+    pass
+
+
+class FrameTooLarge(ValueError):
+    """Сжатый кадр разжимается больше WS_MAX_FRAME_BYTES"""
+
+
+def _optional_module(name: str) -> Optional[Any]:
+    """Импортировать необязательную зависимость один раз; None — не установлена"""
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
+
+
+class Codec:
+    def __init__(
+        self,
+        encoding: str = ENCODING_JSON,
+        compression: Optional[str] = None,
+        threshold: Optional[int] = None,
+        level: Optional[int] = None,
+    ):
+        if encoding not in ENCODINGS:
+            raise CodecUnavailable(f"unknown encoding {encoding!r}")
+        if compression not in (None, COMPRESSION_ZSTD):
+            raise CodecUnavailable(f"unknown compression {compression!r}")
+        self.encoding = encoding
+        self.compression = compression
+        self.threshold = threshold if threshold is not None else settings.WS_COMPRESS_MIN_BYTES
+        self.name = encoding if compression is None else f"{encoding}+{compression}"
+        self.binary = encoding != ENCODING_JSON
+
+        self._orjson = _optional_module("orjson")
+        if encoding == ENCODING_ORJSON and self._orjson is None:
+            raise CodecUnavailable("orjson is not installed")
+        self._msgpack = None
+        if encoding == ENCODING_MSGPACK:
+            self._msgpack = _optional_module("msgpack")
+            if self._msgpack is None:
+                raise CodecUnavailable("msgpack is not installed")
+        self._zstd = None
+        if compression == COMPRESSION_ZSTD:
+            self._zstd = _optional_module("zstandard")
+            if self._zstd is None:
+                raise CodecUnavailable("zstandard is not installed")
+            self._compressor = self._zstd.ZstdCompressor(
+                level=level if level is not None else settings.WS_COMPRESS_LEVEL
+            )
+
+    def encode(self, message: Any) -> Frame:
+        """Кадр для отправки: str — текстовый, bytes — бинарный"""
+        if self.encoding == ENCODING_MSGPACK:
+            data = self._msgpack.packb(message, use_bin_type=True, default=json_default)
+        else:
+            data = self._dump_json(message)
+        if self._zstd is not None and len(data) >= self.threshold:
+            data = self._compressor.compress(data if isinstance(data, bytes) else data.encode("utf-8"))
+        elif not self.binary and isinstance(data, bytes):
+            data = data.decode("utf-8")
+        ENCODED_FRAME_BYTES.labels(encoding=self.name).observe(len(data))
+        return data
+
+    def decode(self, data: Frame) -> Any:
+        """Разобрать входящий кадр: текстовый — JSON, бинарный — в кодировке соединения"""
+        if isinstance(data, str):
+            return self._load_json(data)
+        if data.startswith(ZSTD_MAGIC):
+            data = self._decompress(data)
+        if self.encoding == ENCODING_MSGPACK:
+            return self._msgpack.unpackb(data, raw=False)
+        return self._load_json(data)
+
+    def _dump_json(self, message: Any) -> Union[str, bytes]:
+        if self._orjson is not None:
+            try:
+                return self._orjson.dumps(message, default=json_default)
+            except TypeError:
+                # Целые больше 64 бит и прочее, чего orjson не умеет
+                pass
+        return json.dumps(message, default=json_default)
+
+    def _load_json(self, data: Frame) -> Any:
+        if self._orjson is not None:
+            return self._orjson.loads(data)
+        return json.loads(data)
+
+    def _decompress(self, data: bytes) -> bytes:
+        zstd = self._zstd or _optional_module("zstandard")
+        if zstd is None:
+            raise ValueError("compressed frame, but zstandard is not installed")
+        # Тот же предел, что и для несжатого кадра: иначе маленький кадр
+        # разворачивается в память далеко за WS_MAX_FRAME_BYTES
+        limit = settings.WS_MAX_FRAME_BYTES
+        size = zstd.frame_content_size(data)
+        if size < 0:
+            raise ValueError("compressed frame without content size")
+        if size > limit:
+            raise FrameTooLarge(f"compressed frame expands to {size} bytes")
+        try:
+            data = zstd.ZstdDecompressor().decompress(data, max_output_size=limit)
+        except zstd.ZstdError as exc:
+            raise ValueError(f"broken compressed frame: {exc}") from exc
+        if len(data) > limit:
+            raise FrameTooLarge(f"compressed frame expands to {len(data)} bytes")
+        return data
+
+
+_codecs: Dict[Tuple[str, Optional[str]], Codec] = {}
+
+
+def get_codec(encoding: Optional[str] = None, compression: Optional[str] = None) -> Codec:
+    """Общий кодек для параметров подключения; недоступный — текстовый JSON"""
+    key = (encoding or ENCODING_JSON, compression or None)
+    if key[0] not in ENCODINGS or key[1] not in (None, COMPRESSION_ZSTD):
+        # Произвольные значения из запроса не кэшируем
+        key = (ENCODING_JSON, None)
+    codec = _codecs.get(key)
+    if codec is None:
+        try:
+            codec = Codec(*key)
+        except CodecUnavailable as exc:
+            logger.info("WebSocket codec %s unavailable (%s), falling back to JSON", key, exc)
+            codec = get_codec()
+        _codecs[key] = codec
+    return codec
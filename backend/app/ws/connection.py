@@ -0,0 +1,214 @@
+"""Исходящая сторона WebSocket-соединения: ограниченная очередь и writer-задача.
+
+``broadcast_to_room`` не отправляет в сокет напрямую, а кладет готовый
+кадр в очередь соединения; единственная writer-задача соединения вычитывает
+очередь и отправляет кадры по порядку. Медленный клиент не плодит задачи
+и не держит неограниченную память: при переполнении срабатывает политика
+``settings.WS_SEND_QUEUE_POLICY``.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+from fastapi import WebSocket
+
+from app.core.config import settings
+from app.ws.codec import Codec, Frame, get_codec
+from app.ws.metrics import (
+    SEND_QUEUE_DEPTH,
+    SEND_QUEUE_DROPPED,
+    SEND_QUEUE_MESSAGES,
+    SENT_BYTES,
+    SENT_FRAMES,
+    SLOW_CONSUMERS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Виды исходящих сообщений
+KIND_PRESENCE = "presence"  # курсоры: теряемые, важна только последняя позиция
+KIND_STATE = "state"  # документ: операции и снимки sync_state
+KIND_CONTROL = "control"  # служебные: join/leave/users_list/ack
+
+POLICY_DROP_CURSOR = "drop_cursor"
+POLICY_COALESCE = "coalesce"
+POLICY_DISCONNECT = "disconnect"
+QUEUE_POLICIES = (POLICY_DROP_CURSOR, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# Код закрытия для медленного клиента: "Try Again Later"
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+def message_kind(message_type: Optional[str]) -> str:
+    if message_type in ("cursor_update", "presence"):
+        return KIND_PRESENCE
+    if message_type in (
+        "join", "leave", "users_list", "op_ack", "project_saved", "throttled", "ping", "pong", "reconnect",
+    ):
+        return KIND_CONTROL
+    return KIND_STATE
+
+
+class Connection:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        snapshot: Optional[Callable[[], Frame]] = None,
+        max_queue: Optional[int] = None,
+        policy: Optional[str] = None,
+        codec: Optional[Codec] = None,
+        deltas: bool = True,
+    ):
+        self.websocket = websocket
+        # Клиент понимает дельта-протокол (операции с версиями, op_ack);
+        # иначе после изменений получает полное состояние sync_state
+        self.deltas = deltas
+        # Кодек, согласованный при подключении: str — текстовый кадр, bytes — бинарный
+        self.codec = codec or get_codec()
+        self._sent_bytes = SENT_BYTES.labels(encoding=self.codec.name)
+        self._sent_frames = SENT_FRAMES.labels(encoding=self.codec.name)
+        # Фабрика актуального sync_state для политики coalesce
+        self._snapshot = snapshot
+        self.max_queue = max_queue or settings.WS_SEND_QUEUE_SIZE
+        self.policy = policy or settings.WS_SEND_QUEUE_POLICY
+        if self.policy not in QUEUE_POLICIES:
+            logger.warning("Unknown WS_SEND_QUEUE_POLICY %r, using %r", self.policy, POLICY_COALESCE)
+            self.policy = POLICY_COALESCE
+        self._queue: Deque[Tuple[str, Frame]] = deque()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        # Когда от клиента последний раз пришел кадр (для heartbeat)
+        self.last_seen = time.monotonic()
+        # Клиент хоть раз ответил на ping: только такие соединения heartbeat
+        # закрывает за молчание, остальных проверяют ping-кадры протокола
+        self.answers_ping = False
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+
+    def send(self, data: Frame, kind: str = KIND_STATE) -> bool:
+        """Поставить кадр в очередь; False — соединение закрыто или отключено"""
+        if self.closed:
+            return False
+        if len(self._queue) >= self.max_queue and not self._make_room(kind):
+            return not self.closed
+
+        SEND_QUEUE_DEPTH.observe(len(self._queue))
+        self._queue.append((kind, data))
+        SEND_QUEUE_MESSAGES.inc()
+        self._idle.clear()
+        self._wakeup.set()
+        return True
+
+    async def drain(self) -> None:
+        """Дождаться, пока writer отправит все поставленные кадры"""
+        await self._idle.wait()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._discard(len(self._queue))
+        self._idle.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def abort(self, code: int) -> None:
+        """Закрыть соединение и сокет с кодом code, не дожидаясь очереди"""
+        self.close()
+        asyncio.create_task(self._close_socket(code))
+
+    def _make_room(self, kind: str) -> bool:
+        """Освободить место в полной очереди; False — новый кадр не ставим"""
+        if self.policy == POLICY_DISCONNECT:
+            self._disconnect_slow_consumer()
+            return False
+
+        # Устаревшие курсоры выбрасываем первыми: важна только последняя позиция
+        for i, (queued_kind, _) in enumerate(self._queue):
+            if queued_kind == KIND_PRESENCE:
+                del self._queue[i]
+                SEND_QUEUE_MESSAGES.dec()
+                SEND_QUEUE_DROPPED.labels(kind=KIND_PRESENCE, reason="stale").inc()
+                return True
+
+        if kind == KIND_PRESENCE:
+            SEND_QUEUE_DROPPED.labels(kind=KIND_PRESENCE, reason="full").inc()
+            return False
+
+        if self.policy == POLICY_COALESCE and self._snapshot is not None:
+            # Все документные кадры в очереди заменяются одним актуальным снимком,
+            # поэтому и новый кадр уже отражен в нем
+            self._coalesce_state()
+            return False
+
+        self._disconnect_slow_consumer()
+        return False
+
+    def _coalesce_state(self) -> None:
+        kept = deque(item for item in self._queue if item[0] != KIND_STATE)
+        coalesced = len(self._queue) - len(kept)
+        if coalesced == 0:
+            # Очередь забита служебными кадрами — схлопывать нечего
+            self._disconnect_slow_consumer()
+            return
+        self._queue = kept
+        self._queue.append((KIND_STATE, self._snapshot()))
+        SEND_QUEUE_MESSAGES.dec(coalesced - 1)
+        SEND_QUEUE_DROPPED.labels(kind=KIND_STATE, reason="coalesced").inc(coalesced + 1)
+        self._idle.clear()
+        self._wakeup.set()
+
+    def _disconnect_slow_consumer(self) -> None:
+        logger.info("Disconnecting slow WebSocket consumer (queue depth %d)", len(self._queue))
+        SLOW_CONSUMERS.inc()
+        self.abort(SLOW_CONSUMER_CLOSE_CODE)
+
+    async def _close_socket(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def _discard(self, count: int) -> None:
+        for _ in range(count):
+            self._queue.popleft()
+            SEND_QUEUE_MESSAGES.dec()
+
+    async def _writer(self) -> None:
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._idle.set()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                _, data = self._queue.popleft()
+                SEND_QUEUE_MESSAGES.dec()
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+                self._sent_bytes.inc(len(data))
+                self._sent_frames.inc()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Сокет закрыт: дальнейшие кадры некуда отправлять
+            self.closed = True
+            self._discard(len(self._queue))
+            self._idle.set()
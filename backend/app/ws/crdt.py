@@ -0,0 +1,742 @@
+"""Бесконфликтное (CRDT) применение операций к дереву блоков комнаты.
+
+Операции над документом адресуются не индексами, а устойчивыми
+идентификаторами, поэтому одновременные правки нескольких участников
+сходятся к одному состоянию независимо от порядка доставки:
+
+* **Порядок детей** — у каждого блока в списке (корень или
+  ``container.children``) есть дробный ключ позиции ``position``: строка над
+  алфавитом base62, список упорядочен по ``(position, id)``. Вставка «после
+  блока X» получает ключ строго между X и его соседом, поэтому чужие
+  вставки и перемещения не сдвигают ее. ``move_block`` — LWW-регистр
+  «(родитель, ключ)» блока: побеждает перемещение с большим штампом.
+* **Поля блока** — LWW-регистры: у каждого поля штамп последней записи,
+  запись со штампом меньше текущего отбрасывается. Словарные поля
+  (``style``, ``props``) и разделы ``theme``/``header``/``footer`` сливаются
+  по ключам (LWW-map); значение ``None`` удаляет ключ.
+* **Удаление** — надгробие (tombstone): удаленный блок больше не
+  воскрешается, правки и перемещения после удаления игнорируются. Потомки
+  удаленного контейнера уходят вместе с ним в «кладбище» и возвращаются в
+  документ, если их перемещают наружу, — так удаление и перемещение
+  коммутируют.
+
+Штамп — пара ``(lamport, actor)``. В комнате операции упорядочивает
+владелец, поэтому штампом служит ``(version, userId)`` операции; движок
+при этом не полагается на порядок и годится для реплик с независимыми
+часами (см. тесты сходимости).
+
+Операция проходит две фазы: ``prepare`` на стороне, принявшей ее от
+клиента, переводит пользовательскую форму (``afterId``, устаревшие
+``fromIndex``/``toIndex``) в ключ позиции, а ``apply`` применяет уже
+разрешенную операцию на всех репликах одинаково.
+
+Для undo/redo движок строит обратные операции (``invert``) по состоянию
+до применения исходной и помечает их ее штампом. Перед отменой
+``current`` оставляет в обратной операции только то, что с тех пор никто
+не перезаписал: отмена не затирает чужие правки. Удаление отменяется
+``add_block`` с ``restore``: блок возвращается из кладбища с поддеревом,
+надгробие снимается.
+
+Ключ позиции всегда выдает ``prepare`` (из ``afterId``/``parentId``):
+``position`` из операции клиента не принимается, а ``apply`` отклоняет
+ключ не из алфавита base62 или с нулевой цифрой на конце.
+
+Пакет операций применяется атомарно без копии документа: между ``begin``
+и ``commit`` каждое изменение состояния, индекса и метаданных записывает
+обратное действие, и ``rollback`` отменяет только затронутое — так же, как
+откатывается JSON Patch (app/ws/patch.py).
+
+Метаданные не копятся бесконечно: ``collect`` забывает штампы, надгробия
+и удаленные поддеревья старше заданной версии (комната вызывает его с
+границей окна журнала операций, см. ``Room.collect_garbage``).
+
+Ограничения: перемещения, образующие цикл (A в B и одновременно B в A),
+пропускаются и могут разойтись; запись ``children``/``cells`` целиком
+(устаревшие клиенты) заменяет поддерево без гарантий сходимости.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.ws.block_index import BlockIndex, BlockRef
+from app.ws.document import OBJECT_TYPES, Node, from_json, to_json
+from app.ws.patch import apply_patch
+
+# (версия, автор); операции пакета batch — (версия, автор, номер в пакете)
+Stamp = Tuple[Any, ...]
+
+ZERO_STAMP: Stamp = (0, "")
+
+_MISSING = object()
+
+# Цифры ключей позиций в порядке возрастания кодов ASCII
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BASE = len(DIGITS)
+_DIGIT = {ch: i for i, ch in enumerate(DIGITS)}
+_MIDDLE = DIGITS[BASE // 2]
+
+# Словарные поля блока, которые сливаются по ключам
+MAP_FIELDS = ("style", "props")
+# Поля, задающие структуру дерева: заменяются целиком
+STRUCTURAL_FIELDS = ("children", "cells")
+# Разделы состояния, обновляемые update_theme / update_header / update_footer
+SECTION_OPS = {
+    "update_theme": "theme",
+    "update_header": "header",
+    "update_footer": "footer",
+}
+
+
+def key_between(a: Optional[str], b: Optional[str]) -> str:
+    """Ключ позиции строго между a и b (None — начало или конец списка).
+
+    Ключи не заканчиваются нулевой цифрой, поэтому между любыми двумя
+    различными ключами всегда есть место.
+    """
+    if a is None and b is None:
+        return _MIDDLE
+    if b is None:
+        # После a: увеличиваем первый разряд, который еще можно увеличить
+        for i, ch in enumerate(a):
+            if ch != DIGITS[-1]:
+                return a[:i] + DIGITS[_DIGIT[ch] + 1]
+        return a + _MIDDLE
+    if a is None:
+        # Перед b: уменьшаем первый разряд, который можно уменьшить без нуля на конце
+        for i, ch in enumerate(b):
+            if _DIGIT[ch] > 1:
+                return b[:i] + DIGITS[_DIGIT[ch] - 1]
+        return b[:-1] + DIGITS[0] + _MIDDLE
+    if not a < b:
+        raise ValueError(f"position keys out of order: {a!r} >= {b!r}")
+
+    result = []
+    bounded = True
+    i = 0
+    while True:
+        low = _DIGIT[a[i]] if i < len(a) else 0
+        high = (_DIGIT[b[i]] if i < len(b) else 0) if bounded else BASE
+        if high - low > 1:
+            result.append(DIGITS[(low + high) // 2])
+            return "".join(result)
+        result.append(DIGITS[low])
+        if high - low == 1:
+            # Префикс уже меньше b — дальше ограничивает только a
+            bounded = False
+        i += 1
+
+
+def is_position_key(key: Any) -> bool:
+    """Ключ позиции: непустая строка из цифр base62 без нулевой цифры на конце"""
+    return (
+        isinstance(key, str) and key != "" and key[-1] != DIGITS[0]
+        and all(ch in _DIGIT for ch in key)
+    )
+
+
+def spread_keys(count: int) -> List[str]:
+    """count возрастающих ключей, равномерно распределенных по пространству"""
+    width = 1
+    while BASE ** width <= count:
+        width += 1
+    step = BASE ** width // (count + 1)
+    keys = []
+    for i in range(1, count + 1):
+        value = i * step
+        digits = []
+        for _ in range(width):
+            value, digit = divmod(value, BASE)
+            digits.append(DIGITS[digit])
+        keys.append("".join(reversed(digits)).rstrip(DIGITS[0]))
+    return keys
+
+
+def _restore_key(mapping: Any, key: Any, previous: Any) -> None:
+    if previous is _MISSING:
+        mapping.pop(key, None)
+    else:
+        mapping[key] = previous
+
+
+def _detached(value: Any) -> Any:
+    """Копия значения из операции: операция хранится в журнале и не должна меняться вместе с состоянием"""
+    if isinstance(value, (dict, Node, list)):
+        return from_json(value)
+    return value
+
+
+def _block_id(block: Any) -> Optional[str]:
+    if isinstance(block, OBJECT_TYPES) and isinstance(block.get("id"), str):
+        return block["id"]
+    return None
+
+
+class BlockTreeCRDT:
+    def __init__(self, state: dict, index: BlockIndex):
+        self.index = index
+        # Ключ позиции блока в его списке и штамп последней вставки/перемещения
+        self.keys: Dict[str, str] = {}
+        self.moved: Dict[str, Stamp] = {}
+        # LWW-штампы полей: (blockId, поле), (blockId, поле, ключ), ("#раздел", ключ);
+        # (blockId, поле, None) — наибольший штамп среди ключей словарного поля
+        self.fields: Dict[tuple, Stamp] = {}
+        # Надгробия удаленных блоков
+        self.deleted: Dict[str, Stamp] = {}
+        # Удаленные поддеревья: потомков можно вернуть перемещением наружу
+        self.graveyard: List[dict] = []
+        self.graveyard_index = BlockIndex()
+        # Обратные действия открытого пакета (begin/rollback); None — запись выключена
+        self.journal: Optional[List[Callable[[], None]]] = None
+        self.reset(state)
+
+    def reset(self, state: dict) -> None:
+        """Начать историю заново с состояния state (sync_state); индекс уже перестроен"""
+        self.state = state
+        self.keys = {}
+        self.moved = {}
+        self.fields = {}
+        self.deleted = {}
+        self.graveyard = []
+        self.graveyard_index = BlockIndex()
+        blocks = state.get("blocks") if isinstance(state, OBJECT_TYPES) else None
+        if isinstance(blocks, list):
+            self._key_list(blocks)
+
+    # --- Откат пакета ---
+
+    def begin(self) -> None:
+        """Начать запись обратных действий: следующие apply можно откатить"""
+        self.journal = []
+
+    def commit(self) -> None:
+        self.journal = None
+
+    def rollback(self) -> None:
+        """Отменить все изменения с begin в обратном порядке"""
+        journal, self.journal = self.journal or [], None
+        for undo in reversed(journal):
+            undo()
+
+    def _log(self, undo: Callable[[], None]) -> None:
+        if self.journal is not None:
+            self.journal.append(undo)
+
+    def _put(self, mapping: Any, key: Any, value: Any) -> None:
+        if self.journal is not None:
+            previous = mapping.get(key, _MISSING)
+            self.journal.append(lambda: _restore_key(mapping, key, previous))
+        mapping[key] = value
+
+    def _drop(self, mapping: Any, key: Any) -> None:
+        if key not in mapping:
+            return
+        if self.journal is not None:
+            previous = mapping[key]
+            self.journal.append(lambda: mapping.__setitem__(key, previous))
+        mapping.pop(key)
+
+    def _detach(self, tree_index: BlockIndex, block_id: str) -> Optional[BlockRef]:
+        ref = tree_index.detach(block_id)
+        if ref is not None and self.journal is not None:
+            slot = ref.slot
+            if slot is None:
+                self.journal.append(lambda: tree_index.place_in_cell(ref.block, ref.parent_id, ref.container))
+            else:
+                self.journal.append(lambda: tree_index.insert(ref.block, ref.parent_id, ref.container, slot))
+        return ref
+
+    def export(self) -> dict:
+        """Метаданные движка в JSON-совместимом виде (для снимков между воркерами)"""
+        return {
+            "keys": self.keys,
+            "moved": {block_id: list(stamp) for block_id, stamp in self.moved.items()},
+            "fields": [[list(path), list(stamp)] for path, stamp in self.fields.items()],
+            "deleted": {block_id: list(stamp) for block_id, stamp in self.deleted.items()},
+            "graveyard": self.graveyard,
+        }
+
+    def load(self, meta: dict) -> None:
+        """Восстановить метаданные из export() для текущего состояния"""
+        self.keys = dict(meta.get("keys", {}))
+        self.moved = {block_id: tuple(stamp) for block_id, stamp in meta.get("moved", {}).items()}
+        self.fields = {tuple(path): tuple(stamp) for path, stamp in meta.get("fields", [])}
+        self.deleted = {block_id: tuple(stamp) for block_id, stamp in meta.get("deleted", {}).items()}
+        self.graveyard = from_json(list(meta.get("graveyard", [])))
+        self.graveyard_index = BlockIndex()
+        self.graveyard_index.rebuild({"blocks": self.graveyard})
+
+    def collect(self, horizon: int) -> int:
+        """Забыть метаданные операций с версией меньше horizon; вернуть число записей.
+
+        Все следующие операции комнаты получат версии не меньше horizon, поэтому
+        для LWW такой штамп ничем не отличается от отсутствующего. Надгробия
+        уходят вместе с поддеревьями из кладбища: операция над таким блоком
+        считается ссылкой на неизвестный блок (клиент, отставший больше чем
+        на окно журнала, все равно получает снимок). Отмена правок старше
+        horizon после этого не применяется.
+        """
+        removed = 0
+        expired = {block_id for block_id, stamp in self.deleted.items() if stamp[0] < horizon}
+        if expired:
+            for block_id in expired:
+                del self.deleted[block_id]
+            self.graveyard = [block for block in self.graveyard if _block_id(block) not in expired]
+            self.graveyard_index = BlockIndex()
+            self.graveyard_index.rebuild({"blocks": self.graveyard})
+            removed += len(expired)
+
+        def known(block_id: Any) -> bool:
+            return block_id in self.index or block_id in self.graveyard_index
+
+        count = len(self.keys) + len(self.moved) + len(self.fields)
+        self.keys = {block_id: key for block_id, key in self.keys.items() if known(block_id)}
+        self.moved = {
+            block_id: stamp for block_id, stamp in self.moved.items() if stamp[0] >= horizon and known(block_id)
+        }
+        self.fields = {
+            path: stamp for path, stamp in self.fields.items()
+            if stamp[0] >= horizon and (path[0].startswith("#") or known(path[0]))
+        }
+        return removed + count - len(self.keys) - len(self.moved) - len(self.fields)
+
+    # --- Разрешение пользовательской формы операции ---
+
+    def prepare(self, op_type: str, payload: Any) -> Optional[dict]:
+        """Перевести операцию клиента в разрешенную форму; None — операция неприменима"""
+        if op_type == "patch":
+            return payload if isinstance(payload, list) else None
+        if not isinstance(payload, dict):
+            return None
+        if op_type == "add_block":
+            return self._prepare_add(payload)
+        if op_type == "move_block":
+            return self._prepare_move(payload)
+        return payload
+
+    def _prepare_add(self, payload: dict) -> Optional[dict]:
+        block = payload.get("block")
+        if _block_id(block) is None or block["id"] in self.index or block["id"] in self.deleted:
+            return None
+        parent_id = payload.get("parentId")
+        container = self.index.children_container(parent_id, self.state)
+        if container is None and parent_id is not None:
+            return None
+        # Ключ выдает сервер: ключ клиента мог бы быть некорректным или чужим
+        if "afterId" in payload:
+            position = self._position_after(container or [], payload["afterId"], None)
+        else:
+            # Без afterId — в конец списка, как раньше
+            last = _block_id(container[-1]) if container else None
+            position = key_between(self.keys.get(last), None)
+        if position is None:
+            return None
+        return {"block": block, "parentId": parent_id, "afterId": payload.get("afterId"), "position": position}
+
+    def _prepare_move(self, payload: dict) -> Optional[dict]:
+        if "blockId" not in payload:
+            return self._prepare_index_move(payload)
+        block_id = payload["blockId"]
+        ref = self.index.get(block_id)
+        if ref is None:
+            return None
+        after_id = payload.get("afterId")
+        if after_id is not None:
+            after = self.index.get(after_id)
+            if after is None or after_id == block_id:
+                return None
+            parent_id = after.parent_id
+        else:
+            parent_id = payload.get("parentId")
+        if self._is_cycle(block_id, parent_id):
+            return None
+        container = self.index.children_container(parent_id, self.state)
+        if container is None:
+            return None
+        position = self._position_after(container, after_id, block_id)
+        if position is None:
+            return None
+        return {"blockId": block_id, "parentId": parent_id, "afterId": after_id, "position": position}
+
+    def _prepare_index_move(self, payload: dict) -> Optional[dict]:
+        """Устаревшая форма: переставить корневой блок из fromIndex в toIndex"""
+        from_index = payload.get("fromIndex")
+        to_index = payload.get("toIndex")
+        blocks = self.state.get("blocks")
+        if not isinstance(blocks, list) or not isinstance(from_index, int) or not isinstance(to_index, int):
+            return None
+        if not (0 <= from_index < len(blocks) and 0 <= to_index < len(blocks)):
+            return None
+        block_id = _block_id(blocks[from_index])
+        if block_id is None:
+            return None
+        # Сосед слева в списке без перемещаемого блока
+        after_slot = to_index - 1 if to_index <= from_index else to_index
+        after_id = _block_id(blocks[after_slot]) if to_index > 0 else None
+        position = self._position_after(blocks, after_id, block_id)
+        if position is None:
+            return None
+        return {"blockId": block_id, "parentId": None, "afterId": after_id, "position": position}
+
+    def _position_after(self, container: List[dict], after_id: Optional[str], moving_id: Optional[str]) -> Optional[str]:
+        """Ключ позиции сразу после after_id (None — в начало списка)"""
+        if after_id is None:
+            slot = -1
+        else:
+            slot = self.index.slot_of(after_id)
+            if slot is None or self.index.get(after_id).container is not container:
+                return None
+        right_slot = slot + 1
+        if right_slot < len(container) and _block_id(container[right_slot]) == moving_id:
+            right_slot += 1
+        left = self.keys.get(after_id) if after_id is not None else None
+        right = self.keys.get(_block_id(container[right_slot])) if right_slot < len(container) else None
+        if left is not None and right is not None and not left < right:
+            # Одинаковые ключи у соседей (одновременные вставки) — встаем после обоих
+            return key_between(max(left, right), None)
+        return key_between(left, right)
+
+    def _is_cycle(self, block_id: str, parent_id: Optional[str]) -> bool:
+        """Перемещение блока внутрь собственного поддерева"""
+        while parent_id is not None:
+            if parent_id == block_id:
+                return True
+            ref, _ = self._locate(parent_id)
+            parent_id = ref.parent_id if ref is not None else None
+        return False
+
+    # --- Применение разрешенных операций ---
+
+    def apply(self, op_type: str, payload: Any, stamp: Stamp) -> bool:
+        """Применить разрешенную операцию со штампом.
+
+        True — операция принята (в том числе проигравшая по LWW или
+        адресованная удаленному блоку: это не расхождение, а конфликт,
+        разрешенный одинаково на всех репликах). False — операция
+        некорректна или ссылается на неизвестный блок.
+        """
+        if op_type == "patch":
+            return self._patch(payload)
+        if not isinstance(payload, dict):
+            return False
+        if op_type == "update_block":
+            return self._update_block(payload, stamp)
+        if op_type == "add_block":
+            return self._add_block(payload, stamp)
+        if op_type == "delete_block":
+            return self._delete_block(payload, stamp)
+        if op_type == "move_block":
+            return self._move_block(payload, stamp)
+        if op_type in SECTION_OPS:
+            section = SECTION_OPS[op_type]
+            if not isinstance(self.state.get(section), OBJECT_TYPES):
+                self._put(self.state, section, Node())
+            self._merge_map(self.state[section], ("#" + section,), payload, stamp)
+            return True
+        return False
+
+    def _update_block(self, payload: dict, stamp: Stamp) -> bool:
+        block_id = payload.get("blockId")
+        data = payload.get("data", {})
+        if not isinstance(data, dict) or not isinstance(block_id, str):
+            return False
+        if block_id in self.deleted:
+            return True
+        ref, tree_index = self._locate(block_id)
+        if ref is None or data.get("id", block_id) != block_id:
+            return False
+        block = ref.block
+        for field, value in data.items():
+            if field == "id":
+                continue
+            path = (block_id, field)
+            if field in MAP_FIELDS and isinstance(value, dict):
+                if self._newer(path, stamp):
+                    if not isinstance(block.get(field), OBJECT_TYPES):
+                        self._put(block, field, Node())
+                    self._merge_map(block[field], path, value, stamp)
+                continue
+            # Целиком поле перезаписывается, только если оно новее и всех его ключей
+            if not self._newer(path, stamp) or not self._newer(path + (None,), stamp):
+                continue
+            self._put(self.fields, path, stamp)
+            if field in STRUCTURAL_FIELDS:
+                # При откате потомки переиндексируются после возврата прежнего поля
+                self._log(lambda: tree_index.reindex_children(block_id))
+            self._put(block, field, _detached(value))
+            if field in STRUCTURAL_FIELDS:
+                tree_index.reindex_children(block_id)
+                self._key_children(block)
+        return True
+
+    def _merge_map(self, target: dict, path: tuple, values: dict, stamp: Stamp) -> None:
+        """Слить словарь по ключам: каждый ключ — отдельный LWW-регистр"""
+        changed = False
+        for key, value in values.items():
+            key_path = path + (key,)
+            if not self._newer(key_path, stamp):
+                continue
+            self._put(self.fields, key_path, stamp)
+            changed = True
+            if value is None:
+                self._drop(target, key)
+            else:
+                self._put(target, key, _detached(value))
+        if changed and len(path) == 2:
+            # Поле блока: запись поля целиком должна быть новее всех его ключей
+            max_path = path + (None,)
+            self._put(self.fields, max_path, max(self.fields.get(max_path, ZERO_STAMP), stamp))
+
+    def _add_block(self, payload: dict, stamp: Stamp) -> bool:
+        block = payload.get("block")
+        block_id = _block_id(block)
+        position = payload.get("position")
+        if block_id is None or not is_position_key(position):
+            return False
+        if block_id in self.deleted:
+            if not payload.get("restore"):
+                return True
+            # Отмена удаления: надгробие снимается, копия из кладбища заменяется блоком операции
+            self._drop(self.deleted, block_id)
+            self._detach(self.graveyard_index, block_id)
+        if self._locate(block_id)[0] is not None:
+            return False
+        target = self._container(payload.get("parentId"))
+        if target is None:
+            return False
+        block = from_json(block)
+        self._put(self.keys, block_id, position)
+        self._put(self.moved, block_id, stamp)
+        self._key_children(block)
+        self._insert_sorted(block, payload.get("parentId"), *target)
+        return True
+
+    def _delete_block(self, payload: dict, stamp: Stamp) -> bool:
+        block_id = payload.get("blockId")
+        if not isinstance(block_id, str):
+            return False
+        if block_id in self.deleted:
+            return True
+        ref, tree_index = self._locate(block_id)
+        if ref is None:
+            return False
+        self._put(self.deleted, block_id, stamp)
+        self._detach(tree_index, block_id)
+        self.graveyard_index.insert(ref.block, None, self.graveyard, len(self.graveyard))
+        self._log(lambda: self.graveyard_index.detach(block_id))
+        return True
+
+    def _move_block(self, payload: dict, stamp: Stamp) -> bool:
+        block_id = payload.get("blockId")
+        position = payload.get("position")
+        parent_id = payload.get("parentId")
+        if not isinstance(block_id, str) or not is_position_key(position):
+            return False
+        if block_id in self.deleted:
+            return True
+        ref, tree_index = self._locate(block_id)
+        target = self._container(parent_id)
+        if ref is None or target is None:
+            return False
+        if not stamp > self.moved.get(block_id, ZERO_STAMP) or self._is_cycle(block_id, parent_id):
+            return True
+        self._put(self.keys, block_id, position)
+        self._put(self.moved, block_id, stamp)
+        self._detach(tree_index, block_id)
+        # Контейнер назначения мог быть внутри перемещаемого поддерева — ищем заново
+        self._insert_sorted(ref.block, parent_id, *self._container(parent_id))
+        return True
+
+    def _patch(self, patch: Any) -> bool:
+        """JSON Patch применяется в порядке владельца, без LWW-разрешения"""
+        mark = len(self.journal) if self.journal is not None else 0
+        structural = apply_patch(self.state, self.index, patch, self.journal)
+        if structural is None:
+            return False
+        if structural:
+            if self.journal is not None:
+                # Индекс перестраивается уже после отката самого патча
+                self.journal.insert(mark, lambda: self.index.rebuild(self.state))
+            self.refresh()
+        return True
+
+    def refresh(self) -> None:
+        """Перестроить индекс после структурной правки в обход операций движка.
+
+        Ключи сохраняются, пока порядок списка с ними согласован; новым
+        блокам ключи выдаются между соседями, а список, где порядок
+        разошелся с ключами, получает ключи заново.
+        """
+        self.index.rebuild(self.state)
+        blocks = self.state.get("blocks")
+        if isinstance(blocks, list):
+            self._rekey_list(blocks)
+
+    def _rekey_list(self, container: List[dict]) -> None:
+        ids = [_block_id(block) for block in container]
+        keys = [self.keys.get(block_id) for block_id in ids]
+        present = [key for block_id, key in zip(ids, keys) if block_id is not None and key is not None]
+        if all(a < b for a, b in zip(present, present[1:])):
+            last = None
+            for i, block_id in enumerate(ids):
+                if block_id is None:
+                    continue
+                if keys[i] is None:
+                    following = next((key for key in keys[i + 1:] if key is not None), None)
+                    keys[i] = key_between(last, following)
+                    self._put(self.keys, block_id, keys[i])
+                last = keys[i]
+        else:
+            valid = [block_id for block_id in ids if block_id is not None]
+            for block_id, key in zip(valid, spread_keys(len(valid))):
+                self._put(self.keys, block_id, key)
+        for block in container:
+            if isinstance(block, OBJECT_TYPES):
+                self._key_children(block, self._rekey_list)
+
+    # --- Обратные операции (undo/redo) ---
+
+    def invert(self, op_type: str, payload: Any, stamp: Stamp) -> Optional[List[dict]]:
+        """Операции, отменяющие разрешенную операцию, по состоянию до ее применения.
+
+        Возвращает список ``{"type", "payload", "stamp"}`` (пустой — операция
+        ничего не изменит) или None, если операция не отменяется: patch и
+        блоки в ячейках сетки.
+        """
+        if op_type == "update_block":
+            block_id = payload.get("blockId")
+            ref = self._locate(block_id)[0] if block_id not in self.deleted else None
+            if ref is None or not isinstance(payload.get("data"), dict):
+                return []
+            data = {}
+            for field, value in payload["data"].items():
+                if field == "id":
+                    continue
+                old = ref.block.get(field)
+                if field in MAP_FIELDS and isinstance(value, dict):
+                    old = old if isinstance(old, OBJECT_TYPES) else {}
+                    data[field] = {key: _detached(old.get(key)) for key in value}
+                else:
+                    data[field] = _detached(old)
+            return [{"type": op_type, "payload": {"blockId": block_id, "data": data}, "stamp": stamp}]
+        if op_type in SECTION_OPS:
+            section = self.state.get(SECTION_OPS[op_type])
+            section = section if isinstance(section, OBJECT_TYPES) else {}
+            values = {key: _detached(section.get(key)) for key in payload}
+            return [{"type": op_type, "payload": values, "stamp": stamp}]
+        if op_type == "add_block":
+            block_id = _block_id(payload.get("block"))
+            if block_id is None or (block_id in self.deleted and not payload.get("restore")):
+                return []
+            return [{"type": "delete_block", "payload": {"blockId": block_id}, "stamp": stamp}]
+        if op_type in ("delete_block", "move_block"):
+            block_id = payload.get("blockId")
+            ref = self._locate(block_id)[0] if block_id not in self.deleted else None
+            if ref is None:
+                return []
+            if ref.slot is None or block_id not in self.keys:
+                return None
+            where = {"blockId": block_id, "parentId": ref.parent_id, "position": self.keys[block_id]}
+            if op_type == "move_block":
+                return [{"type": "move_block", "payload": where, "stamp": stamp}]
+            return [{"type": "add_block", "payload": {**where, "restore": True}, "stamp": stamp}]
+        return None
+
+    def current(self, inverse: dict) -> Optional[dict]:
+        """Обратная операция без того, что после исходной перезаписали; None — отменять нечего"""
+        op_type, payload, stamp = inverse["type"], inverse["payload"], tuple(inverse["stamp"])
+        if op_type == "update_block":
+            block_id = payload["blockId"]
+            if block_id in self.deleted or self._locate(block_id)[0] is None:
+                return None
+            data = {}
+            for field, value in payload["data"].items():
+                path = (block_id, field)
+                if field in MAP_FIELDS and isinstance(value, dict):
+                    kept = {key: item for key, item in value.items() if self.fields.get(path + (key,)) == stamp}
+                    if kept:
+                        data[field] = kept
+                elif self.fields.get(path) == stamp:
+                    data[field] = value
+            return {"type": op_type, "payload": {"blockId": block_id, "data": data}} if data else None
+        if op_type in SECTION_OPS:
+            prefix = ("#" + SECTION_OPS[op_type],)
+            values = {key: value for key, value in payload.items() if self.fields.get(prefix + (key,)) == stamp}
+            return {"type": op_type, "payload": values} if values else None
+        if op_type == "delete_block":
+            return {"type": op_type, "payload": payload} if payload["blockId"] in self.index else None
+        block_id = payload["blockId"]
+        if self._container(payload["parentId"]) is None or self._is_cycle(block_id, payload["parentId"]):
+            return None
+        if op_type == "move_block":
+            if block_id in self.deleted or self.moved.get(block_id) != stamp:
+                return None
+            return {"type": op_type, "payload": payload}
+        # add_block с restore: блок возвращается таким, каким лежит в кладбище сейчас
+        ref = self.graveyard_index.get(block_id)
+        if self.deleted.get(block_id) != stamp or ref is None:
+            return None
+        return {"type": op_type, "payload": {**payload, "block": to_json(ref.block)}}
+
+    # --- Вспомогательное ---
+
+    def _newer(self, path: tuple, stamp: Stamp) -> bool:
+        return stamp > self.fields.get(path, ZERO_STAMP)
+
+    def _locate(self, block_id: Any) -> Tuple[Optional[BlockRef], Optional[BlockIndex]]:
+        """Найти блок в документе или среди удаленных поддеревьев"""
+        ref = self.index.get(block_id)
+        if ref is not None:
+            return ref, self.index
+        ref = self.graveyard_index.get(block_id)
+        if ref is not None:
+            return ref, self.graveyard_index
+        return None, None
+
+    def _container(self, parent_id: Optional[str]) -> Optional[Tuple[List[dict], BlockIndex]]:
+        """Список детей родителя и индекс дерева, в котором он лежит"""
+        if parent_id is None:
+            if not isinstance(self.state.get("blocks"), list):
+                self._put(self.state, "blocks", [])
+            return self.state["blocks"], self.index
+        ref, tree_index = self._locate(parent_id)
+        if ref is None or ref.block.get("type") != "container":
+            return None
+        if not isinstance(ref.block.get("children"), list):
+            self._put(ref.block, "children", [])
+        return ref.block["children"], tree_index
+
+    def _sort_key(self, block: Any) -> Tuple[str, str]:
+        block_id = _block_id(block) or ""
+        return self.keys.get(block_id, ""), block_id
+
+    def _insert_sorted(self, block: dict, parent_id: Optional[str], container: List[dict], tree_index: BlockIndex) -> None:
+        key = self._sort_key(block)
+        low, high = 0, len(container)
+        while low < high:
+            middle = (low + high) // 2
+            if self._sort_key(container[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        tree_index.insert(block, parent_id, container, low)
+        block_id = _block_id(block)
+        if block_id is not None:
+            self._log(lambda: tree_index.detach(block_id))
+
+    def _key_list(self, container: List[dict]) -> None:
+        """Раздать блокам списка ключи по текущему порядку"""
+        ids = [_block_id(block) for block in container]
+        for block_id, key in zip(ids, spread_keys(len(ids))):
+            if block_id is not None:
+                self._put(self.keys, block_id, key)
+        for block in container:
+            if isinstance(block, OBJECT_TYPES):
+                self._key_children(block)
+
+    def _key_children(self, block: dict, key_list: Optional[Callable[[List[dict]], None]] = None) -> None:
+        """Раздать ключи спискам внутри блока (по умолчанию — заново по порядку)"""
+        key_list = key_list or self._key_list
+        if block.get("type") == "container" and isinstance(block.get("children"), list):
+            key_list(block["children"])
+        if block.get("type") == "grid" and isinstance(block.get("cells"), list):
+            for cell in block["cells"]:
+                if isinstance(cell, OBJECT_TYPES) and isinstance(cell.get("block"), OBJECT_TYPES):
+                    self._key_children(cell["block"], key_list)
@@ -0,0 +1,204 @@
+"""Компактная модель документа комнаты в памяти.
+
+Состояние комнаты — дерево JSON, присланное клиентом. В виде обычных
+``dict`` каждый блок и каждая карта стилей несет свою хеш-таблицу, хотя
+наборы ключей у тысяч блоков одинаковые. Модель хранит объекты JSON как
+``Node``:
+
+* у узла два слота — «форма» (кортеж ключей) и список значений, без
+  ``__dict__`` и без хеш-таблицы;
+* формы общие: узлы с одинаковыми ключами в одинаковом порядке ссылаются
+  на один кортеж, ключи в нем интернированы;
+* короткие строковые значения (``"text"``, ``"center"``, ``"#333"``)
+  интернируются, поэтому повторы в стилях хранятся один раз;
+* списки детей — обычные ``list`` узлов.
+
+``Node`` зарегистрирован как ``MutableMapping`` и сравнивается со
+словарями, поэтому индекс блоков, CRDT-движок и JSON Patch работают с ним
+как со словарем. Горячие проверки типа используют ``OBJECT_TYPES``:
+``isinstance`` с кортежем конкретных классов не проходит через ABC. Порядок
+ключей сохраняется, ``to_json(from_json(x)) == x`` для любого JSON.
+Сериализаторы получают словарь через ``json_default``.
+
+Поиск ключа — линейный по форме; у блоков и стилей ключей единицы, для
+объектов из сотен ключей словарь быстрее, но в документах лендингов их нет.
+"""
+import sys
+from collections.abc import ItemsView, KeysView, Mapping, MutableMapping, ValuesView
+from typing import Any, Dict, Iterator, List, Tuple
+
+# Больше форм не кэшируем: набор ключей приходит от клиента
+MAX_SHAPES = 4096
+# Строки длиннее не интернируются (тексты, id, ссылки на картинки)
+MAX_INTERNED_LENGTH = 24
+# Значения этих ключей уникальны — интернировать их незачем
+_UNIQUE_KEYS = frozenset(("id", "blockId", "content"))
+
+Shape = Tuple[str, ...]
+
+_shapes: Dict[Shape, Shape] = {(): ()}
+
+
+def _shape(keys: Shape) -> Shape:
+    """Общий кортеж ключей для формы keys"""
+    shape = _shapes.get(keys)
+    if shape is None:
+        shape = tuple(sys.intern(key) if type(key) is str else key for key in keys)
+        if len(_shapes) < MAX_SHAPES:
+            _shapes[shape] = shape
+    return shape
+
+
+class Node:
+    """Объект JSON: общая форма ключей и список значений"""
+
+    __slots__ = ("_shape", "_values")
+
+    def __init__(self, items: Any = ()) -> None:
+        data = dict(items)
+        self._shape = _shape(tuple(data))
+        self._values = list(data.values())
+
+    @classmethod
+    def _make(cls, shape: Shape, values: List[Any]) -> "Node":
+        node = cls.__new__(cls)
+        node._shape = shape
+        node._values = values
+        return node
+
+    def __getitem__(self, key: Any) -> Any:
+        try:
+            return self._values[self._shape.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        try:
+            return self._values[self._shape.index(key)]
+        except ValueError:
+            return default
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._shape
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        try:
+            self._values[self._shape.index(key)] = value
+        except ValueError:
+            self._shape = _shape(self._shape + (key,))
+            self._values.append(value)
+
+    def __delitem__(self, key: Any) -> None:
+        try:
+            i = self._shape.index(key)
+        except ValueError:
+            raise KeyError(key) from None
+        self._shape = _shape(self._shape[:i] + self._shape[i + 1:])
+        del self._values[i]
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._shape)
+
+    def __len__(self) -> int:
+        return len(self._shape)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Node):
+            return dict(zip(self._shape, self._values)) == dict(zip(other._shape, other._values))
+        if isinstance(other, Mapping):
+            return dict(zip(self._shape, self._values)) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def keys(self) -> KeysView:
+        return KeysView(self)
+
+    def items(self) -> ItemsView:
+        return ItemsView(self)
+
+    def values(self) -> ValuesView:
+        return ValuesView(self)
+
+    # Остальное — готовые примеси MutableMapping поверх методов выше
+    pop = MutableMapping.pop
+    popitem = MutableMapping.popitem
+    setdefault = MutableMapping.setdefault
+    update = MutableMapping.update
+
+    def clear(self) -> None:
+        self._shape = ()
+        self._values = []
+
+    def copy(self) -> "Node":
+        return Node._make(self._shape, list(self._values))
+
+    def __reduce__(self) -> tuple:
+        # pickle и deepcopy: форма и значения, без словаря слотов
+        return _rebuild, (self._shape, self._values)
+
+    def __repr__(self) -> str:
+        return f"Node({dict(zip(self._shape, self._values))!r})"
+
+
+MutableMapping.register(Node)
+
+# Объект JSON в состоянии: dict из операций клиента или узел модели
+OBJECT_TYPES = (dict, Node)
+
+
+_SCALARS = frozenset((int, float, bool, type(None)))
+
+
+def _rebuild(keys: Shape, values: List[Any]) -> Node:
+    return Node._make(_shape(keys), values)
+
+
+def _convert(value: Any, key: Any = None) -> Any:
+    # Точные типы проверяются первыми: isinstance с ABC Mapping на каждом
+    # значении — основная цена построения дерева
+    kind = type(value)
+    if kind is str:
+        if len(value) <= MAX_INTERNED_LENGTH and key not in _UNIQUE_KEYS:
+            return sys.intern(value)
+        return value
+    if kind is dict:
+        return Node._make(_shape(tuple(value)), [_convert(item, key) for key, item in value.items()])
+    if kind is list:
+        return [_convert(item) for item in value]
+    if kind in _SCALARS:
+        return value
+    if isinstance(value, Node):
+        return Node._make(value._shape, [_convert(item, key) for key, item in zip(value._shape, value._values)])
+    if isinstance(value, Mapping):
+        return Node._make(_shape(tuple(value)), [_convert(item, key) for key, item in value.items()])
+    if isinstance(value, list):
+        return [_convert(item) for item in value]
+    return value
+
+
+def from_json(value: Any) -> Any:
+    """Перевести значение JSON (или уже модель) в новое дерево модели.
+
+    Результат не разделяет изменяемых объектов с аргументом, поэтому
+    заменяет ``copy.deepcopy`` при переносе значений из операций в состояние.
+    """
+    return _convert(value)
+
+
+def to_json(value: Any) -> Any:
+    """Глубокая копия дерева из обычных dict и list"""
+    if isinstance(value, Node):
+        return {key: to_json(item) for key, item in zip(value._shape, value._values)}
+    if isinstance(value, Mapping):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    return value
+
+
+def json_default(value: Any) -> Any:
+    """Хук default= для json/orjson/msgpack: узел сериализуется как словарь"""
+    if type(value) is Node or isinstance(value, Node):
+        return dict(zip(value._shape, value._values))
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
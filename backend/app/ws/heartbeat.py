@@ -0,0 +1,91 @@
+"""Heartbeat WebSocket-соединений: поиск и отключение «зомби».
+
+Оборванное TCP-соединение (сон ноутбука, смена сети, NAT) без heartbeat
+замечается только при попытке отправить в него, а до тех пор участник
+висит в ``users_list`` и держит комнату в памяти. Раз в
+``WS_HEARTBEAT_INTERVAL_SECONDS`` одна фоновая задача обходит соединения
+участников и зрителей:
+
+* соединению, от которого ничего не приходило дольше интервала, уходит
+  ``{"type": "ping"}``; клиент отвечает ``{"type": "pong"}`` (подтверждает
+  жизнь любой кадр);
+* соединение, которое уже отвечало на ping, но молчит дольше
+  ``WS_HEARTBEAT_TIMEOUT_SECONDS``, закрывается с кодом 4408 и удаляется из
+  комнаты (участникам — ``leave``).
+
+Активные клиенты пингов не получают: их кадры и так подтверждают, что
+соединение живо. Клиент, ни разу не ответивший на ping, за молчание не
+закрывается: открытая вкладка без правок и движений мыши ничего не шлет.
+Оборванные TCP-соединения таких клиентов находят ping-кадры протокола
+WebSocket (uvicorn ``--ws-ping-interval``/``--ws-ping-timeout``): uvicorn
+закрывает соединение, и участник уходит из комнаты обычным путем.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from app.core.config import settings
+from app.ws.connection import KIND_CONTROL, Connection
+from app.ws.metrics import HEARTBEAT_PINGS, HEARTBEAT_REAPED
+from app.ws.rooms import remove_user_from_room, rooms
+
+logger = logging.getLogger(__name__)
+
+# Код закрытия соединения, не ответившего на heartbeat (по аналогии с HTTP 408)
+HEARTBEAT_TIMEOUT_CLOSE_CODE = 4408
+
+
+def heartbeat_sweep(
+    interval: Optional[float] = None,
+    timeout: Optional[float] = None,
+    now: Optional[float] = None,
+) -> int:
+    """Один проход heartbeat; возвращает число отключенных соединений"""
+    interval = interval if interval is not None else settings.WS_HEARTBEAT_INTERVAL_SECONDS
+    timeout = timeout if timeout is not None else settings.WS_HEARTBEAT_TIMEOUT_SECONDS
+    now = now if now is not None else time.monotonic()
+    ping = {"type": "ping", "timestamp": datetime.now().isoformat()}
+    # Кодируем один раз на кодек, а не на каждое соединение
+    frames = {}
+
+    def check(connection: Connection) -> bool:
+        """True — соединение молчит дольше таймаута и закрыто"""
+        silent = now - connection.last_seen
+        if silent >= timeout and connection.answers_ping:
+            connection.abort(HEARTBEAT_TIMEOUT_CLOSE_CODE)
+            return True
+        if silent >= interval:
+            frame = frames.get(connection.codec)
+            if frame is None:
+                frame = frames[connection.codec] = connection.codec.encode(ping)
+            connection.send(frame, KIND_CONTROL)
+            HEARTBEAT_PINGS.inc()
+        return False
+
+    reaped = 0
+    for room in list(rooms.values()):
+        for user_id, user_data in list(room.users.items()):
+            if check(user_data["conn"]):
+                remove_user_from_room(room.room_id, user_id)
+                reaped += 1
+        for spectator_id, connection in list(room.spectators.connections.items()):
+            if check(connection):
+                room.spectators.remove(spectator_id)
+                reaped += 1
+    if reaped:
+        HEARTBEAT_REAPED.inc(reaped)
+        logger.info("Heartbeat reaped %d silent WebSocket connections", reaped)
+    return reaped
+
+
+async def run_heartbeat(interval: Optional[float] = None) -> None:
+    """Фоновая задача heartbeat (запускается в lifespan приложения)"""
+    interval = interval if interval is not None else settings.WS_HEARTBEAT_INTERVAL_SECONDS
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            heartbeat_sweep()
+        except Exception:
+            logger.exception("WebSocket heartbeat sweep failed")
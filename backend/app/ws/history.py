@@ -0,0 +1,94 @@
+"""История undo/redo участников комнаты на сервере.
+
+История живет у владельца комнаты и хранит не снимки документа, а
+обратные операции (``BlockTreeCRDT.invert``): память пропорциональна
+правкам, а не размеру лендинга. Ключ истории — пользователь
+(``user:<id>`` для вошедших, иначе id соединения), поэтому после
+переподключения отмена продолжает работать.
+
+* каждая примененная операция или ``batch`` участника кладет в его стек
+  undo одну запись — обратные операции в порядке применения; стек redo
+  при этом очищается;
+* ``undo`` снимает запись, применяет ее и кладет в redo обратную к ней
+  (то есть повтор исходной), ``redo`` — наоборот;
+* в каждом стеке не больше ``WS_UNDO_DEPTH`` записей, старые вытесняются;
+* историй в комнате не больше ``WS_UNDO_MAX_USERS``: при переполнении
+  вытесняется история, которой дольше всех не пользовались (LRU). История
+  анонима (ключ — id соединения) удаляется, когда соединение уходит: к ней
+  уже никто не вернется.
+
+Запись, которую нельзя отменить (``patch``), в историю не попадает.
+``sync_state`` заменяет документ целиком, и история всей комнаты
+сбрасывается.
+"""
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+from app.core.config import settings
+
+HISTORY_OPS = ("undo", "redo")
+
+Entry = List[dict]
+
+
+class UndoHistory:
+    def __init__(self, depth: Optional[int] = None, max_users: Optional[int] = None):
+        self.depth = depth or settings.WS_UNDO_DEPTH
+        self.max_users = max_users or settings.WS_UNDO_MAX_USERS
+        self._undo: Dict[str, Deque[Entry]] = {}
+        self._redo: Dict[str, Deque[Entry]] = {}
+        # Ключи историй от давно не использованных к недавним
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+
+    @property
+    def users(self) -> int:
+        """Историй в комнате"""
+        return len(self._recent)
+
+    def __len__(self) -> int:
+        """Записей во всех стеках комнаты"""
+        return sum(map(len, self._undo.values())) + sum(map(len, self._redo.values()))
+
+    def record(self, key: str, entry: Optional[Entry]) -> None:
+        """Новая правка пользователя: запись в undo, redo больше неактуален"""
+        if not entry:
+            return
+        self._stack(self._undo, key).append(entry)
+        self._redo.pop(key, None)
+
+    def pop(self, key: str, redo: bool = False) -> Optional[Entry]:
+        stack = (self._redo if redo else self._undo).get(key)
+        if not stack:
+            return None
+        self._touch(key)
+        return stack.pop()
+
+    def push(self, key: str, entry: Optional[Entry], redo: bool = False) -> None:
+        """Положить запись, не трогая противоположный стек (результат undo/redo)"""
+        if entry:
+            self._stack(self._redo if redo else self._undo, key).append(entry)
+
+    def forget(self, key: str) -> None:
+        """Удалить историю пользователя"""
+        self._undo.pop(key, None)
+        self._redo.pop(key, None)
+        self._recent.pop(key, None)
+
+    def clear(self) -> None:
+        self._undo.clear()
+        self._redo.clear()
+        self._recent.clear()
+
+    def _stack(self, stacks: Dict[str, Deque[Entry]], key: str) -> Deque[Entry]:
+        self._touch(key)
+        stack = stacks.get(key)
+        if stack is None:
+            stack = stacks[key] = deque(maxlen=self.depth)
+        return stack
+
+    def _touch(self, key: str) -> None:
+        """Отметить использование истории и вытеснить самую старую при переполнении"""
+        self._recent[key] = None
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_users:
+            self.forget(next(iter(self._recent)))
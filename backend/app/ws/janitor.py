@@ -0,0 +1,103 @@
+"""Выгрузка простаивающих комнат из памяти.
+
+Комната без локальных участников остается в ``rooms`` со всем состоянием,
+поэтому без уборки память процесса растет с числом когда-либо открытых
+комнат. Уборщик раз в ``WS_ROOM_SWEEP_INTERVAL_SECONDS``:
+
+* выгружает пустые комнаты, простаивающие дольше ``WS_ROOM_IDLE_TTL_SECONDS``;
+* если оценка суммарного размера состояний превышает
+  ``WS_ROOMS_MEMORY_BUDGET_BYTES``, выгружает пустые комнаты раньше TTL,
+  начиная с давно неактивных (LRU), пока не уложится в бюджет;
+* переводит в компактную модель документа состояния оставшихся комнат,
+  простаивающих дольше ``WS_ROOM_COMPACT_AFTER_SECONDS``.
+
+Перед выгрузкой несохраненное состояние дописывается в проект; комната,
+которую не удалось сохранить, остается в памяти до следующего прохода.
+Комнаты с участниками или зрителями не выгружаются никогда.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from app.core.config import settings
+from app.ws.bus import room_bus
+from app.ws.metrics import ROOM_STATE_BYTES, ROOMS_ACTIVE, ROOMS_EVICTED
+from app.ws.rooms import Room, rooms, unsubscribe_room
+
+logger = logging.getLogger(__name__)
+
+
+async def evict_room(room: Room, reason: str) -> bool:
+    """Сохранить и выгрузить пустую комнату; True — комната выгружена"""
+    # Под bus_lock не пересекаемся с подключением к шине нового участника
+    async with room.bus_lock:
+        if room.users or room.spectators or room.inbox:
+            return False
+        await room.saver.flush()
+        if room.users or room.spectators or (room.saver.dirty and room.saver.bound):
+            return False
+        if rooms.get(room.room_id) is not room:
+            return False
+        # Подписка остается у комнат, поднятых из журнала; владение снимаем и без
+        # подписки — иначе шина продлевала бы его, а чужие участники ждали бы ответа
+        if room.bus_attached:
+            await unsubscribe_room(room)
+        await room_bus.release_owner(room.room_id)
+        if room.users or room.spectators or rooms.get(room.room_id) is not room:
+            # Пока снимали подписку, вошел участник: он подключит комнату к шине заново
+            return False
+        del rooms[room.room_id]
+        room.close()
+    ROOMS_EVICTED.labels(reason=reason).inc()
+    logger.info("Evicted room %s (%s, ~%d bytes)", room.room_id, reason, room.state_bytes)
+    return True
+
+
+async def sweep_rooms(
+    idle_ttl: Optional[float] = None,
+    memory_budget: Optional[int] = None,
+    now: Optional[float] = None,
+    compact_after: Optional[float] = None,
+) -> int:
+    """Один проход уборщика; возвращает число выгруженных комнат"""
+    idle_ttl = idle_ttl if idle_ttl is not None else settings.WS_ROOM_IDLE_TTL_SECONDS
+    memory_budget = memory_budget if memory_budget is not None else settings.WS_ROOMS_MEMORY_BUDGET_BYTES
+    now = now if now is not None else time.monotonic()
+    compact_after = compact_after if compact_after is not None else settings.WS_ROOM_COMPACT_AFTER_SECONDS
+
+    total_bytes = sum(room.estimate_state_bytes() for room in rooms.values())
+    evicted = 0
+
+    idle = sorted(
+        (room for room in rooms.values() if not room.users and not room.spectators),
+        key=lambda room: room.last_active,
+    )
+    for room in idle:
+        expired = now - room.last_active >= idle_ttl
+        over_budget = total_bytes > memory_budget
+        if not expired and not over_budget:
+            # Дальше по списку комнаты активнее, а бюджет соблюден
+            break
+        if await evict_room(room, "ttl" if expired else "memory"):
+            total_bytes -= room.state_bytes
+            evicted += 1
+
+    for room in list(rooms.values()):
+        if not room.compacted and now - room.last_active >= compact_after:
+            room.compact()
+
+    ROOMS_ACTIVE.set(len(rooms))
+    ROOM_STATE_BYTES.set(total_bytes)
+    return evicted
+
+
+async def run_room_janitor(interval: Optional[float] = None) -> None:
+    """Фоновая задача уборщика (запускается в lifespan приложения)"""
+    interval = interval if interval is not None else settings.WS_ROOM_SWEEP_INTERVAL_SECONDS
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep_rooms()
+        except Exception:
+            logger.exception("Room janitor sweep failed")
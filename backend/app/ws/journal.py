@@ -0,0 +1,219 @@
+"""Журнал комнат на диске: комнаты переживают рестарт и деплой.
+
+У каждой комнаты владельца два файла в ``WS_JOURNAL_DIR`` (имя — хеш
+room_id):
+
+* ``<hash>.snapshot.json`` — сжатый снимок: состояние, метаданные CRDT,
+  версия, epoch и привязка к проекту;
+* ``<hash>.ops.jsonl`` — дописываемый журнал: по строке JSON на каждое
+  сообщение операции, примененной после снимка (с ``version``).
+
+Снимок пишется во временный файл и атомарно заменяет прежний, затем журнал
+обрезается. Снимок делается после ``WS_JOURNAL_SNAPSHOT_OPS`` операций, на
+``sync_state`` (он все равно заменяет состояние целиком) и при остановке
+сервера. Запросы снимка ждут ``WS_JOURNAL_SNAPSHOT_DELAY_SECONDS``:
+``sync_state`` подряд дают один снимок, а операции за это время входят в
+него и в журнал не пишутся.
+
+Файлы пишет фоновая задача журнала в пуле потоков (``asyncio.to_thread``),
+цикл событий только сериализует записи: снимок — в момент записи, чтобы он
+совпадал с состоянием комнаты. Пока идет запись, новые операции копятся и
+уходят следующей. При старте снимок поднимается, строки журнала с версиями после
+него применяются по порядку; оборванная последняя строка (сбой посреди
+записи) отбрасывается. Версии и epoch сохраняются, поэтому клиенты
+переподключаются с ``since``/``epoch`` и получают только пропущенные
+операции.
+
+Запись идет в кэш страниц ОС без fsync: журнал защищает от рестарта
+процесса, а не от потери питания узла.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import IO, Callable, Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+from app.ws.document import json_default
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIX = ".snapshot.json"
+OPS_SUFFIX = ".ops.jsonl"
+
+
+def _dump(value: dict) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=json_default)
+
+
+class RoomJournal:
+    def __init__(
+        self,
+        directory: str,
+        room_id: str,
+        get_snapshot: Optional[Callable[[], dict]] = None,
+        snapshot_ops: Optional[int] = None,
+        snapshot_delay: Optional[float] = None,
+    ):
+        self.room_id = room_id
+        self._get_snapshot = get_snapshot
+        self.snapshot_ops = snapshot_ops if snapshot_ops is not None else settings.WS_JOURNAL_SNAPSHOT_OPS
+        self.snapshot_delay = (
+            snapshot_delay if snapshot_delay is not None else settings.WS_JOURNAL_SNAPSHOT_DELAY_SECONDS
+        )
+        base = os.path.join(directory, hashlib.sha1(room_id.encode("utf-8")).hexdigest())
+        self.snapshot_path = base + SNAPSHOT_SUFFIX
+        self.ops_path = base + OPS_SUFFIX
+        # Операций в журнале после последнего снимка
+        self.pending_ops = 0
+        self._file: Optional[IO[str]] = None
+        # Строки операций, еще не записанные на диск, и запрошенный снимок
+        self._lines: List[str] = []
+        self._snapshot_due = False
+        self._writer: Optional[asyncio.Task] = None
+        # Снимок нужен сейчас, без задержки (остановка, старт)
+        self._urgent = asyncio.Event()
+        self._discarded = False
+
+    @property
+    def needs_snapshot(self) -> bool:
+        return self.pending_ops >= self.snapshot_ops
+
+    def append(self, messages: List[dict]) -> None:
+        """Поставить примененные операции в запись одной строкой на сообщение"""
+        self._lines.extend(_dump(message) + "\n" for message in messages)
+        self.pending_ops += len(messages)
+        self._wake()
+
+    def request_snapshot(self) -> None:
+        """Запросить снимок; запросы в пределах задержки сливаются в один"""
+        self._snapshot_due = True
+        self.pending_ops = 0
+        self._wake()
+
+    async def flush(self, snapshot: bool = False) -> None:
+        """Дождаться записи всего накопленного; snapshot — сразу записать снимок"""
+        if snapshot:
+            self.request_snapshot()
+        self._urgent.set()
+        while self._writer is not None and not self._writer.done():
+            await asyncio.shield(self._writer)
+        self._urgent.clear()
+
+    def close(self) -> None:
+        """Закрыть файл журнала (после flush: писатель не должен работать)"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self) -> None:
+        """Удалить файлы комнаты: выгруженная комната не поднимается после рестарта"""
+        self._discarded = True
+        self._lines.clear()
+        self._snapshot_due = False
+        if self._writer is None or self._writer.done():
+            self._remove_files()
+        # Иначе файлы удалит писатель, закончив текущую запись
+
+    def _wake(self) -> None:
+        if not self._discarded and (self._writer is None or self._writer.done()):
+            self._writer = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        while (self._lines or self._snapshot_due) and not self._discarded:
+            try:
+                if self._snapshot_due:
+                    if not self._urgent.is_set():
+                        try:
+                            await asyncio.wait_for(self._urgent.wait(), self.snapshot_delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    if self._discarded:
+                        break
+                    # Снимок включает все операции до этого момента — их строки не нужны
+                    data = _dump(self._get_snapshot())
+                    self._snapshot_due = False
+                    self._lines.clear()
+                    await asyncio.to_thread(self._replace_snapshot, data)
+                else:
+                    data = "".join(self._lines)
+                    self._lines.clear()
+                    await asyncio.to_thread(self._append_lines, data)
+            except OSError:
+                # Журнал — страховка от рестарта; после сбоя его восстановит следующий снимок
+                logger.exception("Failed to write journal of room %s", self.room_id)
+                self._lines.clear()
+                self._snapshot_due = False
+                self.pending_ops = self.snapshot_ops
+                return
+        if self._discarded:
+            await asyncio.to_thread(self._remove_files)
+
+    def _append_lines(self, data: str) -> None:
+        if self._file is None:
+            self._file = open(self.ops_path, "a", encoding="utf-8")
+        self._file.write(data)
+        self._file.flush()
+
+    def _replace_snapshot(self, data: str) -> None:
+        """Заменить снимок и обрезать журнал: все его операции уже в снимке"""
+        temporary = self.snapshot_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(temporary, self.snapshot_path)
+        if self._file is not None:
+            self._file.truncate(0)
+            self._file.seek(0)
+        elif os.path.exists(self.ops_path):
+            os.truncate(self.ops_path, 0)
+
+    def _remove_files(self) -> None:
+        self.close()
+        for path in (self.snapshot_path, self.ops_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def open_journal(room_id: str, get_snapshot: Optional[Callable[[], dict]] = None) -> Optional[RoomJournal]:
+    """Журнал комнаты или None, если журнал выключен (WS_JOURNAL_DIR пуст)"""
+    if not settings.WS_JOURNAL_DIR:
+        return None
+    os.makedirs(settings.WS_JOURNAL_DIR, exist_ok=True)
+    return RoomJournal(settings.WS_JOURNAL_DIR, room_id, get_snapshot)
+
+
+def read_ops(path: str) -> List[dict]:
+    """Операции журнала по порядку; оборванная запись в конце отбрасывается"""
+    ops = []
+    try:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Truncated record in room journal %s", path)
+                    break
+    except FileNotFoundError:
+        pass
+    return ops
+
+
+def load_journals(directory: Optional[str] = None) -> Iterator[Tuple[dict, List[dict]]]:
+    """Все сохраненные комнаты каталога: (снимок, операции после него)"""
+    directory = directory if directory is not None else settings.WS_JOURNAL_DIR
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(SNAPSHOT_SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path, encoding="utf-8") as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            logger.exception("Unreadable room snapshot %s", path)
+            continue
+        yield snapshot, read_ops(path[: -len(SNAPSHOT_SUFFIX)] + OPS_SUFFIX)
@@ -0,0 +1,156 @@
+"""Prometheus-метрики совместного редактирования.
+
+Метрики регистрируются в глобальном реестре prometheus_client и отдаются
+тем же эндпоинтом /metrics, что и HTTP-метрики инструментатора. Метки
+ограничены по кардинальности: никаких room_id/user_id.
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+
+SEND_QUEUE_MESSAGES = Gauge(
+    "ws_send_queue_messages",
+    "Сообщения, ожидающие отправки во всех очередях WebSocket-соединений",
+)
+SEND_QUEUE_DEPTH = Histogram(
+    "ws_send_queue_depth",
+    "Глубина очереди отправки соединения в момент постановки сообщения",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+SEND_QUEUE_DROPPED = Counter(
+    "ws_send_queue_dropped_total",
+    "Сообщения, выброшенные или схлопнутые из-за переполнения очереди",
+    ["kind", "reason"],
+)
+SLOW_CONSUMERS = Counter(
+    "ws_slow_consumers_total",
+    "Соединения, отключенные из-за переполненной очереди отправки",
+)
+
+AUTOSAVE_OPS = Counter(
+    "ws_autosave_ops_total",
+    "Операции, пометившие комнату для автосохранения",
+)
+AUTOSAVE_WRITES = Counter(
+    "ws_autosave_writes_total",
+    "Попытки автосохранения комнаты по результату",
+    ["result"],
+)
+AUTOSAVE_OPS_PER_WRITE = Histogram(
+    "ws_autosave_ops_per_write",
+    "Сколько операций схлопнуто в одну запись проекта (коэффициент объединения)",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 200, 500, 1000),
+)
+AUTOSAVE_LATENCY = Histogram(
+    "ws_autosave_latency_seconds",
+    "Время записи состояния комнаты в БД",
+)
+
+ROOMS_ACTIVE = Gauge(
+    "ws_rooms",
+    "Комнаты в памяти процесса",
+)
+ROOM_STATE_BYTES = Gauge(
+    "ws_room_state_bytes",
+    "Оценка суммарного размера состояний комнат (байты JSON)",
+)
+ROOMS_EVICTED = Counter(
+    "ws_rooms_evicted_total",
+    "Комнаты, выгруженные из памяти",
+    ["reason"],
+)
+
+ENCODED_FRAME_BYTES = Histogram(
+    "ws_encoded_frame_bytes",
+    "Размер закодированного исходящего кадра по кодеку (рассылка кодируется один раз)",
+    ["encoding"],
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+
+ROOM_OP_LATENCY = Histogram(
+    "ws_room_op_latency_seconds",
+    "Задержка операции в акторе комнаты: от постановки в очередь до рассылки",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+ROOM_ACTOR_BATCH_OPS = Histogram(
+    "ws_room_actor_batch_ops",
+    "Операций, примененных актором комнаты за один пакет",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+MESSAGES_RECEIVED = Counter(
+    "ws_messages_received_total",
+    "Входящие сообщения WebSocket по типу (неизвестные типы — other)",
+    ["type"],
+)
+RECEIVED_BYTES = Counter(
+    "ws_received_bytes_total",
+    "Размер входящих кадров WebSocket (текстовых — в символах)",
+)
+OP_APPLY_LATENCY = Histogram(
+    "ws_op_apply_seconds",
+    "Время применения операции к состоянию комнаты у владельца",
+    ["type"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25),
+)
+FANOUT_RECIPIENTS = Histogram(
+    "ws_fanout_recipients",
+    "Сколько локальных соединений получило одну рассылку по комнате",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+SENT_BYTES = Counter(
+    "ws_sent_bytes_total",
+    "Отправленные байты WebSocket по кодеку (текстовые кадры — в символах)",
+    ["encoding"],
+)
+SENT_FRAMES = Counter(
+    "ws_sent_frames_total",
+    "Отправленные кадры WebSocket по кодеку",
+    ["encoding"],
+)
+CONNECTIONS = Gauge(
+    "ws_connections",
+    "Открытые WebSocket-соединения участников комнат",
+)
+ROOM_USERS = Histogram(
+    "ws_room_users",
+    "Локальные участники комнаты в момент подключения нового (распределение размеров комнат)",
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+)
+SPECTATORS = Gauge(
+    "ws_spectators",
+    "Открытые WebSocket-соединения зрителей комнат (считаются отдельно от участников)",
+)
+SPECTATOR_FRAMES = Counter(
+    "ws_spectator_frames_total",
+    "Кадры, поставленные зрителям: изменения комнаты, схлопнутые за тик",
+)
+REJECTED_FRAMES = Counter(
+    "ws_rejected_frames_total",
+    "Входящие кадры, отклоненные до применения к комнате (oversized, malformed, forbidden)",
+    ["reason"],
+)
+THROTTLED_MESSAGES = Counter(
+    "ws_throttled_messages_total",
+    "Входящие сообщения, отклоненные лимитом частоты, по классу и уровню (connection, room)",
+    ["class", "scope"],
+)
+THROTTLED_CONNECTIONS = Counter(
+    "ws_throttled_connections_total",
+    "Соединения, хотя бы раз упершиеся в лимит частоты",
+)
+THROTTLE_DISCONNECTS = Counter(
+    "ws_throttle_disconnects_total",
+    "Соединения, закрытые за слишком много отклоненных подряд сообщений",
+)
+HEARTBEAT_PINGS = Counter(
+    "ws_heartbeat_pings_total",
+    "Ping, отправленные молчащим соединениям",
+)
+HEARTBEAT_REAPED = Counter(
+    "ws_heartbeat_reaped_total",
+    "Соединения, отключенные из-за отсутствия ответа на heartbeat",
+)
+DRAINED_CONNECTIONS = Counter(
+    "ws_drained_connections_total",
+    "Соединения, закрытые при остановке сервера с подсказкой reconnect",
+)
@@ -0,0 +1,54 @@
+"""Журнал примененных операций комнаты для догоняния при переподключении.
+
+Каждая примененная операция получает номер — версию комнаты после нее
+(``version``), номера идут подряд. Комната хранит последние
+``WS_OPLOG_SIZE`` операций в кольцевом буфере; клиент, переподключившийся с
+``since=<version>``, получает только пропущенные операции. Если разрыв уже
+вытеснен из буфера (или клиент знает другую «линию» комнаты — ``epoch``),
+отправляется полный снимок.
+
+``sync_state`` заменяет состояние целиком, поэтому не пишется в журнал, а
+сбрасывает его: догнать через полную замену можно только снимком.
+"""
+from collections import deque
+from itertools import islice
+from typing import Deque, List, Optional
+
+from app.core.config import settings
+
+
+class OpLog:
+    def __init__(self, capacity: Optional[int] = None):
+        self.capacity = capacity if capacity is not None else settings.WS_OPLOG_SIZE
+        self._ops: Deque[dict] = deque(maxlen=self.capacity)
+        # Версия состояния, от которой начинается журнал
+        self.base_version = 0
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    @property
+    def head_version(self) -> int:
+        """Версия после последней операции журнала"""
+        return self.base_version + len(self._ops)
+
+    def append(self, message: dict) -> None:
+        """Добавить операцию с версией head_version + 1; иначе журнал начинается заново"""
+        version = message["version"]
+        if version != self.head_version + 1:
+            self.reset(version - 1)
+        if len(self._ops) == self.capacity:
+            # Самая старая операция вытесняется из буфера
+            self.base_version += 1
+        self._ops.append(message)
+
+    def reset(self, version: int) -> None:
+        """Очистить журнал: следующая операция будет иметь версию version + 1"""
+        self._ops.clear()
+        self.base_version = version
+
+    def since(self, version: int) -> Optional[List[dict]]:
+        """Операции после version или None, если догнать по журналу нельзя"""
+        if version < self.base_version or version > self.head_version:
+            return None
+        return list(islice(self._ops, version - self.base_version, None))
@@ -0,0 +1,18 @@
+"""Типы операций редактирования документа комнаты.
+
+Применяет их CRDT-движок комнаты (``app.ws.crdt.BlockTreeCRDT``).
+"""
+
+# Операции над документом, которые сервер применяет к room.state
+DOCUMENT_OPS = (
+    "update_block",
+    "add_block",
+    "delete_block",
+    "move_block",
+    "update_theme",
+    "update_header",
+    "update_footer",
+    "patch",
+    "batch",
+)
+
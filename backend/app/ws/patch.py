@@ -0,0 +1,222 @@
+"""JSON Patch (RFC 6902) для состояния комнаты.
+
+Сообщение ``{"type": "patch", "payload": [...]}`` несет стандартный
+документ JSON Patch: операции ``add``, ``remove``, ``replace``, ``move``,
+``copy`` и ``test``. Пути — JSON Pointer (RFC 6901) от корня состояния
+с одним расширением: первый сегмент ``@<blockId>`` указывает на блок по
+id, где бы он ни лежал в дереве::
+
+    {"op": "replace", "path": "/@text-1/style/color", "value": "#333"}
+    {"op": "add", "path": "/@grid-1/cells/0/block", "value": {...}}
+    {"op": "remove", "path": "/@image-3"}
+    {"op": "add", "path": "/header/links/-", "value": {...}}
+
+Патч применяется к состоянию на месте и атомарно: каждая операция
+записывает обратное действие, и при первой ошибке уже сделанные изменения
+откатываются. Копируется только вставляемое значение, а не документ.
+"""
+from typing import Any, Callable, List, Optional, Tuple
+
+from app.ws.block_index import BlockIndex
+from app.ws.document import OBJECT_TYPES, from_json
+
+# Ключи, изменение которых меняет структуру дерева блоков
+STRUCTURAL_KEYS = ("blocks", "children", "cells", "block", "id")
+# Списки, элементы которых — блоки или ячейки с блоками
+STRUCTURAL_LISTS = ("blocks", "children", "cells")
+
+_MISSING = object()
+
+
+class PatchError(ValueError):
+    pass
+
+
+def parse_pointer(pointer: Any) -> List[str]:
+    """Разобрать JSON Pointer в список сегментов"""
+    if not isinstance(pointer, str):
+        raise PatchError("path must be a string")
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise PatchError(f"invalid pointer {pointer!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def is_structural(tokens: List[str]) -> bool:
+    """Затрагивает ли правка по этому пути структуру дерева (нужна переиндексация)"""
+    if not tokens or (len(tokens) == 1 and tokens[0].startswith("@")):
+        return True
+    if tokens[-1] in STRUCTURAL_KEYS:
+        return True
+    return len(tokens) >= 2 and tokens[-2] in STRUCTURAL_LISTS
+
+
+def _list_index(container: list, token: str, allow_end: bool) -> int:
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        raise PatchError(f"invalid list index {token!r}")
+    position = int(token)
+    if position > len(container) or (position == len(container) and not allow_end):
+        raise PatchError(f"list index {position} out of range")
+    return position
+
+
+class _Patcher:
+    def __init__(self, state: dict, index: BlockIndex):
+        self.state = state
+        self.index = index
+        self.undo: List[Callable[[], None]] = []
+        self.structural = False
+        # Индекс устарел после структурной операции внутри этого патча
+        self.stale_index = False
+        self.reindexed = False
+
+    def resolve(self, tokens: List[str]) -> Tuple[Any, Any]:
+        """Найти (родитель, ключ) цели по сегментам пути"""
+        if not tokens:
+            raise PatchError("operations on the whole state are not allowed, use sync_state")
+        if tokens[0].startswith("@"):
+            if self.stale_index:
+                self.index.rebuild(self.state)
+                self.stale_index = False
+                self.reindexed = True
+            ref = self.index.get(tokens[0][1:])
+            if ref is None:
+                raise PatchError(f"unknown block {tokens[0][1:]!r}")
+            if len(tokens) == 1:
+                if ref.slot is None:
+                    return ref.container, "block"
+                return ref.container, self.index.slot_of(ref.block.get("id"))
+            node, rest = ref.block, tokens[1:]
+        else:
+            node, rest = self.state, tokens
+        for token in rest[:-1]:
+            node = self.child(node, token)
+        return node, rest[-1]
+
+    def child(self, node: Any, token: str) -> Any:
+        if isinstance(node, OBJECT_TYPES):
+            if token not in node:
+                raise PatchError(f"missing key {token!r}")
+            return node[token]
+        if isinstance(node, list):
+            return node[_list_index(node, token, allow_end=False)]
+        raise PatchError(f"cannot descend into {type(node).__name__}")
+
+    def get(self, parent: Any, key: Any) -> Any:
+        if isinstance(key, int):
+            return parent[key]
+        return self.child(parent, key)
+
+    def add(self, parent: Any, key: Any, value: Any) -> None:
+        if isinstance(parent, OBJECT_TYPES):
+            previous = parent.get(key, _MISSING)
+            parent[key] = value
+            self.undo.append(lambda: self._restore(parent, key, previous))
+        elif isinstance(parent, list):
+            position = key if isinstance(key, int) else _list_index(parent, key, allow_end=True)
+            parent.insert(position, value)
+            self.undo.append(lambda: parent.pop(position))
+        else:
+            raise PatchError(f"cannot add into {type(parent).__name__}")
+
+    def remove(self, parent: Any, key: Any) -> Any:
+        if isinstance(parent, OBJECT_TYPES):
+            if key not in parent:
+                raise PatchError(f"missing key {key!r}")
+            value = parent.pop(key)
+            self.undo.append(lambda: parent.__setitem__(key, value))
+            return value
+        if isinstance(parent, list):
+            position = key if isinstance(key, int) else _list_index(parent, key, allow_end=False)
+            value = parent.pop(position)
+            self.undo.append(lambda: parent.insert(position, value))
+            return value
+        raise PatchError(f"cannot remove from {type(parent).__name__}")
+
+    def replace(self, parent: Any, key: Any, value: Any) -> None:
+        if isinstance(parent, list):
+            position = key if isinstance(key, int) else _list_index(parent, key, allow_end=False)
+            previous = parent[position]
+            parent[position] = value
+            self.undo.append(lambda: parent.__setitem__(position, previous))
+        else:
+            self.get(parent, key)
+            self.add(parent, key, value)
+
+    @staticmethod
+    def _restore(parent: dict, key: str, previous: Any) -> None:
+        if previous is _MISSING:
+            parent.pop(key, None)
+        else:
+            parent[key] = previous
+
+    def apply(self, operation: Any) -> None:
+        if not isinstance(operation, dict):
+            raise PatchError("operation must be an object")
+        op = operation.get("op")
+        tokens = parse_pointer(operation.get("path"))
+        structural = op != "test" and is_structural(tokens)
+
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise PatchError(f"{op} requires a value")
+        if op == "add":
+            self.add(*self.resolve(tokens), from_json(operation["value"]))
+        elif op == "remove":
+            self.remove(*self.resolve(tokens))
+        elif op == "replace":
+            self.replace(*self.resolve(tokens), from_json(operation["value"]))
+        elif op in ("move", "copy"):
+            source = parse_pointer(operation.get("from"))
+            if op == "move":
+                if tokens[:len(source)] == source and tokens != source:
+                    raise PatchError("cannot move a value into itself")
+                value = self.remove(*self.resolve(source))
+                if is_structural(source):
+                    # Путь назначения ищем уже без перенесенного поддерева
+                    structural = True
+                    self.stale_index = True
+            else:
+                value = from_json(self.get(*self.resolve(source)))
+            self.add(*self.resolve(tokens), value)
+        elif op == "test":
+            if self.get(*self.resolve(tokens)) != operation["value"]:
+                raise PatchError(f"test failed at {operation.get('path')!r}")
+        else:
+            raise PatchError(f"unknown op {op!r}")
+        if structural:
+            self.structural = True
+            self.stale_index = True
+
+    def rollback(self) -> None:
+        for undo in reversed(self.undo):
+            undo()
+        self.undo = []
+
+
+def apply_patch(
+    state: dict, index: BlockIndex, patch: Any, undo: Optional[List[Callable[[], None]]] = None
+) -> Optional[bool]:
+    """Применить JSON Patch атомарно.
+
+    Возвращает None, если патч некорректен или не применился (состояние при
+    этом не изменено), иначе — затронул ли он структуру дерева блоков:
+    тогда индекс блоков нужно перестроить. В undo, если он передан,
+    добавляются обратные действия примененного патча (откат пакета).
+    """
+    if not isinstance(patch, list):
+        return None
+    patcher = _Patcher(state, index)
+    try:
+        for operation in patch:
+            patcher.apply(operation)
+    except (PatchError, IndexError, KeyError, TypeError):
+        patcher.rollback()
+        if patcher.reindexed:
+            index.rebuild(state)
+        return None
+    if undo is not None:
+        undo.extend(patcher.undo)
+    return patcher.structural
@@ -0,0 +1,60 @@
+"""Канал присутствия комнаты: курсоры и выделения участников.
+
+Присутствие отделено от документных операций и намеренно теряемое: сервер
+хранит только последнюю позицию курсора и выделение каждого участника и
+раз в тик (``settings.WS_PRESENCE_TICK_HZ``) рассылает один пакетный кадр
+``presence`` с изменившимися записями. Пока в комнате никто не двигает
+курсор, тикер не работает.
+"""
+import asyncio
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from app.core.config import settings
+
+
+PRESENCE_MESSAGES = ("cursor_update", "selection_update")
+
+
+class Presence:
+    def __init__(self, broadcast: Callable[[dict], None], tick_hz: Optional[float] = None):
+        self._broadcast = broadcast
+        self.interval = 1.0 / (tick_hz or settings.WS_PRESENCE_TICK_HZ)
+        # user_id → последнее известное состояние курсора/выделения
+        self.entries: Dict[str, dict] = {}
+        self._dirty: Dict[str, None] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, user_id: str, payload: dict) -> None:
+        """Запомнить последнее состояние участника; старое просто перезаписывается"""
+        entry = self.entries.setdefault(user_id, {})
+        entry.update(payload)
+        self._dirty[user_id] = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._tick())
+
+    def remove(self, user_id: str) -> None:
+        self.entries.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+
+    def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    def flush(self) -> None:
+        """Разослать один кадр со всеми изменениями с прошлого тика"""
+        if not self._dirty:
+            return
+        cursors = [self.entries[user_id] for user_id in self._dirty if user_id in self.entries]
+        self._dirty = {}
+        if cursors:
+            self._broadcast({
+                "type": "presence",
+                "payload": {"cursors": cursors},
+                "timestamp": datetime.now().isoformat(),
+            })
+
+    async def _tick(self) -> None:
+        await asyncio.sleep(self.interval)
+        self.flush()
@@ -0,0 +1,199 @@
+"""Ограничение частоты входящих сообщений WebSocket (token bucket).
+
+Каждое входящее сообщение относится к классу, и у каждого класса свое
+ведро токенов: ``rate`` токенов в секунду, не больше ``burst`` в запасе.
+
+* ``presence`` — ``cursor_update``, ``selection_update``;
+* ``ops`` — операции над документом и ``undo``/``redo`` (``batch`` стоит
+  столько токенов, сколько в нем операций);
+* ``sync`` — ``sync_state`` и ``request_sync``: полная замена состояния
+  или снимок в ответ;
+* ``save`` — ``save_project``.
+
+Ведра есть у каждого соединения (``WS_RATE_<CLASS>_PER_SECOND`` и
+``WS_RATE_<CLASS>_BURST``) и у комнаты на этом воркере — те же лимиты,
+умноженные на ``WS_ROOM_RATE_FACTOR`` или, если редакторов много, на
+``WS_ROOM_RATE_PER_EDITOR`` × число редакторов (``room_rate_factor``).
+Первое не дает одной вкладке забить комнату, второе ограничивает комнату
+целиком: обычный темп всех ее вкладок проходит, а их общий поток — нет.
+
+Отклоненное сообщение не применяется. Присутствие теряется молча (важна
+только последняя позиция курсора). Отклоненный ``sync_state`` не
+теряется: соединение запоминает последний (``deferred``) и применяет его,
+когда ведра наполнятся. Об остальных классах клиент один раз за эпизод
+получает ``throttled`` с ``retryAfter`` и после паузы должен повторить
+сообщение или догнать комнату через ``request_sync``. После
+``WS_THROTTLE_DISCONNECT_AFTER`` отказов подряд соединение закрывается.
+"""
+import time
+from datetime import datetime
+from typing import Dict, Optional, Set, Tuple
+
+from app.core.config import settings
+from app.ws.metrics import THROTTLED_CONNECTIONS, THROTTLED_MESSAGES
+from app.ws.ops import DOCUMENT_OPS
+from app.ws.history import HISTORY_OPS
+from app.ws.presence import PRESENCE_MESSAGES
+
+CLASS_PRESENCE = "presence"
+CLASS_OPS = "ops"
+CLASS_SYNC = "sync"
+CLASS_SAVE = "save"
+
+
+def message_class(message_type: Optional[str]) -> Optional[str]:
+    """Класс лимита для типа сообщения; None — сообщение не ограничивается"""
+    if message_type in PRESENCE_MESSAGES:
+        return CLASS_PRESENCE
+    if message_type in DOCUMENT_OPS or message_type in HISTORY_OPS:
+        return CLASS_OPS
+    if message_type in ("sync_state", "request_sync"):
+        return CLASS_SYNC
+    if message_type == "save_project":
+        return CLASS_SAVE
+    return None
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: Optional[float] = None) -> None:
+        """Начислить токены за время с прошлого обращения"""
+        now = now if now is not None else time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        """Списать cost токенов; False — ведро пусто, сообщение отклоняется"""
+        self.refill(now)
+        # Сообщение дороже всего запаса проходит при полном ведре, иначе не прошло бы никогда
+        cost = min(cost, self.burst)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost: float = 1.0) -> float:
+        """Через сколько секунд накопится cost токенов (от последнего обращения)"""
+        missing = min(cost, self.burst) - self.tokens
+        return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
+
+    def resize(self, rate: float, burst: float) -> None:
+        """Сменить лимиты: прирост запаса доступен сразу, уменьшение срезает лишнее"""
+        self.refill()
+        self.tokens = min(burst, self.tokens + max(0.0, burst - self.burst))
+        self.rate = rate
+        self.burst = burst
+
+
+def room_rate_factor(editors: int) -> float:
+    """Множитель лимитов комнаты для числа ее редакторов на воркере"""
+    return max(settings.WS_ROOM_RATE_FACTOR, editors * settings.WS_ROOM_RATE_PER_EDITOR)
+
+
+class RateLimiter:
+    """Ведра по классам сообщений для одного соединения или комнаты"""
+
+    def __init__(self, factor: float = 1.0):
+        self.factor = factor
+        self.buckets: Dict[str, TokenBucket] = {
+            limit_class: TokenBucket(rate * factor, burst * factor)
+            for limit_class, (rate, burst) in self._limits().items()
+        }
+
+    @staticmethod
+    def _limits() -> Dict[str, Tuple[float, float]]:
+        """Лимиты соединения по классам: (токенов в секунду, запас)"""
+        return {
+            CLASS_PRESENCE: (settings.WS_RATE_PRESENCE_PER_SECOND, settings.WS_RATE_PRESENCE_BURST),
+            CLASS_OPS: (settings.WS_RATE_OPS_PER_SECOND, settings.WS_RATE_OPS_BURST),
+            CLASS_SYNC: (settings.WS_RATE_SYNC_PER_SECOND, settings.WS_RATE_SYNC_BURST),
+            CLASS_SAVE: (settings.WS_RATE_SAVE_PER_SECOND, settings.WS_RATE_SAVE_BURST),
+        }
+
+    def scale(self, factor: float) -> None:
+        """Пересчитать лимиты под новый множитель (изменилось число редакторов комнаты)"""
+        if factor == self.factor:
+            return
+        self.factor = factor
+        for limit_class, (rate, burst) in self._limits().items():
+            self.buckets[limit_class].resize(rate * factor, burst * factor)
+
+    def take(self, message_class: str, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        return self.buckets[message_class].take(cost, now)
+
+    def retry_after(self, message_class: str, cost: float = 1.0) -> float:
+        return self.buckets[message_class].retry_after(cost)
+
+
+class InboundLimits:
+    """Лимиты входящих сообщений одного соединения в комнате"""
+
+    def __init__(self, room_limiter: RateLimiter):
+        self.connection = RateLimiter()
+        self.room = room_limiter
+        # Отказов подряд, без единого пропущенного сообщения
+        self.rejected_in_row = 0
+        # Классы, о лимите которых клиент уже предупрежден в текущем эпизоде
+        self._notified: Set[str] = set()
+        self._throttled = False
+        self._retry_after = 0.0
+        # Последний отклоненный sync_state, который применится после паузы
+        self.deferred: Optional[dict] = None
+
+    @property
+    def exhausted(self) -> bool:
+        """Клиент не реагирует на лимиты — соединение пора закрыть"""
+        return self.rejected_in_row >= settings.WS_THROTTLE_DISCONNECT_AFTER
+
+    def admit(self, message_type: Optional[str], payload) -> bool:
+        """Списать токены соединения и комнаты; False — сообщение отклонено"""
+        limit_class = message_class(message_type)
+        if limit_class is None:
+            return True
+        cost = len(payload) if message_type == "batch" and isinstance(payload, list) else 1
+        for scope, limiter in (("connection", self.connection), ("room", self.room)):
+            if not limiter.take(limit_class, cost):
+                THROTTLED_MESSAGES.labels(**{"class": limit_class, "scope": scope}).inc()
+                if not self._throttled:
+                    self._throttled = True
+                    THROTTLED_CONNECTIONS.inc()
+                self.rejected_in_row += 1
+                self._retry_after = limiter.retry_after(limit_class, cost)
+                return False
+        self.rejected_in_row = 0
+        self._notified.discard(limit_class)
+        return True
+
+    def retry_after(self, message_type: Optional[str]) -> float:
+        """Через сколько секунд сообщение пройдет лимиты соединения и комнаты"""
+        limit_class = message_class(message_type)
+        if limit_class is None:
+            return 0.0
+        for limiter in (self.connection, self.room):
+            limiter.buckets[limit_class].refill()
+        return max(limiter.retry_after(limit_class) for limiter in (self.connection, self.room))
+
+    def notice(self, message_type: Optional[str]) -> Optional[dict]:
+        """Сообщение throttled для клиента, если о классе он еще не предупрежден"""
+        limit_class = message_class(message_type)
+        if limit_class in (None, CLASS_PRESENCE) or limit_class in self._notified:
+            return None
+        self._notified.add(limit_class)
+        return {
+            "type": "throttled",
+            "payload": {
+                "class": limit_class,
+                "messageType": message_type,
+                "retryAfter": round(self._retry_after, 3),
+                # Сервер сам применит последний sync_state, повторять его не нужно
+                "deferred": message_type == "sync_state",
+            },
+            "timestamp": datetime.now().isoformat(),
+        }
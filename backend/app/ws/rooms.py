@@ -1,36 +1,407 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
-from typing import Dict, Optional
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query, status
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple, Union
+import asyncio
 import json
+import random
 import uuid
-import asyncio
+import logging
+import time
 from datetime import datetime
-from sqlalchemy import select
+from sqlalchemy import Row, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.auth.security import decode_token
+from app.auth.dependencies import get_current_user
+from app.auth.identity_cache import identity_cache
+from app.auth.security import create_view_token, decode_token
+from app.core.config import settings
 from app.core.database import async_session_maker
 from app.models.project import Project
 from app.models.user import User
+from app.ws.autosave import RoomSaver
+from app.ws.block_index import BlockIndex
+from app.ws.bus import room_bus
+from app.ws.codec import Codec, Frame, FrameTooLarge, get_codec
+from app.ws.connection import Connection, message_kind
+from app.ws.crdt import BlockTreeCRDT
+from app.ws.document import from_json, json_default, to_json
+from app.ws.history import HISTORY_OPS, UndoHistory
+from app.ws.journal import RoomJournal, load_journals, open_journal
+from app.ws.metrics import (
+    CONNECTIONS,
+    DRAINED_CONNECTIONS,
+    FANOUT_RECIPIENTS,
+    MESSAGES_RECEIVED,
+    OP_APPLY_LATENCY,
+    RECEIVED_BYTES,
+    REJECTED_FRAMES,
+    ROOM_ACTOR_BATCH_OPS,
+    ROOM_OP_LATENCY,
+    ROOM_USERS,
+    ROOMS_ACTIVE,
+    THROTTLE_DISCONNECTS,
+)
+from app.ws.oplog import OpLog
+from app.ws.ops import DOCUMENT_OPS
+from app.ws.presence import PRESENCE_MESSAGES, Presence
+from app.ws.ratelimit import InboundLimits, RateLimiter, room_rate_factor
+from app.ws.spectators import SpectatorFeed
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+# Сколько раз начинать потоковую синхронизацию заново, прежде чем отправить снимок целиком
+_MAX_SYNC_RESTARTS = 3
+
+# Коды закрытия: кадр больше WS_MAX_FRAME_BYTES; клиент игнорирует лимиты частоты
+FRAME_TOO_BIG_CLOSE_CODE = 1009
+POLICY_VIOLATION_CLOSE_CODE = 1008
+# Код закрытия при остановке сервера: "Service Restart", клиент переподключается
+SERVICE_RESTART_CLOSE_CODE = 1012
+
+# Внутренняя операция актора: состояние привязанного проекта, загруженное из БД.
+# От клиентов не принимается; применяется, только если комната еще пуста
+LOAD_PROJECT = "load_project"
+
+# Типы входящих сообщений, которые считаются в метриках по отдельности
+_COUNTED_MESSAGES = frozenset(
+    ("sync_state", "request_sync", "save_project") + DOCUMENT_OPS + HISTORY_OPS + PRESENCE_MESSAGES
+)
+# Сообщения, которые читают или меняют состояние комнаты: у комнаты проекта — только от владельца
+_WRITE_MESSAGES = frozenset(("sync_state", "request_sync", "save_project") + DOCUMENT_OPS + HISTORY_OPS)
+
+
+class SubmittedOp(NamedTuple):
+    """Операция во входящей очереди актора комнаты"""
+    op_type: str
+    payload: dict
+    author_id: str
+    via: str
+    enqueued_at: float
+    # Разрешается сообщением операции (None — не применилась) после обработки
+    done: Optional[asyncio.Future] = None
+    # Ключ истории undo/redo автора (пользователь, а не соединение)
+    history: Optional[str] = None
+    # Аккаунт автора (None — аноним): автосохранение помечают только правки
+    # того, в чей проект сохраняется комната
+    account: Optional[int] = None
+
 
 class Room:
     def __init__(self, room_id: str):
         self.room_id = room_id
         self.users: Dict[str, dict] = {}
         self.state: dict = {}
+        # Индекс блоков по id: update/delete без обхода дерева
+        self.index = BlockIndex()
+        # Операции применяются через CRDT: одновременные правки сходятся
+        self.engine = BlockTreeCRDT(self.state, self.index)
+        # Монотонно растущая версия состояния: +1 на каждую примененную операцию
+        self.version = 0
+        # Последние примененные операции для догоняния при переподключении;
+        # epoch отличает «линию» версий: после выгрузки комнаты версии начнутся заново
+        self.oplog = OpLog()
+        self.epoch = uuid.uuid4().hex[:12]
+        # Курсоры и выделения рассылаются пакетами по тику, отдельно от операций
+        self.presence = Presence(lambda message: fan_out(room_id, message))
+        # Участники этой комнаты, подключенные к другим воркерам
+        self.remote_users: Dict[str, dict] = {}
+        # Подписка на шину комнат: есть, пока в комнате есть локальные участники
+        self.bus_attached = False
+        self.bus_lock = asyncio.Lock()
+        self.awaiting_snapshot = False
+        # Отложенное сохранение состояния в привязанный проект (только у владельца)
+        self.saver = RoomSaver(lambda: self.state, on_saved=self._announce_saved)
+        # Для выгрузки простаивающих комнат: время последней активности и
+        # оценка размера состояния (пересчитывается уборщиком по версии)
+        self.last_active = time.monotonic()
+        self.state_bytes = 0
+        self.sized_version = -1
+        # Закодированные снимки по кодекам для (epoch, версия) из snapshot_key:
+        # кодирование узлов модели — самая дорогая часть рассылки состояния
+        self.snapshot_frames: Dict[Codec, Frame] = {}
+        self.snapshot_key: Optional[Tuple[str, int]] = None
+        # Состояние переведено в компактную модель документа (compact)
+        self.compacted = True
+        # Актор комнаты у владельца: операции из очереди применяет одна задача,
+        # она же присваивает версии и рассылает результат (run_room_actor)
+        self.inbox: Deque[SubmittedOp] = deque()
+        self.actor: Optional[asyncio.Task] = None
+        # Задержка от постановки в очередь до рассылки у последнего пакета (для /info)
+        self.op_latency = 0.0
+        # Проект, к которому привязана комната (?projectId=), и его владелец;
+        # загрузка идет один раз на всех одновременно подключившихся
+        self.project_id: Optional[int] = None
+        self.project_owner_id: Optional[int] = None
+        self.project_loading: Optional[asyncio.Future] = None
+        # Журнал на диске (у владельца, если WS_JOURNAL_DIR задан)
+        self.journal: Optional[RoomJournal] = None
+        # Зрители: только просмотр, изменения схлопываются до WS_SPECTATOR_RATE_HZ
+        self.spectators = SpectatorFeed(self)
+        # Лимиты входящих сообщений комнаты на этом воркере (вместе со всех соединений)
+        self.limiter = RateLimiter(room_rate_factor(0))
+        # Undo/redo участников: обратные операции (у владельца)
+        self.history = UndoHistory()
+        # Авторы операций, которые клиенты без дельта-протокола еще не получили
+        # полным состоянием (None — отправлять нечего; flush_full_state)
+        self.full_state_authors: Optional[set] = None
+        # Версия последней сборки метаданных CRDT (collect_garbage)
+        self.collected_version = 0
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+    def _announce_saved(self, project_id: int) -> None:
+        fan_out(self.room_id, {
+            "type": "project_saved",
+            "payload": {"projectId": project_id},
+            "timestamp": datetime.now().isoformat(),
+        })
+
+    @property
+    def is_owner(self) -> bool:
+        """Этот воркер — авторитетный владелец состояния комнаты"""
+        return room_bus.is_owner(self.room_id)
+
+    def replace_state(self, state: dict) -> int:
+        """Полностью заменить состояние комнаты (sync_state).
+
+        Состояние остается деревом dict, как пришло: пока комнату правят
+        целыми состояниями, сборка и кодирование узлов модели стоили бы
+        больше, чем они экономят. В компактную модель его переводит
+        compact(), когда комната затихнет.
+        """
+        self.state = state
+        self.compacted = False
+        self.index.rebuild(self.state)
+        self.engine.reset(self.state)
+        self.snapshot_key = None
+        self.version += 1
+        self.oplog.reset(self.version)
+        # Обратные операции ссылались на прежний документ
+        self.history.clear()
+        self.touch()
+        return self.version
+
+    def collect_garbage(self) -> None:
+        """Раз в WS_OPLOG_SIZE версий забыть метаданные CRDT старше окна журнала.
+
+        Операции старше окна клиентам уже не досылаются (вместо них —
+        снимок), поэтому их штампы, надгробия и удаленные поддеревья больше
+        не нужны: без сборки они попадали бы в каждый снимок журнала и
+        снимок для других воркеров.
+        """
+        window = settings.WS_OPLOG_SIZE
+        if self.version - self.collected_version >= window:
+            self.engine.collect(self.version - window)
+            self.collected_version = self.version
+
+    def apply_op(self, op_type: str, payload: dict, author_id: str, history: Optional[str] = None) -> Optional[dict]:
+        """Применить операцию клиента (у владельца); вернуть ее разрешенную форму или None"""
+        if op_type == "batch":
+            return self.apply_batch(payload, author_id, history)
+        prepared = self.engine.prepare(op_type, payload)
+        if prepared is None:
+            return None
+        stamp = (self.version + 1, author_id)
+        inverse = self.engine.invert(op_type, prepared, stamp)
+        if not self.engine.apply(op_type, prepared, stamp):
+            return None
+        self.version += 1
+        self.touch()
+        self.collect_garbage()
+        if history is not None:
+            self.history.record(history, inverse)
+        return prepared
+
+    def apply_batch(self, ops: list, author_id: str, history: Optional[str] = None) -> Optional[list]:
+        """Применить пакет операций атомарно под одной версией.
+
+        Возвращает разрешенные операции пакета или None: тогда хотя бы одна
+        операция неприменима, и уже примененные операции пакета откатаны.
+        Операции пакета получают штампы (версия, автор, номер), поэтому
+        более поздняя правка того же поля внутри пакета побеждает.
+        """
+        if not isinstance(ops, list) or not 0 < len(ops) <= settings.WS_BATCH_MAX_OPS:
+            return None
+        applied = self._apply_ops(ops, author_id, resolve=True)
+        if applied is None:
+            return None
+        prepared, inverse = applied
+        if history is not None:
+            self.history.record(history, inverse)
+        return prepared
+
+    def apply_history(self, author_id: str, history: str, redo: bool = False) -> Optional[list]:
+        """undo/redo: применить запись истории одним пакетом под одной версией.
+
+        Возвращает операции пакета; пустой список — отменять нечего (история
+        пуста или все затронутое с тех пор перезаписали другие).
+        """
+        entry = self.history.pop(history, redo)
+        if entry is None:
+            return []
+        ops = [op for op in map(self.engine.current, entry) if op is not None]
+        if not ops:
+            return []
+        applied = self._apply_ops(ops, author_id, resolve=False)
+        if applied is None:
+            return None
+        prepared, inverse = applied
+        # Отмена undo — это redo, и наоборот
+        self.history.push(history, inverse, redo=not redo)
+        return prepared
+
+    def _apply_ops(self, ops: list, author_id: str, resolve: bool) -> Optional[Tuple[list, Optional[list]]]:
+        """Применить операции под одной версией; (разрешенные операции, обратные к ним) или None"""
+        version = self.version + 1
+        # Движок записывает обратные действия: откат стоит столько же, сколько примененные операции
+        self.engine.begin()
+        prepared = []
+        inverse: Optional[list] = []
+        for number, op in enumerate(ops):
+            op_type = op.get("type") if isinstance(op, dict) else None
+            resolved = None
+            if op_type in DOCUMENT_OPS and op_type != "batch":
+                resolved = self.engine.prepare(op_type, op.get("payload", {})) if resolve else op["payload"]
+            stamp = (version, author_id, number)
+            undo = self.engine.invert(op_type, resolved, stamp) if resolved is not None else None
+            if resolved is None or not self.engine.apply(op_type, resolved, stamp):
+                self.engine.rollback()
+                return None
+            # Обратные операции пакета применяются в обратном порядке
+            inverse = undo + inverse if undo is not None and inverse is not None else None
+            prepared.append({"type": op_type, "payload": resolved})
+        self.engine.commit()
+        self.version = version
+        self.touch()
+        self.collect_garbage()
+        return prepared, inverse
+
+    def compact(self) -> None:
+        """Перевести состояние в компактную модель (app/ws/document.py).
+
+        Содержимое, версия и метаданные CRDT не меняются, поэтому
+        закодированные снимки остаются действительными.
+        """
+        if self.compacted:
+            return
+        meta = self.engine.export()
+        self.state = from_json(self.state)
+        self.index.rebuild(self.state)
+        self.engine.reset(self.state)
+        self.engine.load(meta)
+        self.compacted = True
+
+    def apply_replicated(self, message: dict) -> bool:
+        """Применить разрешенную операцию владельца со следующей версией (у реплики)"""
+        stamp = (message["version"], message.get("userId") or "")
+        if message["type"] == "batch":
+            for number, op in enumerate(message["payload"]):
+                if not self.engine.apply(op["type"], op["payload"], stamp + (number,)):
+                    return False
+        elif not self.engine.apply(message["type"], message["payload"], stamp):
+            return False
+        self.version = message["version"]
+        self.touch()
+        self.collect_garbage()
+        return True
+
+    def estimate_state_bytes(self) -> int:
+        """Размер состояния в байтах JSON; пересчитывается, только если версия изменилась"""
+        if self.sized_version != self.version:
+            self.state_bytes = len(json.dumps(self.state, ensure_ascii=False, default=json_default).encode("utf-8"))
+            self.sized_version = self.version
+        return self.state_bytes
+
+    def enqueue(self, op: SubmittedOp) -> None:
+        """Поставить операцию в очередь актора; актор запускается, если простаивает"""
+        self.inbox.append(op)
+        if self.actor is None or self.actor.done():
+            self.actor = asyncio.create_task(run_room_actor(self))
+
+    def close(self) -> None:
+        """Остановить фоновые задачи комнаты перед выгрузкой"""
+        self.presence.close()
+        self.spectators.close()
+        self.saver.close()
+        if self.actor is not None:
+            self.actor.cancel()
+        if self.journal is not None:
+            self.journal.discard()
+            self.journal = None
+        while self.inbox:
+            op = self.inbox.popleft()
+            if op.done is not None and not op.done.done():
+                op.done.set_result(None)
+
+    def journal_snapshot(self) -> dict:
+        """Снимок комнаты для журнала на диске"""
+        return {
+            "roomId": self.room_id,
+            "epoch": self.epoch,
+            "version": self.version,
+            "state": self.state,
+            "meta": self.engine.export(),
+            "projectId": self.project_id,
+            "projectOwnerId": self.project_owner_id,
+            "saveTo": [self.saver.project_id, self.saver.user_id] if self.saver.bound else None,
+            "saveDirty": self.saver.dirty,
+        }
+
+    def snapshot_message(self) -> dict:
+        """Сообщение sync_state с полным состоянием и текущей версией"""
+        return {
+            "type": "sync_state",
+            "payload": self.state,
+            "version": self.version,
+            "epoch": self.epoch,
+            "timestamp": datetime.now().isoformat(),
+        }
+
+    def snapshot_frame(self, codec: Codec) -> Frame:
+        """Кадр снимка в кодеке соединения: один раз на версию и кодек.
+
+        Присоединения, request_sync, переполненные очереди, зрители и
+        полные состояния для клиентов без дельт получают один и тот же кадр,
+        пока версия не сменится; timestamp в нем — время первого кодирования.
+        """
+        key = (self.epoch, self.version)
+        if self.snapshot_key != key:
+            self.snapshot_frames = {}
+            self.snapshot_key = key
+        frame = self.snapshot_frames.get(codec)
+        if frame is None:
+            frame = self.snapshot_frames[codec] = codec.encode(self.snapshot_message())
+        return frame
+
+    def catch_up_message(self, since: int, epoch: Optional[str] = None) -> dict:
+        """Операции после версии since; снимок, если журнал их уже не хранит"""
+        ops = self.oplog.since(since) if epoch in (None, self.epoch) else None
+        if ops is None:
+            return self.snapshot_message()
+        return {
+            "type": "catch_up",
+            "payload": {"since": since, "ops": ops},
+            "version": self.version,
+            "epoch": self.epoch,
+            "timestamp": datetime.now().isoformat(),
+        }
 
 
 # Хранилище комнат в памяти
 rooms: Dict[str, Room] = {}
+# Сервер останавливается: новые подключения не принимаются (drain_connections)
+draining = False
 
 
 def get_or_create_room(room_id: str) -> Room:
     """Получить комнату или создать новую"""
     if room_id not in rooms:
         rooms[room_id] = Room(room_id)
+        ROOMS_ACTIVE.set(len(rooms))
     return rooms[room_id]
 
 
@@ -39,10 +410,21 @@ def remove_user_from_room(room_id: str, user_id: str):
     if room_id in rooms:
         room = rooms[room_id]
         if user_id in room.users:
-            del room.users[user_id]
+            room.touch()
+            user_data = room.users.pop(user_id)
+            user_data["conn"].close()
+            room.limiter.scale(room_rate_factor(len(room.users)))
+            CONNECTIONS.dec()
+            room.presence.remove(user_id)
+            # История анонима привязана к соединению — к ней уже не вернуться
+            room.history.forget(user_id)
+            if not room.users:
+                room.presence.close()
+                # Ушел последний участник: сохраняем состояние и отписываемся от шины
+                asyncio.create_task(detach_room_from_bus(room))
 
             # Уведомляем остальных пользователей
-            broadcast_to_room(
+            fan_out(
                 room_id,
                 {
                     "type": "leave",
@@ -53,33 +435,720 @@ def remove_user_from_room(room_id: str, user_id: str):
             )
 
 
-def broadcast_to_room(room_id: str, message: dict, exclude_user_id: Optional[str] = None):
-    """Отправить сообщение всем пользователям в комнате"""
+def broadcast_to_room(
+    room_id: str,
+    message: dict,
+    exclude_user_id: Optional[str] = None,
+    deltas: Optional[bool] = None,
+    encode: Optional[Callable[[Codec], Frame]] = None,
+):
+    """Отправить сообщение всем пользователям в комнате.
+
+    deltas — только соединениям с дельта-протоколом (True) или без него (False);
+    encode — готовый кадр сообщения для кодека (снимок из Room.snapshot_frame).
+    """
     if room_id not in rooms:
         return
 
     room = rooms[room_id]
-    message_json = json.dumps(message)
+    kind = message_kind(message.get("type"))
+    # Кодируем один раз на кодек, а не на каждое соединение
+    frames = {}
 
     disconnected_users = []
+    recipients = 0
     for user_id, user_data in list(room.users.items()):
         if exclude_user_id and user_id == exclude_user_id:
             continue
+        if deltas is not None and user_data["conn"].deltas != deltas:
+            continue
+        recipients += 1
 
         try:
             ws: WebSocket = user_data["ws"]
-            if ws.client_state.name == "CONNECTED":
-                asyncio.create_task(ws.send_text(message_json))
-            else:
+            conn: Connection = user_data["conn"]
+            frame = frames.get(conn.codec)
+            if frame is None:
+                frame = frames[conn.codec] = encode(conn.codec) if encode else conn.codec.encode(message)
+            if ws.client_state.name != "CONNECTED" or not conn.send(frame, kind):
                 disconnected_users.append(user_id)
         except Exception:
             disconnected_users.append(user_id)
 
+    FANOUT_RECIPIENTS.observe(recipients)
+
     # Удаляем отключенных пользователей
     for user_id in disconnected_users:
         remove_user_from_room(room_id, user_id)
 
 
+def fan_out(room_id: str, message: dict, exclude_user_id: Optional[str] = None):
+    """Разослать сообщение участникам комнаты на этом и на других воркерах"""
+    broadcast_to_room(room_id, message, exclude_user_id=exclude_user_id)
+    room = rooms.get(room_id)
+    if room is not None and room.bus_attached:
+        room_bus.publish(room_id, {"event": "broadcast", "message": message})
+
+
+def send_message(connection: Connection, message: dict) -> None:
+    """Поставить сообщение в очередь отправки одного соединения"""
+    connection.send(connection.codec.encode(message), message_kind(message.get("type")))
+
+
+def send_snapshot(room: Room, connection: Connection) -> None:
+    """Отправить соединению снимок комнаты (кадр общий для версии и кодека)"""
+    connection.send(room.snapshot_frame(connection.codec), message_kind("sync_state"))
+
+
+def broadcast_snapshot(room: Room, exclude_user_id: Optional[str] = None, deltas: Optional[bool] = None) -> None:
+    """Разослать снимок комнаты локальным участникам"""
+    broadcast_to_room(
+        room.room_id, room.snapshot_message(), exclude_user_id=exclude_user_id, deltas=deltas,
+        encode=room.snapshot_frame,
+    )
+
+
+def send_snapshot_to_user(room: Room, user_id: str) -> None:
+    """Снимок локальному участнику, если он еще подключен (автор отклоненной операции)"""
+    user_data = room.users.get(user_id)
+    if user_data is not None:
+        send_snapshot(room, user_data["conn"])
+
+
+def send_catch_up(room: Room, connection: Connection, since: int, epoch: Optional[str] = None) -> None:
+    """Операции после версии since или снимок, если журнал их уже не хранит"""
+    message = room.catch_up_message(since, epoch)
+    if message["type"] == "catch_up":
+        send_message(connection, message)
+    else:
+        send_snapshot(room, connection)
+
+
+async def stream_snapshot(room: Room, connection: Connection, chunk_blocks: Optional[int] = None) -> None:
+    """Начальная синхронизация частями: sync_begin, окна sync_blocks, sync_end.
+
+    Сначала уходит все состояние, кроме блоков (шапка, тема, подвал), затем
+    корневые блоки окнами по WS_SYNC_CHUNK_BLOCKS. Каждое окно кодируется
+    перед отправкой, между окнами ждем writer соединения. Если за это время
+    комната получила новую версию, поток начинается заново: все окна одного
+    потока соответствуют версии из sync_begin, а операции после нее клиент
+    получает обычной рассылкой и применяет после sync_end.
+    """
+    chunk_blocks = chunk_blocks or settings.WS_SYNC_CHUNK_BLOCKS
+    for _ in range(_MAX_SYNC_RESTARTS):
+        version = room.version
+        blocks = room.state.get("blocks") or []
+        head = {key: value for key, value in room.state.items() if key != "blocks"}
+        send_message(connection, {
+            "type": "sync_begin",
+            "payload": head,
+            "totalBlocks": len(blocks),
+            "version": version,
+            "epoch": room.epoch,
+            "timestamp": datetime.now().isoformat(),
+        })
+        for offset in range(0, len(blocks), chunk_blocks):
+            await connection.drain()
+            if connection.closed:
+                return
+            if room.version != version:
+                break
+            # Список блоков перечитываем: откат пакета заменяет его копией той же версии
+            blocks = room.state.get("blocks") or []
+            send_message(connection, {
+                "type": "sync_blocks",
+                "payload": blocks[offset:offset + chunk_blocks],
+                "offset": offset,
+                "version": version,
+            })
+        else:
+            send_message(connection, {
+                "type": "sync_end",
+                "payload": {"totalBlocks": len(blocks)},
+                "version": version,
+                "epoch": room.epoch,
+                "timestamp": datetime.now().isoformat(),
+            })
+            return
+    # Комната меняется быстрее, чем уходит поток, — одним снимком
+    send_snapshot(room, connection)
+
+
+def users_list_message(room: Room) -> dict:
+    users = [
+        {"id": uid, "name": user_data["name"]}
+        for uid, user_data in room.users.items()
+    ]
+    users.extend(
+        {"id": uid, "name": user_data["name"]}
+        for uid, user_data in room.remote_users.items()
+    )
+    return {
+        "type": "users_list",
+        "payload": users,
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+async def subscribe_room(room: Room) -> bool:
+    """Подписать комнату на шину и попробовать стать ее владельцем (под room.bus_lock).
+
+    Подписка идет первой: владелец должен слышать запросы снимка и
+    операции других воркеров с момента, когда им стал.
+    """
+    room_id = room.room_id
+    await room_bus.subscribe(room_id, lambda envelope: handle_bus_envelope(room_id, envelope))
+    room.bus_attached = True
+    return await room_bus.acquire_owner(room_id)
+
+
+async def unsubscribe_room(room: Room) -> None:
+    """Отписать комнату от шины (под room.bus_lock); владение снимает вызывающий"""
+    room.bus_attached = False
+    room.remote_users.clear()
+    await room_bus.unsubscribe(room.room_id)
+
+
+async def attach_room_to_bus(room: Room) -> None:
+    """Подписаться на шину комнаты и определить ее владельца"""
+    async with room.bus_lock:
+        if room.bus_attached:
+            return
+        room_id = room.room_id
+        if not await subscribe_room(room):
+            # Состояние и список участников берем у владельца и других воркеров
+            room.awaiting_snapshot = True
+            room_bus.publish(room_id, {"event": "snapshot_request"})
+            room_bus.publish(room_id, {"event": "roster_request"})
+
+
+async def detach_room_from_bus(room: Room) -> None:
+    """Отписаться от шины, когда ушел последний локальный участник или зритель"""
+    async with room.bus_lock:
+        if room.users or room.spectators or not room.bus_attached:
+            return
+        await unsubscribe_room(room)
+        # Перед передачей владения дописываем несохраненное состояние, не дожидаясь таймера
+        await room.saver.flush()
+        await room_bus.release_owner(room.room_id)
+
+
+def deliver_op(room: Room, message: dict, via: Optional[str]) -> None:
+    """Разослать примененную операцию локальным участникам; автору — op_ack.
+
+    Результат undo/redo (с полем origin) автор получает вместе со всеми:
+    какие операции его отменили, решает сервер. Клиенты без дельта-протокола
+    получают не операцию, а состояние после пакета (flush_full_state).
+    """
+    author_id = message.get("userId")
+    from_history = "origin" in message
+    exclude_user_id = None if from_history else author_id
+    if message["type"] == "sync_state":
+        broadcast_to_room(room.room_id, message, exclude_user_id=exclude_user_id)
+    else:
+        broadcast_to_room(room.room_id, message, exclude_user_id=exclude_user_id, deltas=True)
+        if room.full_state_authors is None:
+            room.full_state_authors = set()
+        room.full_state_authors.add(exclude_user_id)
+    room.spectators.notify()
+    author = room.users.get(author_id)
+    if (
+        via == room_bus.worker_id and message["type"] != "sync_state" and not from_history
+        and author is not None and author["conn"].deltas
+    ):
+        send_message(author["conn"], {
+            "type": "op_ack",
+            "payload": {"version": message["version"]},
+            "timestamp": datetime.now().isoformat(),
+        })
+
+
+def flush_full_state(room: Room) -> None:
+    """Одно sync_state клиентам без дельта-протокола за весь пакет операций.
+
+    Автор, если он в пакете один, состояние не получает: его правки у него
+    уже есть (как и раньше, когда sync_state рассылался на каждую операцию).
+    """
+    authors = room.full_state_authors
+    if authors is None:
+        return
+    room.full_state_authors = None
+    exclude_user_id = next(iter(authors)) if len(authors) == 1 else None
+    broadcast_snapshot(room, exclude_user_id=exclude_user_id, deltas=False)
+
+
+def commit_op(
+    room: Room,
+    op_type: str,
+    payload: dict,
+    author_id: str,
+    via: str,
+    history: Optional[str] = None,
+    account: Optional[int] = None,
+) -> Optional[dict]:
+    """Применить операцию у владельца комнаты; вернуть сообщение для рассылки или None.
+
+    Автосохранение помечается грязным, только если автор — пользователь,
+    в чей проект сохраняется комната: правки анонимов и остальных участников
+    попадают в проект вместе с его следующей правкой, а после его ухода не
+    записываются в проект от его имени.
+    """
+    project = None
+    origin = None
+    if op_type == LOAD_PROJECT:
+        project = payload
+        if room.state:
+            # Комнату уже наполнили: ее состояние новее сохраненного проекта
+            room.saver.bind(project["projectId"], project["ownerId"])
+            return None
+        op_type, payload = "sync_state", project["state"]
+    started = time.perf_counter()
+    if op_type == "sync_state":
+        version = room.replace_state(payload)
+    elif op_type in HISTORY_OPS:
+        origin = op_type
+        # Запись истории уходит всем, включая автора, одним пакетом batch
+        payload = room.apply_history(author_id, history or author_id, redo=op_type == "redo")
+        if payload == []:
+            # Отменять нечего — автор с сервером не расходился
+            return None
+        op_type = "batch"
+        version = room.version if payload is not None else None
+    else:
+        # В рассылку уходит разрешенная форма операции (ключ позиции вместо индексов)
+        payload = room.apply_op(op_type, payload, author_id, history or author_id)
+        version = room.version if payload is not None else None
+    OP_APPLY_LATENCY.labels(type=op_type).observe(time.perf_counter() - started)
+
+    if version is None:
+        # Операция не применилась — автор разошелся с сервером
+        if via == room_bus.worker_id:
+            send_snapshot_to_user(room, author_id)
+        else:
+            room_bus.publish(room.room_id, {"event": "reject", "author": author_id, "via": via})
+        return None
+
+    if project is not None:
+        # Состояние совпадает с Project.data — записывать его обратно незачем
+        room.saver.bind(project["projectId"], project["ownerId"], clean=True)
+    elif account is not None and account == room.saver.user_id:
+        room.saver.mark_dirty()
+    message = {
+        "type": op_type,
+        "payload": payload,
+        "version": version,
+        "userId": author_id,
+        "timestamp": datetime.now().isoformat(),
+    }
+    if origin is not None:
+        message["origin"] = origin
+    if op_type != "sync_state":
+        room.oplog.append(message)
+    return message
+
+
+async def run_room_actor(room: Room) -> None:
+    """Единственный писатель состояния комнаты у владельца.
+
+    Разбирает входящую очередь пакетами: применяет операции по порядку
+    постановки, присваивает версии и только потом рассылает весь пакет —
+    локальным участникам по порядку версий, другим воркерам одним
+    конвертом. Пока пакет рассылается, новые операции копятся в очереди
+    и уходят следующим пакетом. Задача завершается, когда очередь пуста.
+    """
+    while room.inbox:
+        batch = [room.inbox.popleft() for _ in range(min(len(room.inbox), settings.WS_ROOM_ACTOR_BATCH_OPS))]
+        committed = []
+        for op in batch:
+            try:
+                message = commit_op(room, op.op_type, op.payload, op.author_id, op.via, op.history, op.account)
+            except Exception:
+                logger.exception("Failed to apply %s in room %s", op.op_type, room.room_id)
+                message = None
+            if message is not None:
+                committed.append({"message": message, "via": op.via})
+            if op.done is not None and not op.done.done():
+                op.done.set_result(message)
+
+        if committed:
+            journal_ops(room, [entry["message"] for entry in committed])
+        for entry in committed:
+            deliver_op(room, entry["message"], entry["via"])
+        flush_full_state(room)
+        if committed and room.bus_attached:
+            room_bus.publish(room.room_id, {"event": "ops", "ops": committed})
+
+        now = time.monotonic()
+        for op in batch:
+            ROOM_OP_LATENCY.observe(now - op.enqueued_at)
+        ROOM_ACTOR_BATCH_OPS.observe(len(batch))
+        room.op_latency = now - batch[0].enqueued_at
+        # Отдаем цикл событий: соединения успеют поставить следующие операции
+        await asyncio.sleep(0)
+
+
+async def submit_op(
+    room: Room,
+    op_type: str,
+    payload: dict,
+    author_id: str,
+    wait: bool = False,
+    history: Optional[str] = None,
+    account: Optional[int] = None,
+) -> None:
+    """Операция локального участника: в очередь актора у себя или владельцу.
+
+    wait — дождаться, пока актор применит операцию (только если владелец —
+    этот воркер); history — ключ истории undo/redo автора; account — id его
+    аккаунта (None — аноним).
+    """
+    if room.is_owner or await room_bus.acquire_owner(room.room_id):
+        done = asyncio.get_running_loop().create_future() if wait else None
+        room.enqueue(SubmittedOp(
+            op_type, payload, author_id, room_bus.worker_id, time.monotonic(), done, history, account,
+        ))
+        if done is not None:
+            await done
+    else:
+        room_bus.publish(room.room_id, {
+            "event": "submit",
+            "type": op_type,
+            "payload": payload,
+            "author": author_id,
+            "via": room_bus.worker_id,
+            "history": history,
+            "account": account,
+        })
+
+
+async def bind_project(room: Room, project_id: int, user: Optional[User], author_id: str) -> bool:
+    """Привязать комнату к проекту и один раз загрузить из него состояние.
+
+    Project.data читается из БД при первом подключении с этим projectId и
+    становится состоянием комнаты (если комната еще пуста); следующие
+    участники получают его из памяти. False — пользователь не владелец
+    проекта, проекта нет или комната уже привязана к другому проекту.
+    """
+    if user is None or room.project_id not in (None, project_id):
+        return False
+    if room.project_owner_id is None:
+        loading = room.project_loading
+        if loading is None:
+            loading = room.project_loading = asyncio.ensure_future(load_project(project_id))
+        try:
+            # Одновременные первые подключения ждут одного запроса к БД
+            project = await asyncio.shield(loading)
+        except Exception:
+            logger.exception("Failed to load project %s for room %s", project_id, room.room_id)
+            project = None
+        finally:
+            if room.project_loading is loading:
+                room.project_loading = None
+        if project is None or project.user_id != user.id:
+            return False
+        if room.project_owner_id is None and room.project_id in (None, project_id):
+            claim_project(room, project_id, project.user_id)
+            room_bus.publish(room.room_id, {"event": "bind", "projectId": project_id, "ownerId": project.user_id})
+            await submit_op(room, LOAD_PROJECT, {
+                "projectId": project_id,
+                "ownerId": project.user_id,
+                "state": project.data,
+            }, author_id, wait=True)
+    return room.project_id == project_id and room.project_owner_id == user.id
+
+
+async def apply_deferred_sync(
+    room: Room, limits: InboundLimits, author_id: str, history: str, account: Optional[int] = None,
+) -> None:
+    """Применить последний отклоненный лимитом sync_state, когда ведра наполнятся.
+
+    Клиент шлет полное состояние после каждой правки; отброшенный sync_state
+    потерял бы ее и в комнате, и в автосохранении проекта. Более поздние
+    отклоненные sync_state заменяют ожидающий, так что применяется только
+    последнее состояние клиента.
+    """
+    while limits.deferred is not None:
+        wait = limits.retry_after("sync_state")
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        payload, limits.deferred = limits.deferred, None
+        if limits.admit("sync_state", payload):
+            await submit_op(room, "sync_state", payload, author_id, history=history, account=account)
+        elif limits.deferred is None:
+            limits.deferred = payload
+
+
+def claim_project(room: Room, project_id: int, owner_id: int) -> None:
+    """Закрепить комнату за проектом и отключить участников, не являющихся его владельцем.
+
+    Участники, вошедшие в комнату до привязки, видели бы и правили
+    Project.data чужого проекта — их соединения закрываются с кодом 1008.
+    """
+    room.project_id = project_id
+    room.project_owner_id = owner_id
+    for user_data in room.users.values():
+        if user_data["account"] != owner_id:
+            user_data["conn"].abort(POLICY_VIOLATION_CLOSE_CODE)
+    # Зрители по токенам, выданным не владельцем, тоже не должны видеть проект
+    for spectator_id, connection in room.spectators.connections.items():
+        if not may_view(room, room.spectators.issuers.get(spectator_id)):
+            connection.abort(POLICY_VIOLATION_CLOSE_CODE)
+
+
+def may_edit(room: Room, user: Optional[User]) -> bool:
+    """Может ли участник читать и менять комнату: у комнаты проекта — только его владелец"""
+    return room.project_owner_id is None or (user is not None and user.id == room.project_owner_id)
+
+
+def may_view(room: Room, issuer: Optional[int], project_id: Optional[int] = None) -> bool:
+    """Действует ли токен просмотра, выданный issuer для комнаты проекта project_id.
+
+    Комнату проекта смотрят только по токенам его владельца, и только если
+    с выдачи она не привязана к другому проекту.
+    """
+    if room.project_owner_id is not None and issuer != room.project_owner_id:
+        return False
+    return project_id is None or room.project_id in (None, project_id)
+
+
+def request_save(room: Room, project_id: int, user_id: int) -> None:
+    """Привязать комнату к проекту для автосохранения (у владельца комнаты)"""
+    if room.is_owner:
+        room.saver.bind(project_id, user_id)
+    else:
+        room_bus.publish(room.room_id, {"event": "save", "projectId": project_id, "userId": user_id})
+
+
+async def flush_all_rooms() -> None:
+    """Сохранить все грязные комнаты и снимки журнала (остановка сервера)"""
+    for room in list(rooms.values()):
+        try:
+            await room.saver.flush()
+        except Exception:
+            logger.exception("Failed to flush room %s", room.room_id)
+        if room.journal is not None:
+            await room.journal.flush(snapshot=True)
+            room.journal.close()
+
+
+async def drain_connections(timeout: Optional[float] = None) -> int:
+    """Остановка сервера: разослать reconnect и закрыть сокеты за ограниченное время.
+
+    Каждый участник и зритель получает ``reconnect`` с версией и epoch
+    комнаты и случайной задержкой в пределах
+    WS_DRAIN_RECONNECT_JITTER_SECONDS: клиенты возвращаются не разом и с
+    since/epoch, то есть за catch_up, а не за полным снимком. Затем ждем,
+    пока подсказки уйдут (не дольше timeout), и закрываем сокеты с 1012.
+    Участников снимаем разом, без leave: иначе каждый уход рассылался бы
+    каждому оставшемуся.
+    """
+    global draining
+    draining = True
+    timeout = timeout if timeout is not None else settings.WS_DRAIN_TIMEOUT_SECONDS
+    jitter = settings.WS_DRAIN_RECONNECT_JITTER_SECONDS
+
+    connections: List[Connection] = []
+    for room in list(rooms.values()):
+        room_connections = [user_data["conn"] for user_data in room.users.values()]
+        room_connections.extend(room.spectators.connections.values())
+        for connection in room_connections:
+            send_message(connection, {
+                "type": "reconnect",
+                "payload": {
+                    "roomId": room.room_id,
+                    "since": room.version,
+                    "epoch": room.epoch,
+                    "retryAfter": round(random.uniform(0, jitter), 3),
+                },
+                "timestamp": datetime.now().isoformat(),
+            })
+        connections.extend(room_connections)
+
+    if connections:
+        await asyncio.wait([asyncio.create_task(connection.drain()) for connection in connections], timeout=timeout)
+
+    for room in list(rooms.values()):
+        room.presence.close()
+        for user_data in room.users.values():
+            user_data["conn"].abort(SERVICE_RESTART_CLOSE_CODE)
+        CONNECTIONS.dec(len(room.users))
+        room.users.clear()
+        for spectator_id, connection in list(room.spectators.connections.items()):
+            connection.abort(SERVICE_RESTART_CLOSE_CODE)
+            room.spectators.remove(spectator_id)
+    DRAINED_CONNECTIONS.inc(len(connections))
+    return len(connections)
+
+
+def journal_ops(room: Room, messages: List[dict]) -> None:
+    """Передать пакет примененных операций журналу на диске (у владельца); файлы пишутся в фоне"""
+    if room.journal is None:
+        try:
+            room.journal = open_journal(room.room_id, room.journal_snapshot)
+        except OSError:
+            # Журнал — страховка от рестарта; комната продолжает работать без него
+            logger.exception("Failed to open journal of room %s", room.room_id)
+            return
+        if room.journal is None:
+            return
+        # Новый журнал начинается со снимка, в который уже входит пакет
+        room.journal.request_snapshot()
+    elif room.journal.needs_snapshot or any(message["type"] == "sync_state" for message in messages):
+        room.journal.request_snapshot()
+    else:
+        room.journal.append(messages)
+
+
+async def restore_rooms() -> int:
+    """Поднять комнаты из журнала на диске (старт сервера); вернуть их число.
+
+    Поднятая комната сразу подписана на шину: ее владелец отвечает на
+    snapshot_request и принимает операции участников с других воркеров.
+    Без участников ее выгрузит уборщик, сняв подписку и владение.
+    """
+    restored = 0
+    for snapshot, ops in load_journals():
+        room_id = snapshot["roomId"]
+        if room_id in rooms:
+            continue
+        room = get_or_create_room(room_id)
+        async with room.bus_lock:
+            owner = await subscribe_room(room)
+            if not owner:
+                await unsubscribe_room(room)
+        if not owner:
+            # Комнатой уже владеет другой воркер — его состояние новее. Журнал не
+            # удаляем: при общем WS_JOURNAL_DIR это файлы владельца
+            if rooms.get(room_id) is room:
+                del rooms[room_id]
+            room.close()
+            continue
+        room.replace_state(snapshot["state"])
+        room.engine.load(snapshot["meta"])
+        room.version = snapshot["version"]
+        room.epoch = snapshot["epoch"]
+        room.oplog.reset(room.version)
+        for message in ops:
+            if message["version"] <= room.version:
+                # Снимок записан, а журнал не успели обрезать
+                continue
+            if message["version"] != room.version + 1 or not room.apply_replicated(message):
+                logger.warning("Room %s journal diverges at version %s", room_id, message["version"])
+                break
+            room.oplog.append(message)
+        room.project_id = snapshot.get("projectId")
+        room.project_owner_id = snapshot.get("projectOwnerId")
+        if snapshot.get("saveTo"):
+            room.saver.bind(*snapshot["saveTo"], clean=not snapshot.get("saveDirty", True) and not ops)
+        room.journal = open_journal(room_id, room.journal_snapshot)
+        await room.journal.flush(snapshot=True)
+        restored += 1
+    return restored
+
+
+def _apply_replicated_op(room: Room, message: dict) -> bool:
+    """Применить операцию владельца к реплике; False — реплика отстала"""
+    if room.awaiting_snapshot or message.get("version") != room.version + 1:
+        return False
+    if message["type"] == "sync_state":
+        room.replace_state(message["payload"])
+        return True
+    if not room.apply_replicated(message):
+        return False
+    room.oplog.append(message)
+    return True
+
+
+async def handle_bus_envelope(room_id: str, envelope: dict) -> None:
+    """Обработать конверт от другого воркера"""
+    room = rooms.get(room_id)
+    if room is None:
+        return
+    event = envelope.get("event")
+    origin = envelope.get("origin")
+
+    if event == "broadcast":
+        message = envelope["message"]
+        if message.get("type") == "join":
+            user = message["payload"]
+            room.remote_users[user["id"]] = {"id": user["id"], "name": user["name"], "worker": origin}
+        elif message.get("type") == "leave":
+            room.remote_users.pop(message["payload"]["userId"], None)
+            room.history.forget(message["payload"]["userId"])
+        broadcast_to_room(room_id, message)
+
+    elif event == "submit":
+        if room.is_owner:
+            room.enqueue(SubmittedOp(
+                envelope["type"], envelope["payload"], envelope["author"], envelope["via"], time.monotonic(),
+                history=envelope.get("history"), account=envelope.get("account"),
+            ))
+
+    elif event == "ops":
+        if room.is_owner:
+            return
+        for entry in envelope["ops"]:
+            if _apply_replicated_op(room, entry["message"]):
+                deliver_op(room, entry["message"], entry.get("via"))
+            elif not room.awaiting_snapshot:
+                room.awaiting_snapshot = True
+                room_bus.publish(room_id, {"event": "snapshot_request"})
+        flush_full_state(room)
+
+    elif event == "bind":
+        # Привязка к проекту прошла на другом воркере
+        if room.project_owner_id is None:
+            claim_project(room, envelope["projectId"], envelope["ownerId"])
+
+    elif event == "save":
+        if room.is_owner:
+            room.saver.bind(envelope["projectId"], envelope["userId"])
+
+    elif event == "reject":
+        if envelope.get("via") == room_bus.worker_id:
+            send_snapshot_to_user(room, envelope["author"])
+
+    elif event == "snapshot_request":
+        if room.is_owner:
+            room_bus.publish(room_id, {
+                "event": "snapshot",
+                "state": room.state,
+                "version": room.version,
+                "epoch": room.epoch,
+                "meta": room.engine.export(),
+                "projectId": room.project_id,
+                "ownerId": room.project_owner_id,
+            })
+
+    elif event == "snapshot":
+        if room.is_owner or envelope["version"] < room.version:
+            return
+        room.replace_state(envelope["state"])
+        if "meta" in envelope:
+            room.engine.load(envelope["meta"])
+        room.version = envelope["version"]
+        room.oplog.reset(room.version)
+        room.epoch = envelope.get("epoch", room.epoch)
+        room.awaiting_snapshot = False
+        if envelope.get("ownerId") is not None and room.project_owner_id is None:
+            claim_project(room, envelope["projectId"], envelope["ownerId"])
+        if room.state:
+            broadcast_snapshot(room)
+            room.spectators.notify()
+
+    elif event == "roster_request":
+        room_bus.publish(room_id, {
+            "event": "roster",
+            "users": [{"id": uid, "name": data["name"]} for uid, data in room.users.items()],
+        })
+
+    elif event == "roster":
+        for user in envelope["users"]:
+            room.remote_users[user["id"]] = {"id": user["id"], "name": user["name"], "worker": origin}
+        broadcast_to_room(room_id, users_list_message(room))
+
+
 async def get_user_from_token(token: str) -> Optional[User]:
     """Получить пользователя из токена"""
     try:
@@ -88,23 +1157,71 @@ async def get_user_from_token(token: str) -> Optional[User]:
         if subject is None:
             return None
         user_id = int(subject)
+        # Сессия открывает соединение с БД, только если пользователя нет в кэше
         async with async_session_maker() as db:
-            result = await db.execute(select(User).where(User.id == user_id))
-            return result.scalar_one_or_none()
+            return await identity_cache.get_user(user_id, db)
     except Exception:
         return None
 
 
+async def load_project(project_id: int) -> Optional[Row]:
+    """Владелец и данные неудаленного проекта; None — проекта нет"""
+    async with async_session_maker() as db:
+        result = await db.execute(
+            select(Project.user_id, Project.data).where(
+                Project.id == project_id,
+                Project.deleted_at.is_(None),
+            )
+        )
+        return result.one_or_none()
+
+
+def is_well_formed(message) -> bool:
+    """Кадр — объект со строковым type и payload-объектом или массивом"""
+    return (
+        isinstance(message, dict)
+        and isinstance(message.get("type"), str)
+        and isinstance(message.get("payload", {}), (dict, list))
+    )
+
+
+async def receive_frame(websocket: WebSocket) -> Union[str, bytes]:
+    """Следующий кадр клиента: текстовый (str) или бинарный (bytes)"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("text") is not None:
+        return message["text"]
+    return message.get("bytes") or b""
+
+
+def frame_size(data: Union[str, bytes]) -> int:
+    """Размер кадра в байтах: текстовый кадр шел по сети в UTF-8"""
+    if isinstance(data, bytes) or data.isascii():
+        return len(data)
+    return len(data.encode())
+
+
 @router.websocket("/ws/rooms/{room_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     room_id: str,
     name: str = Query(..., description="Имя пользователя"),
     token: str = Query(None, description="JWT токен для аутентификации"),
+    since: Optional[int] = Query(None, description="Последняя известная клиенту версия комнаты"),
+    epoch: Optional[str] = Query(None, description="Epoch комнаты из последнего sync_state"),
+    encoding: Optional[str] = Query(None, description="Кодировка кадров: json, orjson или msgpack"),
+    compress: Optional[str] = Query(None, description="Сжатие больших кадров: zstd"),
+    sync: Optional[str] = Query(None, description="chunked — начальное состояние частями"),
+    project_id: Optional[int] = Query(None, alias="projectId", description="Проект, из которого загрузить состояние"),
+    protocol: Optional[str] = Query(None, description="delta — операции с версиями вместо полного состояния"),
 ):
     """WebSocket endpoint для подключения к комнате"""
     # Токен опционален, но если передан, можно использовать для идентификации пользователя
     await websocket.accept()
+    if draining:
+        await websocket.close(code=SERVICE_RESTART_CLOSE_CODE)
+        return
 
     # Получаем пользователя из токена, если он передан
     user: Optional[User] = None
@@ -113,30 +1230,65 @@ async def websocket_endpoint(
 
     # Генерируем ID пользователя
     user_id = f"user-{uuid.uuid4().hex[:12]}"
+    # История undo/redo привязана к пользователю и переживает переподключение
+    history_key = f"user:{user.id}" if user else user_id
+    account = user.id if user else None
 
     # Получаем или создаем комнату
     room = get_or_create_room(room_id)
 
+    # Комната проекта: состояние загружается из БД, выгружать его клиенту не нужно
+    if project_id is not None and not await bind_project(room, project_id, user, user_id):
+        await websocket.close(code=1008)
+        return
+    # В уже привязанную комнату — только владелец проекта, с projectId или без;
+    # остальным доступен просмотр по токену /view
+    if not may_edit(room, user):
+        await websocket.close(code=1008)
+        return
+
+    # Все исходящие кадры соединения идут через его очередь и writer-задачу
+    codec = get_codec(encoding, compress)
+    connection = Connection(
+        websocket,
+        snapshot=lambda: room.snapshot_frame(codec),
+        codec=codec,
+        deltas=protocol == "delta",
+    )
+    connection.start()
+    limits = InboundLimits(room.limiter)
+    deferred_sync: Optional[asyncio.Task] = None
+
     # Добавляем пользователя в комнату
+    room.touch()
     room.users[user_id] = {
         "id": user_id,
         "name": name,
         "ws": websocket,
+        "conn": connection,
+        "account": account,
         "joined_at": datetime.now().isoformat(),
     }
+    room.limiter.scale(room_rate_factor(len(room.users)))
+    CONNECTIONS.inc()
+    ROOM_USERS.observe(len(room.users))
+    # Первый локальный участник подключает комнату к шине между воркерами
+    await attach_room_to_bus(room)
 
-    # Отправляем текущее состояние проекта новому пользователю
+    # Отправляем текущее состояние проекта новому пользователю; переподключившийся
+    # клиент с since получает только пропущенные операции (если умеет их применять)
     if room.state:
-        await websocket.send_text(
-            json.dumps({
-                "type": "sync_state",
-                "payload": room.state,
-                "timestamp": datetime.now().isoformat(),
-            })
-        )
+        initial = room.catch_up_message(since, epoch) if since is not None and connection.deltas else None
+        if initial is not None and initial["type"] == "catch_up":
+            send_message(connection, initial)
+        elif sync == "chunked":
+            # Шапка и тема сразу, блоки окнами — редактор рисует первый экран, не дожидаясь всего
+            await stream_snapshot(room, connection)
+        else:
+            send_snapshot(room, connection)
 
     # Уведомляем всех о новом пользователе
-    broadcast_to_room(
+    fan_out(
         room_id,
         {
             "type": "join",
@@ -150,170 +1302,102 @@ async def websocket_endpoint(
     )
 
     # Отправляем список всех пользователей новому участнику
-    users_list = [
-        {"id": uid, "name": user_data["name"]}
-        for uid, user_data in room.users.items()
-    ]
-    await websocket.send_text(
-        json.dumps({
-            "type": "users_list",
-            "payload": users_list,
-            "timestamp": datetime.now().isoformat(),
-        })
-    )
+    send_message(connection, users_list_message(room))
 
     try:
         while True:
             # Получаем сообщение от клиента
-            data = await websocket.receive_text()
+            data = await receive_frame(websocket)
+            size = frame_size(data)
+            RECEIVED_BYTES.inc(size)
+            connection.touch()
+            if size > settings.WS_MAX_FRAME_BYTES:
+                # Не разбираем: до комнаты такой кадр не доходит
+                REJECTED_FRAMES.labels(reason="oversized").inc()
+                connection.abort(FRAME_TOO_BIG_CLOSE_CODE)
+                continue
 
             try:
-                message = json.loads(data)
-                message_type = message.get("type")
+                message = codec.decode(data)
+                if not is_well_formed(message):
+                    REJECTED_FRAMES.labels(reason="malformed").inc()
+                    continue
+                message_type = message["type"]
                 payload = message.get("payload", {})
+                MESSAGES_RECEIVED.labels(
+                    type=message_type if message_type in _COUNTED_MESSAGES else "other"
+                ).inc()
+
+                if not limits.admit(message_type, payload):
+                    if limits.exhausted:
+                        THROTTLE_DISCONNECTS.inc()
+                        connection.abort(POLICY_VIOLATION_CLOSE_CODE)
+                        continue
+                    if message_type == "sync_state":
+                        # Последнее состояние клиента применится, когда лимит позволит
+                        limits.deferred = payload
+                        if deferred_sync is None or deferred_sync.done():
+                            deferred_sync = asyncio.create_task(
+                                apply_deferred_sync(room, limits, user_id, history_key, account)
+                            )
+                    notice = limits.notice(message_type)
+                    if notice is not None:
+                        send_message(connection, notice)
+                    continue
 
-                # Обработка различных типов сообщений
                 if message_type == "sync_state":
-                    # Обновляем состояние комнаты
-                    room.state = payload
-                    # Отправляем всем остальным
-                    broadcast_to_room(room_id, message, exclude_user_id=user_id)
-
-                elif message_type in [
-                    "update_block",
-                    "add_block",
-                    "delete_block",
-                    "move_block",
-                    "update_theme",
-                    "update_header",
-                    "update_footer",
-                ]:
-                    # Обновляем состояние проекта на основе изменения
-                    if message_type == "update_block":
-                        block_id = payload.get("blockId")
-                        block_data = payload.get("data", {})
-
-                        def update_block_recursive(blocks_list):
-                            for block in blocks_list:
-                                if block.get("id") == block_id:
-                                    block.update(block_data)
-                                    return True
-                                # Проверяем вложенные блоки
-                                if block.get("type") == "container" and "children" in block:
-                                    if update_block_recursive(block["children"]):
-                                        return True
-                                if block.get("type") == "grid" and "cells" in block:
-                                    for cell in block["cells"]:
-                                        if cell.get("block") and update_block_recursive([cell["block"]]):
-                                            return True
-                            return False
-
-                        if "blocks" in room.state:
-                            update_block_recursive(room.state.get("blocks", []))
-
-                    elif message_type == "add_block":
-                        new_block = payload.get("block")
-                        if new_block:
-                            if "blocks" not in room.state:
-                                room.state["blocks"] = []
-                            room.state["blocks"].append(new_block)
-
-                    elif message_type == "delete_block":
-                        block_id = payload.get("blockId")
-
-                        def delete_block_recursive(blocks_list):
-                            for i, block in enumerate(blocks_list):
-                                if block.get("id") == block_id:
-                                    blocks_list.pop(i)
-                                    return True
-                                # Проверяем вложенные блоки
-                                if block.get("type") == "container" and "children" in block:
-                                    if delete_block_recursive(block["children"]):
-                                        return True
-                                if block.get("type") == "grid" and "cells" in block:
-                                    for cell in block["cells"]:
-                                        if cell.get("block") and cell["block"].get("id") == block_id:
-                                            cell["block"] = None
-                                            return True
-                                        if cell.get("block") and "children" in cell["block"]:
-                                            if delete_block_recursive(cell["block"]["children"]):
-                                                return True
-                            return False
-
-                        if "blocks" in room.state:
-                            delete_block_recursive(room.state.get("blocks", []))
-
-                    elif message_type == "move_block":
-                        from_index = payload.get("fromIndex")
-                        to_index = payload.get("toIndex")
-                        if "blocks" in room.state and isinstance(room.state["blocks"], list):
-                            blocks = room.state["blocks"]
-                            if 0 <= from_index < len(blocks) and 0 <= to_index < len(blocks):
-                                moved = blocks.pop(from_index)
-                                blocks.insert(to_index, moved)
-
-                    elif message_type == "update_theme":
-                        if "theme" not in room.state:
-                            room.state["theme"] = {}
-                        room.state["theme"].update(payload)
-
-                    elif message_type == "update_header":
-                        if "header" not in room.state:
-                            room.state["header"] = {}
-                        room.state["header"].update(payload)
-
-                    elif message_type == "update_footer":
-                        if "footer" not in room.state:
-                            room.state["footer"] = {}
-                        room.state["footer"].update(payload)
-
-                    # Отправляем обновленное состояние всем остальным
-                    broadcast_to_room(
-                        room_id,
-                        {
-                            "type": "sync_state",
-                            "payload": room.state,
-                            "timestamp": datetime.now().isoformat(),
-                        },
-                        exclude_user_id=user_id,
-                    )
-
-                elif message_type == "cursor_update":
-                    # Отправляем обновление курсора всем остальным
-                    broadcast_to_room(room_id, message, exclude_user_id=user_id)
+                    # Свежий sync_state прошел лимит — ожидающий устарел
+                    limits.deferred = None
+
+                if message_type in _WRITE_MESSAGES and not may_edit(room, user):
+                    # Комнату привязали к чужому проекту после входа участника
+                    REJECTED_FRAMES.labels(reason="forbidden").inc()
+                    connection.abort(POLICY_VIOLATION_CLOSE_CODE)
+                    continue
+
+                # Обработка различных типов сообщений
+                if message_type == "sync_state" or message_type in DOCUMENT_OPS or message_type in HISTORY_OPS:
+                    # Операцию применяет владелец комнаты и рассылает только ее саму
+                    # (дельту) с новой версией; sync_state заменяет состояние целиком
+                    await submit_op(room, message_type, payload, user_id, history=history_key, account=account)
+
+                elif message_type == "request_sync":
+                    # Клиент пропустил версии — досылаем их из журнала или снимком
+                    known = payload.get("version")
+                    if known != room.version:
+                        if isinstance(known, int) and connection.deltas:
+                            send_catch_up(room, connection, known, payload.get("epoch"))
+                        else:
+                            send_snapshot(room, connection)
+
+                elif message_type == "ping":
+                    # Heartbeat со стороны клиента
+                    send_message(connection, {"type": "pong", "timestamp": datetime.now().isoformat()})
+
+                elif message_type == "pong":
+                    # Клиент отвечает на heartbeat — его молчание теперь значит обрыв
+                    connection.answers_ping = True
+
+                elif message_type in PRESENCE_MESSAGES:
+                    # Запоминаем последнее состояние; рассылка — пакетом по тику
+                    if isinstance(payload, dict):
+                        room.presence.update(user_id, payload)
 
                 elif message_type == "save_project":
                     # Автосохранение проекта в БД
+                    project_data = payload.get("project")
+                    if user and not room.state and isinstance(project_data, dict):
+                        # Комната пуста — принимаем проект клиента как ее состояние
+                        await submit_op(room, "sync_state", project_data, user_id, wait=True, account=user.id)
+
                     if user and room.state:
                         project_id = payload.get("projectId")
-                        project_data = payload.get("project") or room.state
-                        
+                        project_data = project_data or to_json(room.state)
+
                         if project_id:
-                            # Обновляем существующий проект
-                            async with async_session_maker() as db:
-                                result = await db.execute(
-                                    select(Project).where(
-                                        Project.id == project_id,
-                                        Project.user_id == user.id,
-                                        Project.deleted_at.is_(None),
-                                    )
-                                )
-                                project = result.scalar_one_or_none()
-                                if project:
-                                    project.title = project_data.get("projectName", project.title)
-                                    project.data = project_data
-                                    db.add(project)
-                                    await db.commit()
-                                    # Отправляем подтверждение сохранения
-                                    await websocket.send_text(
-                                        json.dumps({
-                                            "type": "project_saved",
-                                            "payload": {
-                                                "projectId": project.id,
-                                            },
-                                            "timestamp": datetime.now().isoformat(),
-                                        })
-                                    )
+                            # Существующий проект пишется отложенно: не чаще раза в
+                            # WS_AUTOSAVE_INTERVAL_SECONDS, подтверждение — project_saved
+                            request_save(room, int(project_id), user.id)
                         else:
                             # Создаем новый проект, если его нет
                             async with async_session_maker() as db:
@@ -326,23 +1410,26 @@ async def websocket_endpoint(
                                 await db.commit()
                                 await db.refresh(new_project)
                                 # Отправляем ID нового проекта обратно клиенту
-                                await websocket.send_text(
-                                    json.dumps({
-                                        "type": "project_saved",
-                                        "payload": {
-                                            "projectId": new_project.id,
-                                        },
-                                        "timestamp": datetime.now().isoformat(),
-                                    })
-                                )
+                                send_message(connection, {
+                                    "type": "project_saved",
+                                    "payload": {
+                                        "projectId": new_project.id,
+                                    },
+                                    "timestamp": datetime.now().isoformat(),
+                                })
+                            request_save(room, new_project.id, user.id)
 
                 else:
                     # Игнорируем неизвестные типы сообщений
                     pass
 
-            except json.JSONDecodeError:
-                # Игнорируем некорректный JSON
-                pass
+            except FrameTooLarge:
+                # Сжатый кадр разжимается больше лимита — как слишком большой несжатый
+                REJECTED_FRAMES.labels(reason="oversized").inc()
+                connection.abort(FRAME_TOO_BIG_CLOSE_CODE)
+            except ValueError:
+                # Кадр не декодируется
+                REJECTED_FRAMES.labels(reason="malformed").inc()
             except Exception:
                 # Логируем, но продолжаем работу цикла
                 pass
@@ -351,6 +1438,81 @@ async def websocket_endpoint(
         remove_user_from_room(room_id, user_id)
     except Exception:
         remove_user_from_room(room_id, user_id)
+    finally:
+        if deferred_sync is not None:
+            deferred_sync.cancel()
+
+
+@router.websocket("/ws/rooms/{room_id}/view")
+async def spectator_endpoint(
+    websocket: WebSocket,
+    room_id: str,
+    token: str = Query(..., description="Токен просмотра из POST /rooms/{room_id}/view-token"),
+    encoding: Optional[str] = Query(None, description="Кодировка кадров: json, orjson или msgpack"),
+    compress: Optional[str] = Query(None, description="Сжатие больших кадров: zstd"),
+):
+    """WebSocket endpoint зрителя: только просмотр, без участия в комнате"""
+    await websocket.accept()
+    if draining:
+        await websocket.close(code=SERVICE_RESTART_CLOSE_CODE)
+        return
+    try:
+        claims = decode_token(token)
+    except Exception:
+        claims = {}
+    if claims.get("scope") != "view" or claims.get("room") != room_id:
+        await websocket.close(code=1008)
+        return
+
+    room = get_or_create_room(room_id)
+    # Токен мог быть выдан до того, как комнату привязали к чужому проекту
+    issuer = claims.get("issuer")
+    if not may_view(room, issuer, claims.get("project")):
+        await websocket.close(code=1008)
+        return
+    codec = get_codec(encoding, compress)
+    connection = Connection(
+        websocket,
+        snapshot=lambda: room.snapshot_frame(codec),
+        codec=codec,
+    )
+    connection.start()
+
+    spectator_id = f"view-{uuid.uuid4().hex[:12]}"
+    room.touch()
+    room.spectators.add(spectator_id, connection, issuer)
+    # Зритель тоже держит подписку на шину: операции владельца нужны ему для рассылки
+    await attach_room_to_bus(room)
+
+    try:
+        while True:
+            # Зритель ничего не меняет; входящие кадры — только pong и disconnect
+            await receive_frame(websocket)
+            connection.touch()
+            connection.answers_ping = True
+    except Exception:
+        pass
+    finally:
+        room.spectators.remove(spectator_id)
+        if not room.users and not room.spectators:
+            asyncio.create_task(detach_room_from_bus(room))
+
+
+@router.post("/rooms/{room_id}/view-token")
+async def issue_view_token(room_id: str, user: User = Depends(get_current_user)):
+    """Выдать токен просмотра комнаты; для комнаты проекта — только его владельцу.
+
+    Комнаты может не быть на этом воркере, поэтому токен несет выдавшего и
+    проект: права проверяются снова при подключении зрителя и при привязке
+    комнаты к проекту.
+    """
+    room = rooms.get(room_id)
+    if room is not None and not may_view(room, user.id):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нет доступа к комнате")
+    return {
+        "token": create_view_token(room_id, user.id, room.project_id if room is not None else None),
+        "expires_in": settings.WS_VIEW_TOKEN_TTL_SECONDS,
+    }
 
 
 @router.get("/rooms/{room_id}/info")
@@ -364,8 +1526,20 @@ async def get_room_info(room_id: str):
         "room_id": room_id,
         "users_count": len(room.users),
         "users": [
-            {"id": uid, "name": user_data["name"]}
+            {
+                "id": uid,
+                "name": user_data["name"],
+                "send_queue_depth": user_data["conn"].depth,
+            }
             for uid, user_data in room.users.items()
         ],
         "has_state": bool(room.state),
+        "version": room.version,
+        "is_owner": room.is_owner,
+        "inbox_depth": len(room.inbox),
+        "op_latency_ms": round(room.op_latency * 1000, 3),
+        "remote_users_count": len(room.remote_users),
+        "undo_entries": len(room.history),
+        "undo_users": room.history.users,
+        "spectators_count": len(room.spectators),
     }
\ No newline at end of file
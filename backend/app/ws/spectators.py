@@ -0,0 +1,100 @@
+"""Зрители комнаты: живой просмотр лендинга без участия в редактировании.
+
+Зритель подключается к ``/ws/rooms/{room_id}/view`` с токеном просмотра
+(``scope: view``, выдается ``POST /rooms/{room_id}/view-token``). В отличие
+от участника он:
+
+* не попадает в ``users_list`` и не вызывает ``join``/``leave``;
+* не получает курсоры и выделения (рассылка присутствия идет только
+  участникам);
+* ничего не отправляет в комнату — входящие кадры игнорируются;
+* получает документ не на каждую операцию, а не чаще
+  ``WS_SPECTATOR_RATE_HZ`` раз в секунду: изменения с прошлой рассылки
+  приходят одним ``catch_up`` (операции с версиями; уже известные клиенту
+  версии пропускаются) или одним ``sync_state``, если журнал их уже не
+  хранит.
+
+Кадр рассылки кодируется один раз на кодек и общий для всех зрителей,
+поэтому сотни зрителей стоят одной кодировки и постановки в их очереди.
+"""
+import asyncio
+from typing import TYPE_CHECKING, Dict, Optional
+
+from app.core.config import settings
+from app.ws.connection import Connection, message_kind
+from app.ws.metrics import SPECTATOR_FRAMES, SPECTATORS
+
+if TYPE_CHECKING:
+    from app.ws.rooms import Room
+
+
+class SpectatorFeed:
+    def __init__(self, room: "Room", rate_hz: Optional[float] = None):
+        self.room = room
+        self.interval = 1.0 / (rate_hz or settings.WS_SPECTATOR_RATE_HZ)
+        # spectator_id → соединение зрителя
+        self.connections: Dict[str, Connection] = {}
+        # spectator_id → аккаунт, выдавший токен просмотра (см. may_view)
+        self.issuers: Dict[str, Optional[int]] = {}
+        # Последняя версия (и ее epoch), разосланная зрителям
+        self.version = 0
+        self.epoch: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def add(self, spectator_id: str, connection: Connection, issuer: Optional[int] = None) -> None:
+        """Подключить зрителя: он сразу получает снимок, дальше — вместе со всеми по тику"""
+        self.connections[spectator_id] = connection
+        self.issuers[spectator_id] = issuer
+        SPECTATORS.inc()
+        if self.room.state:
+            connection.send(self.room.snapshot_frame(connection.codec), message_kind("sync_state"))
+            if self.epoch is None:
+                self.version, self.epoch = self.room.version, self.room.epoch
+
+    def remove(self, spectator_id: str) -> None:
+        connection = self.connections.pop(spectator_id, None)
+        self.issuers.pop(spectator_id, None)
+        if connection is None:
+            return
+        connection.close()
+        SPECTATORS.dec()
+        if not self.connections:
+            self.close()
+
+    def notify(self) -> None:
+        """Комната получила новую версию: разослать ее не раньше следующего тика"""
+        if self.connections and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._tick())
+
+    def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    def flush(self) -> None:
+        """Разослать зрителям все изменения с прошлой рассылки одним кадром"""
+        room = self.room
+        if not room.state or (room.version, room.epoch) == (self.version, self.epoch):
+            return
+        # Сменился epoch (снимок от владельца) или журнал ушел вперед — придет sync_state
+        message = room.catch_up_message(self.version, self.epoch)
+        self.version, self.epoch = room.version, room.epoch
+        kind = message_kind(message["type"])
+        frames = {}
+        for spectator_id, connection in list(self.connections.items()):
+            frame = frames.get(connection.codec)
+            if frame is None:
+                codec = connection.codec
+                frame = frames[codec] = (
+                    room.snapshot_frame(codec) if message["type"] == "sync_state" else codec.encode(message)
+                )
+            if not connection.send(frame, kind):
+                self.remove(spectator_id)
+        SPECTATOR_FRAMES.inc(len(self.connections))
+
+    async def _tick(self) -> None:
+        await asyncio.sleep(self.interval)
+        self.flush()
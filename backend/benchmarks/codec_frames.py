@@ -0,0 +1,69 @@
+"""Бенчмарк кодеков кадров WebSocket на начальной синхронизации.
+
+Для sync_state лендинга из N блоков сравнивает размер кадра и время
+кодирования/разбора у доступных кодеков: stdlib ``json.dumps`` (прежний
+путь), текстовый JSON через ``Codec`` (orjson, если установлен), orjson
+bytes, MessagePack и их варианты со сжатием zstd. Кодеки, для которых не
+установлены библиотеки, пропускаются.
+
+Запуск (из каталога backend):
+
+    python -m benchmarks.codec_frames --blocks 1000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.ws.codec import Codec, CodecUnavailable  # noqa: E402
+from app.ws.document import json_default  # noqa: E402
+from app.ws.rooms import Room  # noqa: E402
+from benchmarks.room_broadcast_bytes import build_landing  # noqa: E402
+
+
+def measure(encode, decode, message: dict, repeat: int) -> tuple:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        frame = encode(message)
+    encoded = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(repeat):
+        decode(frame)
+    decoded = time.perf_counter() - started
+    size = len(frame.encode("utf-8")) if isinstance(frame, str) else len(frame)
+    return size, encoded / repeat, decoded / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    room = Room("bench-codec")
+    room.replace_state(build_landing(args.blocks))
+    message = room.snapshot_message()
+
+    rows = [("stdlib json", measure(lambda m: json.dumps(m, default=json_default), json.loads, message, args.repeat))]
+    for encoding in ("json", "orjson", "msgpack"):
+        for compression in (None, "zstd"):
+            try:
+                codec = Codec(encoding, compression)
+            except CodecUnavailable as exc:
+                print(f"skip {encoding}{'+' + compression if compression else ''}: {exc}")
+                continue
+            rows.append((codec.name, measure(codec.encode, codec.decode, message, args.repeat)))
+
+    print(f"sync_state of {args.blocks} blocks")
+    print(f"{'codec':14} {'frame KiB':>10} {'encode ms':>10} {'decode ms':>10}")
+    for name, (size, encoded, decoded) in rows:
+        print(f"{name:14} {size / 1024:10.1f} {encoded * 1000:10.2f} {decoded * 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Бенчмарк пропускной способности движка операций комнаты.
+
+Применяет операции к лендингу из N блоков так же, как владелец комнаты:
+``BlockTreeCRDT.prepare`` + ``apply`` со штампом на модели документа
+(``app.ws.document``).
+
+Смеси операций: ``update`` (правки текста и стилей), ``move`` (перестановки
+корневых блоков) и ``mixed`` (правки, перемещения, добавления, удаления).
+
+Колонка ``batch`` — те же операции пакетами из одной операции через
+``Room.apply_op("batch", ...)``: атомарность пакета (журнал отката движка)
+не должна стоить порядков относительно одиночной операции.
+
+Запуск (из каталога backend):
+
+    python -m benchmarks.crdt_throughput --blocks 1000 --ops 20000
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.ws.block_index import BlockIndex  # noqa: E402
+from app.ws.crdt import BlockTreeCRDT  # noqa: E402
+from app.ws.document import from_json  # noqa: E402
+from app.ws.rooms import Room  # noqa: E402
+from benchmarks.room_broadcast_bytes import build_landing  # noqa: E402
+
+
+def generate_ops(state: dict, mix: str, count: int, seed: int = 7) -> list:
+    """Операции в пользовательской форме (перемещения — устаревшей формой по индексам)"""
+    rng = random.Random(seed)
+    root_ids = [block["id"] for block in state["blocks"]]
+    text_ids = [bid for bid in root_ids if bid.startswith("text-")]
+    ops = []
+    for n in range(count):
+        roll = rng.random()
+        if mix == "update" or (mix == "mixed" and roll < 0.7):
+            if rng.random() < 0.5:
+                data = {"content": f"edit {n}"}
+            else:
+                data = {"style": {"color": rng.choice(["#111111", "#222222", "#333333"])}}
+            ops.append(("update_block", {"blockId": rng.choice(text_ids), "data": data}))
+        elif mix == "move" or roll < 0.9:
+            from_index = rng.randrange(len(root_ids))
+            to_index = rng.randrange(len(root_ids))
+            ops.append(("move_block", {"fromIndex": from_index, "toIndex": to_index}))
+        elif roll < 0.95:
+            ops.append(("add_block", {"block": {"id": f"new-{n}", "type": "text", "content": ""}}))
+            root_ids.append(f"new-{n}")
+        else:
+            ops.append(("delete_block", {"blockId": f"new-{n - 1}"}))
+    return ops
+
+
+def run_crdt(state: dict, ops: list) -> float:
+    index = BlockIndex()
+    index.rebuild(state)
+    engine = BlockTreeCRDT(state, index)
+    started = time.perf_counter()
+    for version, (op_type, payload) in enumerate(ops, start=1):
+        prepared = engine.prepare(op_type, payload)
+        if prepared is not None:
+            engine.apply(op_type, prepared, (version, "bench"))
+    return time.perf_counter() - started
+
+
+def run_batches(state: dict, ops: list) -> float:
+    room = Room("bench")
+    room.replace_state(state)
+    started = time.perf_counter()
+    for op_type, payload in ops:
+        room.apply_op("batch", [{"type": op_type, "payload": payload}], "bench")
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=20000)
+    args = parser.parse_args()
+
+    landing = build_landing(args.blocks)
+    print(f"{args.blocks} blocks, {args.ops} ops per mix")
+    print(f"{'mix':8} {'crdt ops/s':>14} {'batch ops/s':>14}")
+    for mix in ("update", "move", "mixed"):
+        ops = generate_ops(landing, mix, args.ops)
+        crdt = run_crdt(from_json(landing), copy.deepcopy(ops))
+        batches = run_batches(copy.deepcopy(landing), copy.deepcopy(ops))
+        print(f"{mix:8} {args.ops / crdt:14,.0f} {args.ops / batches:14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
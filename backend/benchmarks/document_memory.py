@@ -0,0 +1,123 @@
+"""Бенчмарк памяти и скорости модели документа комнаты.
+
+Прогоняет состояние лендинга из N блоков через комнату в четырех вариантах:
+
+* dict — дерево ``json.loads`` без модели, каждый снимок кодируется
+  заново (как до модели документа);
+* model — каждый sync_state сразу переводится в модель
+  (``app.ws.document.from_json``), каждый снимок кодируется заново;
+* hot — как сейчас в комнате, которую правят: sync_state хранится
+  деревом dict, снимок одной версии кодируется один раз
+  (``Room.snapshot_frame``);
+* compacted — как сейчас в затихшей комнате: состояние переведено в
+  модель ``Room.compact``, снимок тоже берется из кэша кадров.
+
+Печатает память дерева (tracemalloc: все, что выделено при построении и
+живо после него), время sync_state (разбор кадра и ``replace_state``;
+для compacted — время ``compact``), одного кодирования снимка и отправки
+снимка одной версии ``--receivers`` соединениям (присоединения,
+переподключения после деплоя, клиенты без дельт).
+
+Запуск (из каталога backend):
+
+    python -m benchmarks.document_memory --blocks 1000
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.ws.codec import get_codec  # noqa: E402
+from app.ws.document import from_json  # noqa: E402
+from app.ws.rooms import Room  # noqa: E402
+from benchmarks.room_broadcast_bytes import build_landing  # noqa: E402
+
+
+def retained(build) -> tuple:
+    """Построить дерево; вернуть (дерево, живые байты)"""
+    gc.collect()
+    tracemalloc.start()
+    tree = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tree, size
+
+
+def timed(action, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        action()
+    return (time.perf_counter() - started) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--receivers", type=int, default=20, help="соединений, получающих снимок одной версии")
+    args = parser.parse_args()
+
+    # Так состояние приходит в комнату: текст кадра sync_state
+    text = json.dumps(build_landing(args.blocks))
+    codec = get_codec()
+
+    def send_each(room: Room) -> None:
+        for _ in range(args.receivers):
+            codec.encode(room.snapshot_message())
+
+    def send_cached(room: Room) -> None:
+        # Новая версия: первый получатель кодирует, остальные берут готовый кадр
+        room.snapshot_key = None
+        for _ in range(args.receivers):
+            room.snapshot_frame(codec)
+
+    def compact(room: Room) -> None:
+        room.compacted = False
+        room.compact()
+
+    print(f"landing of {args.blocks} blocks, {len(text) / 1024:.0f} KiB JSON")
+    print(
+        f"{'repr':10} {'memory KiB':>11} {'sync ms':>8} {'encode ms':>10} "
+        f"{f'send x{args.receivers} ms':>14}"
+    )
+    rows = {}
+    dict_tree, dict_size = retained(lambda: json.loads(text))
+    model_tree, model_size = retained(lambda: from_json(json.loads(text)))
+    del dict_tree, model_tree
+    for name, size, prepare, sync, send in (
+        ("dict", dict_size, None, lambda room: room.replace_state(json.loads(text)), send_each),
+        ("model", model_size, None, lambda room: room.replace_state(from_json(json.loads(text))), send_each),
+        ("hot", dict_size, None, lambda room: room.replace_state(json.loads(text)), send_cached),
+        ("compacted", model_size, lambda room: room.replace_state(json.loads(text)), compact, send_cached),
+    ):
+        room = Room("bench")
+        if prepare is not None:
+            prepare(room)
+        # Время — без tracemalloc, он замедляет каждое выделение
+        elapsed = timed(lambda: sync(room), args.repeat)
+        encode = timed(lambda: codec.encode(room.state), args.repeat)
+        fanout = timed(lambda: send(room), args.repeat)
+        rows[name] = (elapsed, fanout)
+        print(
+            f"{name:10} {size / 1024:11.0f} {elapsed * 1000:8.2f} {encode * 1000:10.2f} "
+            f"{fanout * 1000:14.2f}"
+        )
+        room.close()
+    print(f"model uses {1 - model_size / dict_size:.0%} less memory")
+    print(
+        f"sync_state: hot is {rows['hot'][0] / rows['model'][0]:.2f}x model; "
+        f"a snapshot for {args.receivers} receivers: hot is {rows['hot'][1] / rows['dict'][1]:.2f}x dict, "
+        f"compacted is {rows['compacted'][1] / rows['dict'][1]:.2f}x dict"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Бенчмарк списка проектов: загрузка ORM-объектов против проекции колонок.
+
+Заполняет базу U пользователями по P проектов с лендингом из N блоков в
+data и измеряет запрос списка одного пользователя:
+
+* before — старый запрос ``select(Project)``: каждая строка тянет весь
+  JSON лендинга и разбирается в ORM-объект;
+* after — ``project_list_query``: только id, title, preview_url и
+  updated_at, все проекты одним запросом;
+* page / deep page — страница ``--limit`` с начала списка и по курсору
+  из его середины (без OFFSET, по индексу ``(user_id, updated_at, id)``).
+
+По умолчанию база — временный файл SQLite; для PostgreSQL передайте
+``--database-url`` (таблица projects в ней будет заполнена тестовыми
+данными).
+
+Запуск (из каталога backend):
+
+    python -m benchmarks.project_list --projects 500 --blocks 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+
+# Порядок как в main: пакет auth до роутеров API, иначе цикл импорта
+import app.auth  # noqa: E402,F401
+from app.api.v1.projects import encode_cursor, project_list_query  # noqa: E402
+from app.core.database import Base  # noqa: E402
+from app.models import Project, User  # noqa: E402
+from benchmarks.room_broadcast_bytes import build_landing  # noqa: E402
+
+
+async def seed(engine, users: int, projects: int, blocks: int) -> int:
+    """Заполнить базу; вернуть id пользователя, чей список измеряется"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), [
+            {"username": f"bench{i}", "email": f"bench{i}@example.com", "password_hash": "-"}
+            for i in range(users)
+        ])
+        user_ids = (await conn.execute(select(User.id).order_by(User.id))).scalars().all()
+        landing = build_landing(blocks)
+        started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for user_id in user_ids:
+            await conn.execute(insert(Project), [
+                {
+                    "user_id": user_id,
+                    "title": f"Landing {i}",
+                    "data": landing,
+                    "is_public": False,
+                    "updated_at": started + timedelta(minutes=i),
+                }
+                for i in range(projects)
+            ])
+    return user_ids[0]
+
+
+async def timed(engine, query, repeat: int) -> tuple:
+    """Среднее время запроса в мс и число строк"""
+    rows = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        async with engine.connect() as conn:
+            rows = (await conn.execute(query)).all()
+    return (time.perf_counter() - started) / repeat * 1000, len(rows)
+
+
+async def timed_orm(engine, user_id: int, repeat: int) -> tuple:
+    """Старый запрос: ORM-объекты Project целиком, с data"""
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    query = (
+        select(Project)
+        .where(Project.user_id == user_id, Project.deleted_at.is_(None))
+        .order_by(Project.updated_at.desc())
+    )
+    projects = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        async with session_maker() as session:
+            projects = (await session.execute(query)).scalars().all()
+    return (time.perf_counter() - started) / repeat * 1000, len(projects)
+
+
+async def run(args) -> None:
+    database_url = args.database_url
+    if database_url is None:
+        database_url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'projects_bench.db')}"
+    engine = create_async_engine(database_url)
+    try:
+        user_id = await seed(engine, args.users, args.projects, args.blocks)
+
+        # Курсор из середины списка: страница после половины проектов
+        async with engine.connect() as conn:
+            middle = (await conn.execute(project_list_query(user_id, args.projects // 2))).all()[-2]
+        cursor = encode_cursor(middle.updated_at, middle.id)
+
+        print(f"{args.users} users x {args.projects} projects, landing of {args.blocks} blocks in data")
+        print(f"{'query':10} {'rows':>6} {'ms':>9}")
+        for name, result in (
+            ("before", await timed_orm(engine, user_id, args.repeat)),
+            ("after", await timed(engine, project_list_query(user_id), args.repeat)),
+            ("page", await timed(engine, project_list_query(user_id, args.limit), args.repeat)),
+            ("deep page", await timed(engine, project_list_query(user_id, args.limit, cursor), args.repeat)),
+        ):
+            elapsed, rows = result
+            print(f"{name:10} {rows:6} {elapsed:9.2f}")
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--projects", type=int, default=500, help="проектов на пользователя")
+    parser.add_argument("--blocks", type=int, default=200, help="блоков в лендинге каждого проекта")
+    parser.add_argument("--limit", type=int, default=20, help="размер страницы")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--database-url", default=None, help="по умолчанию — временная база SQLite")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Бенчмарк исходящего трафика комнаты: полный sync_state против дельт.
+
+Моделирует лендинг из N блоков и M редакторов, каждый из которых делает
+R правок в секунду (update_block). Для каждой правки считаем байты, которые
+сервер отправляет всем участникам комнаты:
+
+* before — старый протокол: после каждой операции всем остальным уходит
+  полный sync_state;
+* after — дельта-протокол: остальным уходит сама операция с версией,
+  отправителю — короткий op_ack.
+
+Запуск (из каталога backend):
+
+    python -m benchmarks.room_broadcast_bytes --blocks 200 --editors 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from datetime import datetime
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.ws import rooms as rooms_module  # noqa: E402
+from app.ws.connection import Connection  # noqa: E402
+from app.ws.document import json_default  # noqa: E402
+from app.ws.rooms import Room, broadcast_to_room, send_message  # noqa: E402
+
+
+class _ClientState:
+    name = "CONNECTED"
+
+
+class CountingWebSocket:
+    """Заглушка WebSocket, которая только считает отправленные байты"""
+
+    client_state = _ClientState()
+
+    def __init__(self) -> None:
+        self.bytes_sent = 0
+        self.frames_sent = 0
+
+    async def send_text(self, data: str) -> None:
+        self.bytes_sent += len(data.encode("utf-8"))
+        self.frames_sent += 1
+
+    async def send_bytes(self, data: bytes) -> None:
+        self.bytes_sent += len(data)
+        self.frames_sent += 1
+
+
+def build_landing(blocks_count: int) -> dict:
+    """Лендинг с текстовыми блоками, контейнерами и сетками"""
+    blocks = []
+    for i in range(blocks_count):
+        if i % 10 == 5:
+            blocks.append({
+                "id": f"container-{i}",
+                "type": "container",
+                "style": {"padding": "16px", "display": "flex", "flexDirection": "row"},
+                "children": [
+                    {"id": f"text-{i}-{j}", "type": "text", "content": "Lorem ipsum " * 8,
+                     "style": {"color": "#111111", "fontSize": "16px"}}
+                    for j in range(3)
+                ],
+            })
+        elif i % 10 == 7:
+            blocks.append({
+                "id": f"grid-{i}",
+                "type": "grid",
+                "style": {"padding": "8px"},
+                "settings": {"columns": 2, "rows": 1, "gapX": 8, "gapY": 8},
+                "cells": [
+                    {"block": {"id": f"image-{i}-{j}", "type": "image",
+                               "url": "https://example.com/image.png", "alt": "", "style": {}}}
+                    for j in range(2)
+                ],
+            })
+        else:
+            blocks.append({
+                "id": f"text-{i}",
+                "type": "text",
+                "content": "Sed ut perspiciatis unde omnis iste natus error " * 4,
+                "style": {"color": "#333333", "fontSize": "18px", "textAlign": "left"},
+            })
+    return {
+        "projectName": "Benchmark landing",
+        "header": {"companyName": "Bench", "backgroundColor": "#ffffff"},
+        "footer": {"text": "© Bench"},
+        "theme": {"mode": "light", "accent": "#ff0000", "text": "#000000"},
+        "blocks": blocks,
+    }
+
+
+def edit_ops(state: dict, count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    text_ids = [b["id"] for b in state["blocks"] if b["type"] == "text"]
+    return [
+        {"blockId": rng.choice(text_ids), "data": {"content": f"edit {n} " + "x" * rng.randint(1, 40)}}
+        for n in range(count)
+    ]
+
+
+def bytes_before(state: dict, ops: list, editors: int) -> int:
+    """Старый протокол: полный sync_state всем, кроме автора, после каждой правки"""
+    room = Room("bench-before")
+    room.replace_state(json.loads(json.dumps(state)))
+    total = 0
+    for payload in ops:
+        room.apply_op("update_block", payload, "bench")
+        frame = json.dumps({
+            "type": "sync_state",
+            "payload": room.state,
+            "timestamp": datetime.now().isoformat(),
+        }, default=json_default)
+        total += len(frame.encode("utf-8")) * (editors - 1)
+    return total
+
+
+async def bytes_after(state: dict, ops: list, editors: int) -> int:
+    """Дельта-протокол: операция с версией всем, кроме автора, и op_ack автору"""
+    room = rooms_module.get_or_create_room("bench-after")
+    room.replace_state(json.loads(json.dumps(state)))
+    sockets = []
+    for i in range(editors):
+        ws = CountingWebSocket()
+        conn = Connection(ws)
+        conn.start()
+        sockets.append(ws)
+        room.users[f"user-{i}"] = {"id": f"user-{i}", "name": f"Editor {i}", "ws": ws, "conn": conn}
+
+    for n, payload in enumerate(ops):
+        author = f"user-{n % editors}"
+        room.apply_op("update_block", payload, author)
+        version = room.version
+        broadcast_to_room(
+            room.room_id,
+            {
+                "type": "update_block",
+                "payload": payload,
+                "version": version,
+                "userId": author,
+                "timestamp": datetime.now().isoformat(),
+            },
+            exclude_user_id=author,
+        )
+        send_message(room.users[author]["conn"], {
+            "type": "op_ack",
+            "payload": {"version": version},
+            "timestamp": datetime.now().isoformat(),
+        })
+        # Даем отработать writer-задачам
+        await asyncio.sleep(0)
+
+    for user_data in room.users.values():
+        await user_data["conn"].drain()
+        user_data["conn"].close()
+    rooms_module.rooms.pop(room.room_id, None)
+    return sum(ws.bytes_sent for ws in sockets)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=200)
+    parser.add_argument("--editors", type=int, default=10)
+    parser.add_argument("--edits-per-sec", type=float, default=2.0, help="правок в секунду на одного редактора")
+    parser.add_argument("--seconds", type=int, default=10)
+    args = parser.parse_args()
+
+    state = build_landing(args.blocks)
+    ops_count = int(args.editors * args.edits_per_sec * args.seconds)
+    ops = edit_ops(state, ops_count)
+
+    before = bytes_before(state, ops, args.editors)
+    after = asyncio.run(bytes_after(state, ops, args.editors))
+
+    state_size = len(json.dumps(state).encode("utf-8"))
+    print(f"state size:        {state_size / 1024:.1f} KiB ({args.blocks} blocks)")
+    print(f"editors:           {args.editors}, {args.edits_per_sec} edits/s each, {ops_count} ops")
+    print(f"before (sync_state): {before / args.seconds / 1024:10.1f} KiB/s per room")
+    print(f"after  (delta ops):  {after / args.seconds / 1024:10.1f} KiB/s per room")
+    print(f"reduction:         x{before / max(after, 1):.0f}")
+
+
+if __name__ == "__main__":
+    main()
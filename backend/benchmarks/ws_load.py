@@ -0,0 +1,320 @@
+"""Нагрузочный генератор комнат WebSocket.
+
+Открывает N комнат по M редакторов и воспроизводит смесь действий
+реального редактирования: поток курсоров, правки текста и стилей блоков,
+перестановки блоков и сохранения проекта. В конце печатает:
+
+* задержку «операция → соседи» (p50/p99) для правок блоков и для курсоров —
+  от отправки автором до получения каждым другим участником комнаты;
+* отправленные операции и полученные кадры в секунду;
+* память процесса на комнату (только для сервера в этом же процессе) и
+  размер состояния комнаты.
+
+По умолчанию приложение поднимается в этом же процессе (uvicorn в
+отдельном потоке, только роутер комнат) и внешних сервисов не нужно:
+пользователь токена и запись проекта при сохранении подменяются
+заглушками. С ``--url`` нагрузка идет на запущенный сервер; сохранения
+тогда работают, только если передан ``--token`` реального пользователя.
+
+Запуск (из каталога backend):
+
+    python -m benchmarks.ws_load --rooms 10 --editors 5 --seconds 20
+    python -m benchmarks.ws_load --url ws://localhost:8000 --rooms 2 --editors 3
+
+Редакторы подключаются с ``?protocol=delta`` и получают правки соседей
+операциями; ``--protocol full`` — как клиенты без дельт, которым после
+правок приходит полный ``sync_state`` (задержка правки считается по первому
+состоянию, где виден ее маркер).
+
+С ``--max-p99-ms`` скрипт завершается с кодом 1, если p99 правок выше
+порога или ни одна доставка правки не измерена, — так регрессии в
+``app/ws`` видны до деплоя.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+import websockets  # noqa: E402
+
+from benchmarks.room_broadcast_bytes import build_landing  # noqa: E402
+
+BENCH_TOKEN = "bench-token"
+BENCH_PROJECT_ID = 1
+
+
+class Stats:
+    """Общие счетчики всех редакторов: отправители и получатели в одном процессе"""
+
+    def __init__(self) -> None:
+        self.sent: Dict[str, int] = defaultdict(int)
+        self.frames_received = 0
+        # Маркер правки/курсора → время отправки
+        self.sent_at: Dict[str, float] = {}
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors = 0
+
+    def mark(self, marker: str) -> None:
+        self.sent_at[marker] = time.perf_counter()
+
+    def observe(self, kind: str, marker: Optional[str]) -> None:
+        started = self.sent_at.get(marker) if marker else None
+        if started is not None:
+            self.latencies[kind].append(time.perf_counter() - started)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Editor:
+    def __init__(self, url: str, room_id: str, number: int, landing: dict, args, stats: Stats):
+        self.url = url
+        self.room_id = room_id
+        self.number = number
+        self.name = f"{room_id}-editor-{number}"
+        self.landing = landing
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(f"{room_id}:{number}")
+        self.root_ids = [block["id"] for block in landing["blocks"]]
+        self.text_ids = [block["id"] for block in landing["blocks"] if block["type"] == "text"]
+        self.seq = 0
+        # Маркеры правок, уже найденные в полученных sync_state (--protocol full)
+        self.seen: set = set()
+
+    async def run(self, ready: asyncio.Event, deadline: float) -> None:
+        query = f"name={self.name}"
+        if self.args.protocol == "delta":
+            query += "&protocol=delta"
+        if self.args.token:
+            query += f"&token={self.args.token}"
+        async with websockets.connect(f"{self.url}/ws/rooms/{self.room_id}?{query}", max_size=None) as ws:
+            reader = asyncio.create_task(self._read(ws))
+            if self.number == 0:
+                await self._send(ws, "sync_state", self.landing)
+            ready.set()
+            try:
+                await self._act(ws, deadline)
+            finally:
+                reader.cancel()
+
+    async def _act(self, ws, deadline: float) -> None:
+        actions = [
+            ("cursor_update", self.args.cursor_hz),
+            ("update_block", self.args.edits_per_sec),
+            ("move_block", self.args.moves_per_sec),
+            ("save_project", self.args.saves_per_sec),
+        ]
+        actions = [(kind, rate) for kind, rate in actions if rate > 0]
+        total_rate = sum(rate for _, rate in actions)
+        kinds = [kind for kind, _ in actions]
+        weights = [rate for _, rate in actions]
+        while time.perf_counter() < deadline:
+            # Пуассоновский поток действий с суммарной частотой total_rate
+            await asyncio.sleep(self.rng.expovariate(total_rate))
+            kind = self.rng.choices(kinds, weights)[0]
+            self.seq += 1
+            marker = f"{self.name}:{self.seq}"
+            if kind == "cursor_update":
+                self.stats.mark(marker)
+                payload = {
+                    "userId": self.name,
+                    "userName": self.name,
+                    "x": self.rng.randint(0, 1440),
+                    "y": self.rng.randint(0, 4000),
+                    "marker": marker,
+                }
+            elif kind == "update_block":
+                self.stats.mark(marker)
+                if self.rng.random() < 0.7:
+                    data = {"content": marker}
+                else:
+                    data = {"content": marker, "style": {"color": self.rng.choice(["#111", "#222", "#333"])}}
+                payload = {"blockId": self.rng.choice(self.text_ids), "data": data}
+            elif kind == "move_block":
+                block_id = self.rng.choice(self.root_ids)
+                after_id = self.rng.choice([None] + self.root_ids)
+                payload = {"blockId": block_id, "afterId": after_id if after_id != block_id else None}
+            else:
+                payload = {"projectId": BENCH_PROJECT_ID}
+            await self._send(ws, kind, payload)
+
+    async def _send(self, ws, kind: str, payload) -> None:
+        await ws.send(json.dumps({"type": kind, "payload": payload}))
+        self.stats.sent[kind] += 1
+
+    async def _read(self, ws) -> None:
+        try:
+            async for frame in ws:
+                self.stats.frames_received += 1
+                message = json.loads(frame)
+                kind = message.get("type")
+                if kind == "update_block":
+                    self.stats.observe("edit", message["payload"].get("data", {}).get("content"))
+                elif kind == "sync_state" and self.args.protocol == "full":
+                    # Без дельт правка приходит в полном состоянии, пока ее не перезапишут
+                    for block in message["payload"].get("blocks", []):
+                        marker = block.get("content")
+                        if marker not in self.seen and not str(marker).startswith(f"{self.name}:"):
+                            self.seen.add(marker)
+                            self.stats.observe("edit", marker)
+                elif kind == "presence":
+                    for cursor in message["payload"].get("cursors", []):
+                        if cursor.get("userId") != self.name:
+                            self.stats.observe("cursor", cursor.get("marker"))
+        except websockets.ConnectionClosed:
+            pass
+        except Exception:
+            self.stats.errors += 1
+
+
+def start_in_process_server():
+    """Поднять роутер комнат в uvicorn в отдельном потоке; БД и токены — заглушки"""
+    from types import SimpleNamespace
+
+    import uvicorn
+    from fastapi import FastAPI
+
+    from app.ws import autosave
+    from app.ws import rooms as rooms_module
+
+    saves = []
+
+    async def fake_user(token: str):
+        return SimpleNamespace(id=1) if token == BENCH_TOKEN else None
+
+    async def fake_persist(project_id: int, user_id: int, state: dict) -> bool:
+        # Задержка, сравнимая с UPDATE в локальном PostgreSQL
+        await asyncio.sleep(0.005)
+        saves.append(project_id)
+        return True
+
+    rooms_module.get_user_from_token = fake_user
+    autosave.persist_project_state = fake_persist
+
+    app = FastAPI()
+    app.include_router(rooms_module.router)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="off"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"ws://127.0.0.1:{port}", rooms_module, saves
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Не Linux: только пиковое значение
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def run_load(url: str, args, stats: Stats) -> float:
+    landing = build_landing(args.blocks)
+    started = time.perf_counter()
+    deadline = started + args.seconds
+    tasks = []
+    for room_number in range(args.rooms):
+        room_id = f"load-{room_number}"
+        ready = asyncio.Event()
+        first = Editor(url, room_id, 0, landing, args, stats)
+        tasks.append(asyncio.create_task(first.run(ready, deadline)))
+        # Остальные подключаются, когда в комнате уже есть состояние
+        await ready.wait()
+        for number in range(1, args.editors):
+            editor = Editor(url, room_id, number, landing, args, stats)
+            tasks.append(asyncio.create_task(editor.run(asyncio.Event(), deadline)))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    stats.errors += sum(1 for result in results if isinstance(result, Exception))
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="ws://host:port запущенного сервера; без него — сервер в этом процессе")
+    parser.add_argument("--token", help="JWT для сохранений при --url")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--editors", type=int, default=5, help="редакторов в комнате")
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--blocks", type=int, default=200, help="блоков в лендинге комнаты")
+    parser.add_argument("--cursor-hz", type=float, default=20.0, help="курсоров в секунду на редактора")
+    parser.add_argument("--edits-per-sec", type=float, default=2.0)
+    parser.add_argument("--moves-per-sec", type=float, default=0.2)
+    parser.add_argument("--saves-per-sec", type=float, default=0.05)
+    parser.add_argument(
+        "--protocol", choices=("delta", "full"), default="delta",
+        help="delta — правки соседей операциями, full — полным sync_state",
+    )
+    parser.add_argument("--max-p99-ms", type=float, help="код выхода 1, если p99 правок выше порога")
+    args = parser.parse_args()
+
+    server = None
+    rooms_module = None
+    saves: list = []
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        server, thread, url, rooms_module, saves = start_in_process_server()
+        args.token = args.token or BENCH_TOKEN
+    rss_before = rss_bytes()
+
+    stats = Stats()
+    elapsed = asyncio.run(run_load(url, args, stats))
+
+    print(f"{args.rooms} rooms x {args.editors} editors, {args.blocks} blocks, {elapsed:.1f} s")
+    sent = sum(stats.sent.values())
+    print(f"ops sent:          {sent / elapsed:10.0f} /s  " + ", ".join(
+        f"{kind} {count}" for kind, count in sorted(stats.sent.items())
+    ))
+    print(f"frames received:   {stats.frames_received / elapsed:10.0f} /s")
+    for kind in ("edit", "cursor"):
+        values = stats.latencies[kind]
+        print(
+            f"{kind:6} to peer:    p50 {percentile(values, 0.5) * 1000:7.2f} ms"
+            f"   p99 {percentile(values, 0.99) * 1000:7.2f} ms   ({len(values)} deliveries)"
+        )
+    if rooms_module is not None:
+        live_rooms = list(rooms_module.rooms.values())
+        state_bytes = sum(room.estimate_state_bytes() for room in live_rooms)
+        print(f"memory per room:   {(rss_bytes() - rss_before) / max(len(live_rooms), 1) / 1024:10.0f} KiB RSS "
+              f"(server and clients), state {state_bytes / max(len(live_rooms), 1) / 1024:.0f} KiB")
+        print(f"saves persisted:   {len(saves):10d} (DB mocked)")
+    if stats.errors:
+        print(f"client errors:     {stats.errors:10d}")
+
+    if server is not None:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+    if not stats.latencies["edit"]:
+        # nan не сравнивается с порогом: без доставок прогон ничего не измерил
+        print("FAIL: no edit deliveries measured")
+        if args.max_p99_ms is not None:
+            sys.exit(1)
+        return
+    p99 = percentile(stats.latencies["edit"], 0.99) * 1000
+    if args.max_p99_ms is not None and p99 > args.max_p99_ms:
+        print(f"FAIL: edit p99 {p99:.2f} ms > {args.max_p99_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import os
+import asyncio
 import logging
+import signal
+import threading
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
@@ -10,10 +13,46 @@ from app.core.config import settings
 from app.core.database import Base, engine, async_session_maker
 from app.core.init_db import init_preset_palettes, init_system_blocks
 from app.api.v1 import ai, library, palette, user, projects, user_blocks, project_media
-from app.ws.rooms import router as ws_router
+from app.ws.bus import room_bus
+from app.ws.heartbeat import run_heartbeat
+from app.ws.janitor import run_room_janitor
+from app.ws import rooms as ws_rooms
+from app.ws.rooms import drain_connections, flush_all_rooms, restore_rooms, router as ws_router
 from prometheus_fastapi_instrumentator import Instrumentator
 
 
+def drain_websockets_on_exit_signals(loop: asyncio.AbstractEventLoop) -> None:
+    """SIGTERM/SIGINT: сначала drain WebSocket-соединений, затем обычная остановка uvicorn.
+
+    uvicorn закрывает WebSocket-соединения раньше, чем вызывает shutdown в
+    lifespan, поэтому reconnect надо разослать до того, как сигнал дойдет до
+    него. Повторный сигнал во время drain передается uvicorn сразу.
+    """
+    # Обработчики сигналов ставятся только из главного потока (TestClient
+    # запускает lifespan в своем потоке — там drain по сигналу не нужен)
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            if ws_rooms.draining:
+                previous(signum, frame)
+                return
+
+            async def drain_then_exit():
+                try:
+                    await drain_connections()
+                finally:
+                    previous(signum, frame)
+
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain_then_exit()))
+
+        signal.signal(sig, handler)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: создаем таблицы и инициализируем данные при необходимости
@@ -26,9 +65,32 @@ async def lifespan(app: FastAPI):
                 await init_preset_palettes(session)
     except Exception as e:
         print(f"Предупреждение: не удалось инициализировать системные данные: {e}")
-    
+
+    # Шина комнат между воркерами (Redis или внутрипроцессная)
+    await room_bus.start()
+    # Комнаты из журнала на диске возвращаются с версиями: клиенты догоняют по since
+    restored = await restore_rooms()
+    if restored:
+        logging.getLogger(__name__).info("Restored %d rooms from the journal", restored)
+    # Выгрузка простаивающих комнат из памяти
+    janitor = asyncio.create_task(run_room_janitor())
+    # Ping молчащим соединениям и отключение оборванных
+    heartbeat = asyncio.create_task(run_heartbeat())
+    drain_websockets_on_exit_signals(asyncio.get_running_loop())
+
     yield
 
+    janitor.cancel()
+    heartbeat.cancel()
+    # Клиенты получают reconnect с версией и переподключаются вразнобой, за catch_up
+    # (обычно уже по сигналу; здесь — если остановка пришла не через него)
+    drained = await drain_connections()
+    if drained:
+        logging.getLogger(__name__).info("Drained %d WebSocket connections", drained)
+    # Дописываем несохраненные правки комнат до остановки
+    await flush_all_rooms()
+    await room_bus.stop()
+
 
 app = FastAPI(
     title="Constructor Landing API",
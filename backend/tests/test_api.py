@@ -1,5 +1,6 @@
 import os
 import sys
+from datetime import datetime, timezone
 
 import anyio
 import pytest
@@ -9,7 +10,12 @@ BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if BASE_DIR not in sys.path:
     sys.path.insert(0, BASE_DIR)
 
+from sqlalchemy import select, update
+
 from main import app
+from app.auth.identity_cache import identity_cache
+from app.core.database import async_session_maker
+from app.models.project import Project
 
 pytestmark = pytest.mark.anyio("asyncio")
 
@@ -88,6 +94,32 @@ async def test_auth_flow(client):
     assert "access_token" in new_login.json()
 
 
+async def test_identity_cache_reuses_user_until_password_change(client):
+    credentials = {"username": "cached", "email": "cached@example.com", "password": "StrongPass123!"}
+    assert (await client.post("/api/auth/register", json=credentials)).status_code == 201
+    login_resp = await client.post(
+        "/api/auth/login",
+        json={"email": credentials["email"], "password": credentials["password"]},
+    )
+    headers = {"Authorization": f"Bearer {login_resp.json()['access_token']}"}
+
+    # Повторные проверки токена берут пользователя из кэша
+    identity_cache.clear()
+    for _ in range(2):
+        profile_resp = await client.get("/api/user/me", headers=headers)
+        assert profile_resp.status_code == 200
+    assert len(identity_cache) == 1
+
+    # Смена пароля сбрасывает запись
+    change_resp = await client.post(
+        "/api/auth/change-password",
+        headers=headers,
+        json={"current_password": credentials["password"], "new_password": "NewPass123!"},
+    )
+    assert change_resp.status_code == 200
+    assert len(identity_cache) == 0
+
+
 async def test_library_crud_flow(client):
     list_resp = await client.get("/api/library/blocks")
     assert list_resp.status_code == 200
@@ -123,6 +155,66 @@ async def test_library_crud_flow(client):
     assert delete_resp.json()["message"] == "Блок успешно удален"
 
 
+async def test_project_list_pages_by_keyset_without_data(client):
+    credentials = {"username": "lister", "email": "lister@example.com", "password": "StrongPass123!"}
+    assert (await client.post("/api/auth/register", json=credentials)).status_code == 201
+    login_resp = await client.post(
+        "/api/auth/login",
+        json={"email": credentials["email"], "password": credentials["password"]},
+    )
+    headers = {"Authorization": f"Bearer {login_resp.json()['access_token']}"}
+    user_id = (await client.get("/api/user/me", headers=headers)).json()["id"]
+
+    for i in range(5):
+        create_resp = await client.post(
+            "/api/projects",
+            headers=headers,
+            json={"title": f"Project {i}", "data": {"blocks": [{"id": f"b{i}", "type": "text"}]}},
+        )
+        assert create_resp.status_code == 201
+
+    # Фиксированные updated_at с совпадением: порядок внутри него решает id
+    stamps = [
+        datetime(2024, 1, 1, 12, 0, 0, 500000, tzinfo=timezone.utc),
+        datetime(2024, 1, 2, tzinfo=timezone.utc),
+        datetime(2024, 1, 2, tzinfo=timezone.utc),
+        datetime(2024, 1, 3, tzinfo=timezone.utc),
+        datetime(2024, 1, 2, tzinfo=timezone.utc),
+    ]
+    async with async_session_maker() as session:
+        project_ids = (await session.execute(
+            select(Project.id).where(Project.user_id == user_id).order_by(Project.id)
+        )).scalars().all()
+        for project_id, stamp in zip(project_ids, stamps):
+            await session.execute(update(Project).where(Project.id == project_id).values(updated_at=stamp))
+        await session.commit()
+    expected = [project_ids[3], project_ids[4], project_ids[2], project_ids[1], project_ids[0]]
+
+    full_resp = await client.get("/api/projects", headers=headers, params={"userId": user_id})
+    assert full_resp.status_code == 200
+    everything = full_resp.json()
+    assert [project["id"] for project in everything] == expected
+    assert "data" not in everything[0]
+    assert "X-Next-Cursor" not in full_resp.headers
+
+    pages, cursor = [], None
+    for _ in range(len(everything)):
+        params = {"userId": user_id, "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page_resp = await client.get("/api/projects", headers=headers, params=params)
+        assert page_resp.status_code == 200
+        pages.append([project["id"] for project in page_resp.json()])
+        cursor = page_resp.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert sum(pages, []) == expected
+
+    bad_resp = await client.get("/api/projects", headers=headers, params={"userId": user_id, "cursor": "???"})
+    assert bad_resp.status_code == 400
+
+
 async def test_palette_endpoints(client):
     apply_resp = await client.post(
         "/api/palette/apply",
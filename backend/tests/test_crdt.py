@@ -0,0 +1,370 @@
+import copy
+import json
+import os
+import sys
+
+from hypothesis import given, settings, strategies as st
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.ws.block_index import BlockIndex
+from app.ws.crdt import DIGITS, BlockTreeCRDT, is_position_key, key_between, spread_keys
+from app.ws.document import Node, from_json, json_default, to_json
+
+
+ROOT_TEXTS = [f"t{i}" for i in range(5)]
+CONTAINERS = ["c0", "c1"]
+NESTED_TEXTS = ["c0-a", "c0-b", "c1-a", "c1-b"]
+TEXTS = ROOT_TEXTS + NESTED_TEXTS
+
+
+def initial_state() -> dict:
+    blocks = [{"id": bid, "type": "text", "content": bid, "style": {}} for bid in ROOT_TEXTS[:3]]
+    for container_id in CONTAINERS:
+        blocks.append({
+            "id": container_id,
+            "type": "container",
+            "style": {},
+            "children": [
+                {"id": f"{container_id}-{suffix}", "type": "text", "content": "", "style": {}}
+                for suffix in ("a", "b")
+            ],
+        })
+    blocks.extend({"id": bid, "type": "text", "content": bid, "style": {}} for bid in ROOT_TEXTS[3:])
+    return {"theme": {"accent": "#000"}, "blocks": blocks}
+
+
+def make_engine(state: dict) -> BlockTreeCRDT:
+    index = BlockIndex()
+    index.rebuild(state)
+    return BlockTreeCRDT(state, index)
+
+
+def tree_ids(blocks: list) -> list:
+    return [
+        (block["id"], tree_ids(block.get("children", [])))
+        for block in blocks
+    ]
+
+
+op_strategy = st.one_of(
+    st.builds(
+        lambda bid, text: ("update_block", {"blockId": bid, "data": {"content": text}}),
+        st.sampled_from(TEXTS + CONTAINERS), st.text("abc", max_size=3),
+    ),
+    st.builds(
+        lambda bid, key, value: ("update_block", {"blockId": bid, "data": {"style": {key: value}}}),
+        st.sampled_from(TEXTS + CONTAINERS), st.sampled_from(["color", "margin"]),
+        st.one_of(st.none(), st.sampled_from(["1px", "2px", "red"])),
+    ),
+    st.builds(
+        lambda bid, after: ("move_block", {"blockId": bid, "afterId": after}),
+        st.sampled_from(TEXTS), st.sampled_from([None] + TEXTS + CONTAINERS),
+    ),
+    st.builds(
+        lambda bid, parent: ("move_block", {"blockId": bid, "afterId": None, "parentId": parent}),
+        st.sampled_from(TEXTS), st.sampled_from([None] + CONTAINERS),
+    ),
+    st.builds(
+        lambda bid, after: ("move_block", {"blockId": bid, "afterId": after}),
+        st.sampled_from(CONTAINERS), st.sampled_from([None] + ROOT_TEXTS[:2]),
+    ),
+    st.builds(
+        lambda bid: ("delete_block", {"blockId": bid}),
+        st.sampled_from(TEXTS + CONTAINERS),
+    ),
+    st.builds(
+        lambda n, after: ("add_block", {"block": {"id": f"new-{n}", "type": "text", "content": ""}, "afterId": after}),
+        st.integers(0, 3), st.sampled_from([None] + TEXTS),
+    ),
+    st.builds(
+        lambda n, parent: ("add_block", {"block": {"id": f"new-{n}", "type": "text"}, "parentId": parent}),
+        st.integers(4, 6), st.sampled_from([None] + CONTAINERS),
+    ),
+    st.builds(
+        lambda color: ("update_theme", {"accent": color}),
+        st.sampled_from(["#111", "#222", "#333"]),
+    ),
+)
+
+
+def prepare_concurrent(ops):
+    """Каждая реплика готовит свою операцию на исходном состоянии: все операции одновременны"""
+    prepared = []
+    seen_new = set()
+    for actor, ((op_type, payload), lamport) in enumerate(ops):
+        if op_type == "add_block":
+            # Идентификаторы новых блоков уникальны, как uuid на клиентах
+            if payload["block"]["id"] in seen_new:
+                continue
+            seen_new.add(payload["block"]["id"])
+        resolved = make_engine(initial_state()).prepare(op_type, copy.deepcopy(payload))
+        if resolved is not None:
+            prepared.append((op_type, resolved, (lamport, f"actor-{actor}")))
+    return prepared
+
+
+def replay(prepared, order) -> dict:
+    state = initial_state()
+    engine = make_engine(state)
+    for i in order:
+        op_type, payload, stamp = prepared[i]
+        assert engine.apply(op_type, copy.deepcopy(payload), stamp)
+    return state
+
+
+@settings(max_examples=300, deadline=None)
+@given(
+    ops=st.lists(st.tuples(op_strategy, st.integers(1, 4)), min_size=1, max_size=12),
+    data=st.data(),
+)
+def test_concurrent_ops_converge_in_any_delivery_order(ops, data):
+    prepared = prepare_concurrent(ops)
+    order = list(range(len(prepared)))
+    expected = replay(prepared, order)
+    for _ in range(3):
+        shuffled = data.draw(st.permutations(order))
+        assert json.dumps(to_json(replay(prepared, shuffled)), sort_keys=True) == json.dumps(to_json(expected), sort_keys=True)
+
+
+@given(st.lists(st.text(DIGITS[1:], min_size=1, max_size=4), min_size=2, max_size=2, unique=True))
+def test_key_between_is_strictly_between(pair):
+    low, high = sorted(pair)
+    for a, b in ((low, high), (None, low), (high, None), (None, None)):
+        key = key_between(a, b)
+        assert a is None or a < key
+        assert b is None or key < b
+        assert not key.endswith(DIGITS[0])
+
+
+def test_spread_keys_are_sorted_and_unique():
+    for count in (0, 1, 61, 62, 1000):
+        keys = spread_keys(count)
+        assert keys == sorted(set(keys))
+        assert len(keys) == count
+
+
+def test_moves_by_id_survive_concurrent_reorder():
+    # Два пользователя одновременно переставляют разные блоки от одного исходного состояния
+    prepared = []
+    for op in ({"blockId": "t4", "afterId": None}, {"blockId": "t0", "afterId": "t2"}):
+        prepared.append(("move_block", make_engine(initial_state()).prepare("move_block", op)))
+
+    state = initial_state()
+    engine = make_engine(state)
+    for version, (op_type, payload) in enumerate(prepared, start=1):
+        assert engine.apply(op_type, payload, (version, "u"))
+    assert [block["id"] for block in state["blocks"]] == ["t4", "t1", "t2", "t0", "c0", "c1", "t3"]
+
+
+def test_delete_wins_and_children_of_deleted_container_can_be_moved_out():
+    state = initial_state()
+    engine = make_engine(state)
+    move = engine.prepare("move_block", {"blockId": "c0-a", "afterId": None, "parentId": None})
+
+    assert engine.apply("delete_block", {"blockId": "c0"}, (1, "a"))
+    assert engine.apply("update_block", {"blockId": "c0", "data": {"content": "late"}}, (2, "b"))
+    assert "c0" not in engine.index
+    assert engine.apply("move_block", move, (3, "c"))
+    assert [child for child, _ in tree_ids(state["blocks"])][0] == "c0-a"
+
+
+def test_lww_map_merges_style_keys():
+    state = initial_state()
+    engine = make_engine(state)
+    assert engine.apply("update_block", {"blockId": "t0", "data": {"style": {"color": "red"}}}, (2, "a"))
+    assert engine.apply("update_block", {"blockId": "t0", "data": {"style": {"color": "blue", "margin": "1px"}}}, (1, "b"))
+    assert state["blocks"][0]["style"] == {"color": "red", "margin": "1px"}
+    assert engine.apply("update_block", {"blockId": "t0", "data": {"style": {"margin": None}}}, (3, "c"))
+    assert state["blocks"][0]["style"] == {"color": "red"}
+
+
+def test_inverse_ops_undo_own_edits_and_skip_overwritten_ones():
+    state = initial_state()
+    engine = make_engine(state)
+    edits = [
+        ("update_block", {"blockId": "t0", "data": {"content": "new", "style": {"color": "red"}}}),
+        ("move_block", {"blockId": "t4", "afterId": None}),
+        ("delete_block", {"blockId": "c0"}),
+        ("update_theme", {"accent": "#fff", "font": "serif"}),
+    ]
+    history = []
+    for version, (op_type, payload) in enumerate(edits, start=1):
+        prepared = engine.prepare(op_type, payload)
+        history.append(engine.invert(op_type, prepared, (version, "a")))
+        assert engine.apply(op_type, prepared, (version, "a"))
+
+    # Чужая правка после нашей: отмена не трогает content, но возвращает style
+    assert engine.apply("update_block", {"blockId": "t0", "data": {"content": "theirs"}}, (5, "b"))
+    for version, inverse in enumerate(reversed(history), start=6):
+        for op in filter(None, map(engine.current, inverse)):
+            assert engine.apply(op["type"], op["payload"], (version, "a"))
+
+    expected = initial_state()
+    expected["blocks"][0]["content"] = "theirs"
+    assert to_json(state) == expected
+    assert engine.invert("patch", [], (10, "a")) is None
+
+
+def test_export_and_load_keep_positions():
+    state = initial_state()
+    engine = make_engine(state)
+    move = engine.prepare("move_block", {"blockId": "t3", "afterId": "t0"})
+    assert engine.apply("move_block", move, (1, "a"))
+    assert engine.apply("delete_block", {"blockId": "c1"}, (2, "a"))
+
+    replica_state = copy.deepcopy(state)
+    replica = make_engine(replica_state)
+    replica.load(json.loads(json.dumps(engine.export())))
+    add = engine.prepare("add_block", {"block": {"id": "x", "type": "text"}, "afterId": "t0"})
+    for target in (engine, replica):
+        assert target.apply("add_block", add, (3, "b"))
+        assert target.apply("move_block", {"blockId": "c1-a", "parentId": None, "position": add["position"]}, (4, "b"))
+    assert replica_state == state
+
+
+def test_positions_are_assigned_by_the_server_and_validated():
+    state = initial_state()
+    engine = make_engine(state)
+    # Ключ клиента не принимается: позиция считается из afterId
+    add = engine.prepare("add_block", {"block": {"id": "x", "type": "text"}, "afterId": "t0", "position": "!!"})
+    assert is_position_key(add["position"])
+    assert engine.keys["t0"] < add["position"] < engine.keys["t1"]
+    assert engine.apply("add_block", add, (1, "a"))
+    after = engine.prepare("add_block", {"block": {"id": "y", "type": "text"}, "afterId": "x"})
+    assert engine.apply("add_block", after, (2, "a"))
+    assert [bid for bid, _ in tree_ids(state["blocks"])][:4] == ["t0", "x", "y", "t1"]
+
+    for bad in ("!!", "", "V0", 5):
+        assert not is_position_key(bad)
+        assert not engine.apply("add_block", {"block": {"id": "z", "type": "text"}, "position": bad}, (3, "a"))
+        assert not engine.apply("move_block", {"blockId": "t1", "parentId": None, "position": bad}, (3, "a"))
+
+
+def test_collect_forgets_metadata_older_than_horizon():
+    state = initial_state()
+    engine = make_engine(state)
+    assert engine.apply("delete_block", {"blockId": "c0"}, (1, "a"))
+    assert engine.apply("update_block", {"blockId": "t0", "data": {"style": {"color": "red"}}}, (2, "a"))
+    assert engine.apply("update_theme", {"accent": "#fff"}, (3, "a"))
+    assert engine.apply("update_block", {"blockId": "t1", "data": {"content": "kept"}}, (10, "a"))
+
+    assert engine.collect(5) > 0
+    assert engine.deleted == {} and engine.graveyard == []
+    assert "c0-a" not in engine.keys and "c0" not in engine.keys
+    assert set(engine.fields) == {("t1", "content")}
+    # Новые операции по-прежнему побеждают, правка забытого блока — неизвестный блок
+    assert engine.apply("update_block", {"blockId": "t0", "data": {"style": {"color": "blue"}}}, (11, "a"))
+    assert state["blocks"][0]["style"] == {"color": "blue"}
+    assert not engine.apply("update_block", {"blockId": "c0", "data": {"content": "late"}}, (12, "a"))
+    assert "c0" not in json.dumps(engine.export())
+
+
+def engine_view(engine: BlockTreeCRDT) -> tuple:
+    """Состояние, метаданные и оба индекса движка в сравнимом виде"""
+    def refs(index, blocks, parent_id=None):
+        view = {}
+        for block in blocks:
+            ref = index.get(block["id"])
+            assert ref is not None and ref.block is block and ref.parent_id == parent_id
+            view[block["id"]] = (parent_id, index.slot_of(block["id"]))
+            view.update(refs(index, block.get("children", []), block["id"]))
+        return view
+
+    tree = refs(engine.index, engine.state.get("blocks", []))
+    graveyard = refs(engine.graveyard_index, engine.graveyard)
+    assert len(engine.index) == len(tree) and len(engine.graveyard_index) == len(graveyard)
+    meta = json.dumps(to_json(engine.export()), sort_keys=True)
+    return json.dumps(to_json(engine.state), sort_keys=True), meta, tree, graveyard
+
+
+rollback_op_strategy = st.one_of(
+    op_strategy,
+    st.builds(
+        lambda bid: ("update_block", {"blockId": bid, "data": {"children": [{"id": f"{bid}-z", "type": "text"}]}}),
+        st.sampled_from(CONTAINERS),
+    ),
+    st.builds(
+        lambda bid: ("patch", [{"op": "remove", "path": f"/@{bid}"}]),
+        st.sampled_from(TEXTS),
+    ),
+    st.just(("patch", [{"op": "add", "path": "/blocks/0", "value": {"id": "p", "type": "text"}}])),
+)
+
+
+@settings(max_examples=300, deadline=None)
+@given(
+    history=st.lists(op_strategy, max_size=6),
+    batch=st.lists(rollback_op_strategy, min_size=1, max_size=8),
+)
+def test_rollback_restores_state_metadata_and_indexes(history, batch):
+    state = from_json(initial_state())
+    engine = make_engine(state)
+    for version, (op_type, payload) in enumerate(history, start=1):
+        prepared = engine.prepare(op_type, copy.deepcopy(payload))
+        if prepared is not None:
+            engine.apply(op_type, prepared, (version, "a"))
+    before = engine_view(engine)
+
+    engine.begin()
+    for number, (op_type, payload) in enumerate(batch):
+        prepared = engine.prepare(op_type, copy.deepcopy(payload))
+        if prepared is not None:
+            engine.apply(op_type, prepared, (100, "b", number))
+    engine.rollback()
+
+    assert engine.journal is None
+    assert engine_view(engine) == before
+
+
+json_values = st.recursive(
+    st.none() | st.booleans() | st.integers() | st.floats(allow_nan=False) | st.text(max_size=30),
+    lambda children: st.lists(children, max_size=4) | st.dictionaries(st.text(max_size=8), children, max_size=4),
+    max_leaves=20,
+)
+
+
+@given(json_values)
+def test_document_model_round_trips_json(value):
+    model = from_json(value)
+    assert to_json(model) == value
+    assert json.loads(json.dumps(model, default=json_default)) == json.loads(json.dumps(value))
+
+
+def test_document_nodes_share_shapes_and_behave_like_dicts():
+    state = from_json(initial_state())
+    first, second = state["blocks"][0], state["blocks"][1]
+    assert isinstance(first, Node) and first._shape is second._shape
+    assert first["style"] == {} and first == {"id": "t0", "type": "text", "content": "t0", "style": {}}
+
+    first["style"]["color"] = "red"
+    first.pop("content")
+    first["content"] = "moved to the end"
+    assert list(first) == ["id", "type", "style", "content"]
+    assert "content" not in second["style"] and second.get("missing", 1) == 1
+
+    # Перенос в состояние отвязывает значение от операции
+    payload = {"style": {"color": "blue"}}
+    detached = from_json(payload)
+    detached["style"]["color"] = "green"
+    assert payload == {"style": {"color": "blue"}}
+    assert copy.deepcopy(state) == state
+
+
+def test_engine_on_document_model_matches_dict_state():
+    ops = [
+        ("update_block", {"blockId": "t0", "data": {"content": "x", "style": {"color": "red"}}}),
+        ("move_block", {"blockId": "t3", "afterId": "t0"}),
+        ("add_block", {"block": {"id": "n", "type": "text", "style": {}}, "parentId": "c0", "afterId": "c0-a"}),
+        ("delete_block", {"blockId": "c1"}),
+        ("patch", [{"op": "replace", "path": "/theme/accent", "value": "#fff"}]),
+    ]
+    plain, model = initial_state(), from_json(initial_state())
+    engines = [make_engine(plain), make_engine(model)]
+    for version, (op_type, payload) in enumerate(ops, start=1):
+        for engine in engines:
+            prepared = engine.prepare(op_type, copy.deepcopy(payload))
+            assert engine.apply(op_type, prepared, (version, "a"))
+    assert to_json(model) == to_json(plain)
@@ -0,0 +1,1199 @@
+import asyncio
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI, WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.auth.security import create_access_token, create_view_token
+from app.ws import rooms as rooms_module
+from app.ws.autosave import RoomSaver
+from app.ws.block_index import BlockIndex
+from app.ws.codec import ZSTD_MAGIC, Codec, FrameTooLarge, get_codec
+from app.ws.crdt import BlockTreeCRDT
+from app.ws.document import Node, to_json
+from app.ws.heartbeat import HEARTBEAT_TIMEOUT_CLOSE_CODE, heartbeat_sweep
+from app.ws.history import UndoHistory
+from app.ws.janitor import evict_room, sweep_rooms
+from app.ws.journal import RoomJournal
+from app.ws.connection import (
+    KIND_PRESENCE,
+    KIND_STATE,
+    POLICY_COALESCE,
+    POLICY_DISCONNECT,
+    POLICY_DROP_CURSOR,
+    Connection,
+)
+from app.ws.oplog import OpLog
+from app.ws.patch import apply_patch
+from app.ws.presence import Presence
+from app.ws.ratelimit import RateLimiter, TokenBucket, room_rate_factor
+
+
+def build_state() -> dict:
+    return {
+        "projectName": "Test",
+        "theme": {"accent": "#ff0000"},
+        "blocks": [
+            {"id": "text-1", "type": "text", "content": "Hello", "style": {}},
+            {
+                "id": "container-1",
+                "type": "container",
+                "style": {},
+                "children": [{"id": "text-2", "type": "text", "content": "Nested", "style": {}}],
+            },
+            {
+                "id": "grid-1",
+                "type": "grid",
+                "style": {},
+                "cells": [{"block": {"id": "image-1", "type": "image", "style": {}}}, {"block": None}],
+            },
+        ],
+    }
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class _Connected:
+    name = "CONNECTED"
+
+
+class SlowWebSocket:
+    """Сокет, который не отправляет ничего, пока его не отпустят"""
+
+    client_state = _Connected()
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.released = asyncio.Event()
+        self.close_code = None
+
+    async def send_text(self, data: str) -> None:
+        await self.released.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000) -> None:
+        self.close_code = code
+
+
+def make_client() -> TestClient:
+    app = FastAPI()
+    app.include_router(rooms_module.router)
+    return TestClient(app)
+
+
+def receive_until(websocket, message_type: str) -> dict:
+    while True:
+        message = websocket.receive_json()
+        if message["type"] == message_type:
+            return message
+
+
+def build_indexed_state():
+    state = build_state()
+    index = BlockIndex()
+    index.rebuild(state)
+    return state, index
+
+
+def build_engine():
+    state, index = build_indexed_state()
+    return state, index, BlockTreeCRDT(state, index)
+
+
+def apply_op(engine: BlockTreeCRDT, op_type: str, payload: dict, version: int) -> bool:
+    """Операция клиента так, как ее применяет владелец комнаты: prepare, затем apply"""
+    prepared = engine.prepare(op_type, payload)
+    return prepared is not None and engine.apply(op_type, prepared, (version, "test"))
+
+
+def test_engine_updates_nested_blocks():
+    state, index, engine = build_engine()
+    assert apply_op(engine, "update_block", {"blockId": "text-2", "data": {"content": "Changed"}}, 1)
+    assert state["blocks"][1]["children"][0]["content"] == "Changed"
+
+    assert apply_op(engine, "delete_block", {"blockId": "image-1"}, 2)
+    assert state["blocks"][2]["cells"][0]["block"] is None
+
+    assert apply_op(engine, "move_block", {"fromIndex": 0, "toIndex": 2}, 3)
+    assert [b["id"] for b in state["blocks"]] == ["container-1", "grid-1", "text-1"]
+
+    assert not apply_op(engine, "update_block", {"blockId": "missing", "data": {}}, 4)
+
+
+def test_block_index_tracks_structure_changes():
+    state, index, engine = build_engine()
+    assert index.get("text-2").parent_id == "container-1"
+    assert index.get("image-1").container is state["blocks"][2]["cells"][0]
+
+    assert apply_op(engine, "move_block", {"fromIndex": 2, "toIndex": 0}, 1)
+    assert apply_op(engine, "delete_block", {"blockId": "text-1"}, 2)
+    assert [b["id"] for b in state["blocks"]] == ["grid-1", "container-1"]
+    assert index.get("container-1").slot == 1
+
+    assert apply_op(engine, "delete_block", {"blockId": "container-1"}, 3)
+    assert "text-2" not in index
+
+    new_children = [{"id": "text-3", "type": "text", "content": "", "style": {}}]
+    assert apply_op(engine, "add_block", {"block": {"id": "container-2", "type": "container", "children": []}}, 4)
+    assert apply_op(engine, "update_block", {"blockId": "container-2", "data": {"children": new_children}}, 5)
+    assert index.get("text-3").parent_id == "container-2"
+    assert apply_op(engine, "update_block", {"blockId": "text-3", "data": {"content": "Deep"}}, 6)
+    assert state["blocks"][-1]["children"][0]["content"] == "Deep"
+
+
+def test_room_broadcasts_delta_ops_with_versions():
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/delta?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+
+            with client.websocket_connect("/ws/rooms/delta?protocol=delta&name=Bob") as bob:
+                snapshot = receive_until(bob, "sync_state")
+                assert snapshot["version"] == 1
+                receive_until(bob, "users_list")
+
+                alice.send_json({
+                    "type": "update_block",
+                    "payload": {"blockId": "text-1", "data": {"content": "Hi"}},
+                })
+                ack = receive_until(alice, "op_ack")
+                assert ack["payload"]["version"] == 2
+
+                op = bob.receive_json()
+                assert op["type"] == "update_block"
+                assert op["version"] == 2
+                assert op["payload"] == {"blockId": "text-1", "data": {"content": "Hi"}}
+
+                # Отставший клиент получает пропущенные операции из журнала
+                bob.send_json({"type": "request_sync", "payload": {"version": 1}})
+                catch_up = bob.receive_json()
+                assert catch_up["type"] == "catch_up"
+                assert [op["version"] for op in catch_up["payload"]["ops"]] == [2]
+
+                # Без известной версии — полный снимок
+                bob.send_json({"type": "request_sync", "payload": {}})
+                resync = bob.receive_json()
+                assert resync["type"] == "sync_state"
+                assert resync["payload"]["blocks"][0]["content"] == "Hi"
+    rooms_module.rooms.clear()
+
+
+def test_clients_without_delta_protocol_get_full_state_per_batch():
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/legacy?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+
+            # Клиент без ?protocol=delta: операций и op_ack не понимает
+            with client.websocket_connect("/ws/rooms/legacy?name=Bob") as bob:
+                receive_until(bob, "users_list")
+                alice.send_json({
+                    "type": "update_block",
+                    "payload": {"blockId": "text-1", "data": {"content": "Hi"}},
+                })
+                assert receive_until(alice, "op_ack")["payload"]["version"] == 2
+                state = receive_until(bob, "sync_state")
+                while state["version"] < 2:
+                    state = receive_until(bob, "sync_state")
+                assert state["version"] == 2
+                assert state["payload"]["blocks"][0]["content"] == "Hi"
+
+                # Его собственная правка доходит до Alice операцией, а ему op_ack не приходит
+                bob.send_json({
+                    "type": "update_block",
+                    "payload": {"blockId": "text-1", "data": {"content": "Hey"}},
+                })
+                op = receive_until(alice, "update_block")
+                assert op["version"] == 3
+                bob.send_json({"type": "request_sync", "payload": {}})
+                assert bob.receive_json()["type"] == "sync_state"
+    rooms_module.rooms.clear()
+
+
+def test_reconnect_with_since_gets_only_missed_ops():
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/resume?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+            for i in range(5):
+                alice.send_json({
+                    "type": "update_block",
+                    "payload": {"blockId": "text-1", "data": {"content": f"v{i}"}},
+                })
+                receive_until(alice, "op_ack")
+            epoch = rooms_module.rooms["resume"].epoch
+
+            with client.websocket_connect(f"/ws/rooms/resume?protocol=delta&name=Bob&since=3&epoch={epoch}") as bob:
+                catch_up = receive_until(bob, "catch_up")
+                assert catch_up["version"] == 6
+                assert [op["version"] for op in catch_up["payload"]["ops"]] == [4, 5, 6]
+                assert catch_up["payload"]["ops"][-1]["payload"]["data"]["content"] == "v4"
+
+            # Клиент без дельта-протокола операции не применит — ему снимок
+            with client.websocket_connect(f"/ws/rooms/resume?name=Carol&since=3&epoch={epoch}") as carol:
+                assert receive_until(carol, "sync_state")["version"] == 6
+
+            # Другая линия версий (комната пересоздана) — только снимок
+            with client.websocket_connect("/ws/rooms/resume?protocol=delta&name=Bob&since=3&epoch=stale") as bob:
+                assert receive_until(bob, "sync_state")["version"] == 6
+
+            # Разрыв вытеснен из буфера — тоже снимок
+            rooms_module.rooms["resume"].oplog = OpLog(capacity=2)
+            for version in (5, 6):
+                rooms_module.rooms["resume"].oplog.append({"version": version})
+            with client.websocket_connect(f"/ws/rooms/resume?protocol=delta&name=Bob&since=3&epoch={epoch}") as bob:
+                assert receive_until(bob, "sync_state")["version"] == 6
+    rooms_module.rooms.clear()
+
+
+def test_oplog_ring_buffer_evicts_oldest_ops():
+    log = OpLog(capacity=3)
+    log.reset(10)
+    for version in range(11, 16):
+        log.append({"version": version})
+    assert len(log) == 3
+    assert log.base_version == 12
+    assert [op["version"] for op in log.since(12)] == [13, 14, 15]
+    assert log.since(15) == []
+    assert log.since(11) is None
+    assert log.since(16) is None
+
+
+@pytest.mark.anyio
+async def test_connection_queue_drops_stale_cursors():
+    ws = SlowWebSocket()
+    conn = Connection(ws, max_queue=3, policy=POLICY_DROP_CURSOR)
+    conn.start()
+    await asyncio.sleep(0)
+
+    conn.send("cursor-1", KIND_PRESENCE)
+    conn.send("op-1", KIND_STATE)
+    conn.send("cursor-2", KIND_PRESENCE)
+    assert conn.send("op-2", KIND_STATE)
+    assert conn.depth == 3
+
+    ws.released.set()
+    await conn.drain()
+    assert ws.sent[-3:] == ["op-1", "cursor-2", "op-2"]
+    conn.close()
+
+
+@pytest.mark.anyio
+async def test_connection_queue_coalesces_state_into_snapshot():
+    ws = SlowWebSocket()
+    conn = Connection(ws, snapshot=lambda: "snapshot", max_queue=2, policy=POLICY_COALESCE)
+    conn.start()
+    await asyncio.sleep(0)
+
+    for i in range(5):
+        assert conn.send(f"op-{i}", KIND_STATE)
+    assert conn.depth <= 2
+
+    ws.released.set()
+    await conn.drain()
+    assert ws.sent[-1] == "snapshot"
+    conn.close()
+
+
+@pytest.mark.anyio
+async def test_connection_queue_disconnects_slow_consumer():
+    ws = SlowWebSocket()
+    conn = Connection(ws, max_queue=1, policy=POLICY_DISCONNECT)
+    conn.start()
+    await asyncio.sleep(0)
+
+    assert conn.send("op-1", KIND_STATE)
+    assert not conn.send("op-2", KIND_STATE)
+    await asyncio.sleep(0)
+    assert conn.closed
+    assert ws.close_code == 1013
+
+
+@pytest.mark.anyio
+async def test_presence_coalesces_cursor_updates_per_tick():
+    frames = []
+    presence = Presence(frames.append, tick_hz=100)
+
+    for x in range(60):
+        presence.update("user-a", {"userId": "a", "x": x, "y": 0})
+    presence.update("user-b", {"userId": "b", "x": 1, "y": 1, "blockId": "text-1"})
+    await asyncio.sleep(0.05)
+
+    assert len(frames) == 1
+    cursors = {c["userId"]: c for c in frames[0]["payload"]["cursors"]}
+    assert cursors["a"]["x"] == 59
+    assert cursors["b"]["blockId"] == "text-1"
+
+    presence.update("user-a", {"x": 100})
+    await asyncio.sleep(0.05)
+    assert len(frames) == 2
+    assert frames[1]["payload"]["cursors"] == [{"userId": "a", "x": 100, "y": 0}]
+    presence.close()
+
+
+@pytest.mark.anyio
+async def test_room_saver_coalesces_ops_and_skips_unchanged_state():
+    state = build_state()
+    writes = []
+    saved = []
+
+    async def persist(project_id, user_id, data):
+        writes.append((project_id, user_id, data))
+        return True
+
+    saver = RoomSaver(lambda: state, on_saved=saved.append, persist=persist, interval=0.02, max_ops=1000)
+    saver.bind(7, 1)
+    for i in range(50):
+        state["blocks"][0]["content"] = f"edit {i}"
+        saver.mark_dirty()
+    await asyncio.sleep(0.06)
+
+    assert len(writes) == 1
+    assert writes[0][:2] == (7, 1)
+    assert writes[0][2]["blocks"][0]["content"] == "edit 49"
+    assert saved == [7]
+
+    # Состояние не изменилось — запись пропускается
+    saver.mark_dirty()
+    assert not await saver.flush()
+    assert len(writes) == 1
+
+    saver.max_ops = 3
+    for i in range(3):
+        state["theme"]["accent"] = f"#00000{i}"
+        saver.mark_dirty()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert len(writes) == 2
+    saver.close()
+
+
+@pytest.mark.anyio
+async def test_only_edits_of_the_project_owner_mark_the_room_for_autosave():
+    rooms_module.rooms.clear()
+    room = rooms_module.get_or_create_room("saved")
+    await rooms_module.submit_op(room, "sync_state", build_state(), "owner", wait=True, account=1)
+    room.saver.bind(5, 1, clean=True)
+
+    # Аноним и чужой аккаунт правят комнату, но в проект владельца от его имени это не пишется
+    await rooms_module.submit_op(room, "update_theme", {"accent": "#111"}, "anon", wait=True)
+    await rooms_module.submit_op(room, "update_theme", {"accent": "#222"}, "other", wait=True, account=2)
+    assert not room.saver.dirty and room.version == 3
+
+    await rooms_module.submit_op(room, "update_theme", {"accent": "#333"}, "owner", wait=True, account=1)
+    assert room.saver.dirty and room.saver.pending_ops == 1
+    room.close()
+    rooms_module.rooms.clear()
+
+
+@pytest.mark.anyio
+async def test_janitor_evicts_idle_rooms_by_ttl_and_memory_budget():
+    writes = []
+
+    async def persist(project_id, user_id, data):
+        writes.append(project_id)
+        return True
+
+    rooms_module.rooms.clear()
+    for i, room_id in enumerate(["old", "middle", "fresh", "busy"]):
+        room = rooms_module.get_or_create_room(room_id)
+        room.replace_state(build_state())
+        room.last_active = 100.0 + i
+    rooms_module.rooms["busy"].users["u"] = {"id": "u"}
+    saver = rooms_module.rooms["old"].saver
+    saver._persist = persist
+    saver.bind(1, 1)
+
+    # TTL истек только у "old": перед выгрузкой состояние сохраняется
+    assert await sweep_rooms(idle_ttl=102.5, memory_budget=10**9, now=203.0) == 1
+    assert writes == [1]
+    assert set(rooms_module.rooms) == {"middle", "fresh", "busy"}
+
+    # Бюджет на одну комнату: выгружаются пустые, начиная с давно неактивных
+    budget = rooms_module.rooms["busy"].estimate_state_bytes()
+    assert await sweep_rooms(idle_ttl=10**6, memory_budget=budget, now=203.0) == 2
+    assert set(rooms_module.rooms) == {"busy"}
+    rooms_module.rooms.clear()
+
+
+@pytest.mark.anyio
+async def test_janitor_compacts_quiet_rooms_without_changing_state():
+    rooms_module.rooms.clear()
+    quiet, busy = rooms_module.get_or_create_room("quiet"), rooms_module.get_or_create_room("busy")
+    for room in (quiet, busy):
+        room.replace_state(build_state())
+        room.apply_op("update_block", {"blockId": "text-1", "data": {"content": "Hi"}}, "alice")
+    # sync_state хранится деревом dict, как пришло
+    assert type(quiet.state) is dict and not quiet.compacted
+    quiet.last_active, busy.last_active = 100.0, 190.0
+    frame = quiet.snapshot_frame(get_codec())
+
+    assert await sweep_rooms(idle_ttl=10**6, memory_budget=10**9, now=200.0, compact_after=60.0) == 0
+    assert quiet.compacted and isinstance(quiet.state, Node)
+    assert not busy.compacted and type(busy.state) is dict
+    assert to_json(quiet.state) == to_json(busy.state)
+    assert quiet.snapshot_frame(get_codec()) is frame
+
+    # Метаданные CRDT пережили перевод: правки сходятся так же, как без него
+    for room in (quiet, busy):
+        room.apply_op("update_block", {"blockId": "text-1", "data": {"content": "Bye"}}, "bob")
+        room.apply_op("delete_block", {"blockId": "text-1"}, "alice")
+    assert to_json(quiet.state) == to_json(busy.state)
+    assert quiet.engine.export() == busy.engine.export()
+    rooms_module.rooms.clear()
+
+
+def test_json_patch_by_block_id_is_atomic_and_reindexes():
+    state, index = build_indexed_state()
+
+    structural = apply_patch(state, index, [
+        {"op": "add", "path": "/@text-2/style/color", "value": "#333"},
+        {"op": "add", "path": "/theme/font", "value": "Inter"},
+    ])
+    assert structural is False
+    assert state["blocks"][1]["children"][0]["style"] == {"color": "#333"}
+    assert state["theme"]["font"] == "Inter"
+
+    # Вторая операция падает — первая откатывается
+    before = json.dumps(state, sort_keys=True)
+    assert apply_patch(state, index, [
+        {"op": "remove", "path": "/@text-1"},
+        {"op": "test", "path": "/@text-2/content", "value": "Other"},
+    ]) is None
+    assert json.dumps(state, sort_keys=True) == before
+    assert index.get("text-1").block is state["blocks"][0]
+
+    # Структурные правки: новый блок сразу адресуется по id
+    assert apply_patch(state, index, [
+        {"op": "add", "path": "/@container-1/children/-", "value": {"id": "text-3", "type": "text"}},
+        {"op": "add", "path": "/@text-3/content", "value": "Added"},
+        {"op": "move", "from": "/@image-1", "path": "/blocks/0"},
+    ]) is True
+    index.rebuild(state)
+    assert index.get("text-3").parent_id == "container-1"
+    assert state["blocks"][0]["id"] == "image-1"
+    assert state["blocks"][3]["cells"][0] == {}
+
+
+def test_patch_message_is_rebroadcast_as_is():
+    rooms_module.rooms.clear()
+    patch = [{"op": "add", "path": "/@container-1/children/0", "value": {"id": "text-9", "type": "text"}}]
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/patch?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+            with client.websocket_connect("/ws/rooms/patch?protocol=delta&name=Bob") as bob:
+                receive_until(bob, "users_list")
+                alice.send_json({"type": "patch", "payload": patch})
+                op = receive_until(bob, "patch")
+                assert op["payload"] == patch
+                assert op["version"] == 2
+
+                # Новый блок проиндексирован и получил ключ позиции
+                alice.send_json({"type": "move_block", "payload": {"blockId": "text-9", "afterId": None}})
+                moved = receive_until(bob, "move_block")
+                assert moved["payload"]["parentId"] is None
+
+                # Неприменимый патч не меняет состояние, автору уходит снимок
+                alice.send_json({"type": "patch", "payload": [{"op": "remove", "path": "/@missing"}]})
+                assert receive_until(alice, "sync_state")["version"] == 3
+    rooms_module.rooms.clear()
+
+
+def test_snapshot_frame_is_encoded_once_per_version_and_codec():
+    room = rooms_module.Room("frames")
+    room.replace_state(build_state())
+    codec = get_codec()
+    frame = room.snapshot_frame(codec)
+    assert json.loads(frame)["payload"] == build_state()
+    assert room.snapshot_frame(codec) is frame
+
+    room.apply_op("update_block", {"blockId": "text-1", "data": {"content": "Hi"}}, "alice")
+    updated = room.snapshot_frame(codec)
+    assert updated is not frame and json.loads(updated)["version"] == 2
+
+    # Снимок от владельца с той же версией, но другим состоянием — кадр кодируется заново
+    room.replace_state(dict(build_state(), projectName="Other"))
+    room.version = 2
+    assert json.loads(room.snapshot_frame(codec))["payload"]["projectName"] == "Other"
+
+
+def test_codec_falls_back_to_text_json():
+    codec = get_codec("cbor", "brotli")
+    assert codec is get_codec()
+    frame = codec.encode({"type": "op_ack", "payload": {"version": 1}})
+    assert isinstance(frame, str)
+    assert json.loads(frame)["payload"]["version"] == 1
+    assert codec.decode(b'{"type": "request_sync"}') == {"type": "request_sync"}
+
+
+def test_binary_frames_are_negotiated_per_connection():
+    msgpack = pytest.importorskip("msgpack")
+    pytest.importorskip("zstandard")
+    codec = Codec("msgpack", "zstd", threshold=1024)
+    small = codec.encode({"type": "op_ack"})
+    assert msgpack.unpackb(small) == {"type": "op_ack"}
+    large = {"type": "sync_state", "payload": {"blocks": [{"id": f"t{i}", "content": "x" * 50} for i in range(100)]}}
+    compressed = codec.encode(large)
+    assert compressed.startswith(ZSTD_MAGIC) and len(compressed) < 1024
+    assert codec.decode(compressed) == large
+
+    rooms_module.rooms.clear()
+    state = build_state()
+    state["blocks"].extend({"id": f"filler-{i}", "type": "text", "content": "Lorem ipsum " * 20} for i in range(100))
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/codec?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": state})
+            with client.websocket_connect("/ws/rooms/codec?protocol=delta&name=Bob&encoding=msgpack&compress=zstd") as bob:
+                # Большой снимок сжат, мелкие кадры — MessagePack без сжатия
+                frame = bob.receive_bytes()
+                assert frame.startswith(ZSTD_MAGIC)
+                assert get_codec("msgpack", "zstd").decode(frame)["payload"] == state
+                assert msgpack.unpackb(bob.receive_bytes())["type"] == "users_list"
+
+                bob.send_bytes(msgpack.packb({
+                    "type": "update_block",
+                    "payload": {"blockId": "text-1", "data": {"content": "Hi"}},
+                }))
+                op = receive_until(alice, "update_block")
+                assert op["payload"]["data"] == {"content": "Hi"}
+                assert msgpack.unpackb(bob.receive_bytes())["type"] == "op_ack"
+    rooms_module.rooms.clear()
+
+
+def test_compressed_frames_are_limited_by_decompressed_size(monkeypatch):
+    zstd = pytest.importorskip("zstandard")
+    monkeypatch.setattr(rooms_module.settings, "WS_MAX_FRAME_BYTES", 10_000)
+    codec = Codec("json", "zstd")
+    bomb = zstd.ZstdCompressor().compress(json.dumps({"type": "sync_state", "payload": "x" * 20_000}).encode())
+    assert len(bomb) < 1_000
+    with pytest.raises(FrameTooLarge):
+        codec.decode(bomb)
+
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/bomb?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_bytes(bomb)
+            with pytest.raises(WebSocketDisconnect) as closed:
+                receive_until(alice, "never")
+            assert closed.value.code == 1009
+    rooms_module.rooms.clear()
+
+
+def test_project_room_is_hydrated_once_from_the_database(monkeypatch):
+    loads = []
+
+    async def fake_user(token):
+        return SimpleNamespace(id={"owner": 1, "stranger": 2}[token])
+
+    async def fake_load(project_id):
+        loads.append(project_id)
+        return SimpleNamespace(user_id=1, data=build_state()) if project_id == 5 else None
+
+    monkeypatch.setattr(rooms_module, "get_user_from_token", fake_user)
+    monkeypatch.setattr(rooms_module, "load_project", fake_load)
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/project?protocol=delta&name=Alice&token=owner&projectId=5") as alice:
+            # Клиент ничего не выгружает: состояние приходит из проекта
+            assert receive_until(alice, "sync_state")["payload"] == build_state()
+            with client.websocket_connect("/ws/rooms/project?protocol=delta&name=Bob&token=owner&projectId=5") as bob:
+                assert receive_until(bob, "sync_state")["payload"] == build_state()
+            assert loads == [5]
+
+            room = rooms_module.rooms["project"]
+            assert (room.saver.project_id, room.saver.user_id, room.saver.dirty) == (5, 1, False)
+
+            for query in ("token=stranger&projectId=5", "token=owner&projectId=6", "projectId=5"):
+                with client.websocket_connect(f"/ws/rooms/project?protocol=delta&name=Eve&{query}") as eve:
+                    with pytest.raises(WebSocketDisconnect) as closed:
+                        eve.receive_json()
+                    assert closed.value.code == 1008
+    rooms_module.rooms.clear()
+
+
+def test_project_room_admits_only_its_owner(monkeypatch):
+    async def fake_user(token):
+        return SimpleNamespace(id={"owner": 1, "stranger": 2}[token])
+
+    async def fake_load(project_id):
+        return SimpleNamespace(user_id=1, data=build_state())
+
+    monkeypatch.setattr(rooms_module, "get_user_from_token", fake_user)
+    monkeypatch.setattr(rooms_module, "load_project", fake_load)
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/owned?protocol=delta&name=Eve") as early:
+            receive_until(early, "users_list")
+            with client.websocket_connect("/ws/rooms/owned?protocol=delta&name=Alice&token=owner&projectId=5") as alice:
+                receive_until(alice, "sync_state")
+                # Вошедший до привязки аноним отключается, не получив проект
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    while True:
+                        assert early.receive_json()["type"] != "sync_state"
+                assert closed.value.code == 1008
+
+                # Без projectId в привязанную комнату тоже только владелец
+                for query in ("", "&token=stranger"):
+                    with client.websocket_connect(f"/ws/rooms/owned?protocol=delta&name=Eve{query}") as eve:
+                        with pytest.raises(WebSocketDisconnect) as closed:
+                            eve.receive_json()
+                        assert closed.value.code == 1008
+                with client.websocket_connect("/ws/rooms/owned?protocol=delta&name=Bob&token=owner") as bob:
+                    assert receive_until(bob, "sync_state")["payload"] == build_state()
+
+            assert rooms_module.rooms["owned"].state == build_state()
+    rooms_module.rooms.clear()
+
+
+def test_spectators_get_coalesced_updates_without_joining_the_room():
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/show?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+
+            token = create_view_token("show", 1)
+            with client.websocket_connect(f"/ws/rooms/show/view?token={token}") as viewer:
+                snapshot = viewer.receive_json()
+                assert (snapshot["type"], snapshot["version"]) == ("sync_state", 1)
+
+                for i in range(3):
+                    alice.send_json({
+                        "type": "update_block",
+                        "payload": {"blockId": "text-1", "data": {"content": f"v{i}"}},
+                    })
+                    receive_until(alice, "op_ack")
+
+                # Три операции за тик — один кадр, участникам зритель не виден
+                catch_up = viewer.receive_json()
+                assert catch_up["type"] == "catch_up"
+                assert [op["version"] for op in catch_up["payload"]["ops"]] == [2, 3, 4]
+                info = client.get("/rooms/show/info").json()
+                assert (info["users_count"], info["spectators_count"]) == (1, 1)
+
+            # Токен пользователя и токен другой комнаты не дают просмотра
+            for token in (create_access_token(1), create_view_token("other", 1)):
+                with client.websocket_connect(f"/ws/rooms/show/view?token={token}") as eve:
+                    with pytest.raises(WebSocketDisconnect) as closed:
+                        eve.receive_json()
+                    assert closed.value.code == 1008
+    rooms_module.rooms.clear()
+
+
+def test_view_tokens_are_checked_against_the_project_of_the_room(monkeypatch):
+    async def fake_user(token):
+        return SimpleNamespace(id={"owner": 1, "stranger": 2}[token])
+
+    async def fake_load(project_id):
+        return SimpleNamespace(user_id=1, data=build_state())
+
+    monkeypatch.setattr(rooms_module, "get_user_from_token", fake_user)
+    monkeypatch.setattr(rooms_module, "load_project", fake_load)
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        # Токен выдан чужим аккаунтом, пока комнаты еще не было: после привязки
+        # к проекту зритель отключается, не получив Project.data
+        early = create_view_token("preview", 2)
+        with client.websocket_connect(f"/ws/rooms/preview/view?token={early}") as eve:
+            with client.websocket_connect("/ws/rooms/preview?protocol=delta&name=Alice&token=owner&projectId=5") as alice:
+                receive_until(alice, "sync_state")
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    while True:
+                        assert eve.receive_json()["type"] != "sync_state"
+                assert closed.value.code == 1008
+
+                # К привязанной комнате — только токены владельца и этого проекта
+                for token in (early, create_view_token("preview", 1, 6)):
+                    with client.websocket_connect(f"/ws/rooms/preview/view?token={token}") as viewer:
+                        with pytest.raises(WebSocketDisconnect) as closed:
+                            viewer.receive_json()
+                        assert closed.value.code == 1008
+                owner = create_view_token("preview", 1, 5)
+                with client.websocket_connect(f"/ws/rooms/preview/view?token={owner}") as viewer:
+                    assert viewer.receive_json()["payload"] == build_state()
+    rooms_module.rooms.clear()
+
+
+def test_undo_and_redo_broadcast_minimal_batches_to_everyone():
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/undo?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+            with client.websocket_connect("/ws/rooms/undo?protocol=delta&name=Bob") as bob:
+                receive_until(bob, "users_list")
+                alice.send_json({"type": "update_block", "payload": {"blockId": "text-1", "data": {"content": "Hi"}}})
+                receive_until(alice, "op_ack")
+                alice.send_json({"type": "delete_block", "payload": {"blockId": "container-1"}})
+                receive_until(alice, "op_ack")
+                bob.send_json({"type": "update_block", "payload": {"blockId": "text-1", "data": {"content": "Bob"}}})
+                receive_until(bob, "op_ack")
+
+                # Отмена удаления: контейнер возвращается с детьми, пакет получают оба
+                alice.send_json({"type": "undo"})
+                for peer in (alice, bob):
+                    undo = receive_until(peer, "batch")
+                    assert (undo["origin"], undo["version"]) == ("undo", 5)
+                    [op] = undo["payload"]
+                    assert op["type"] == "add_block" and op["payload"]["restore"]
+                    assert op["payload"]["block"]["children"][0]["id"] == "text-2"
+
+                # content с тех пор переписал Bob — отменять нечего; redo снова удаляет
+                alice.send_json({"type": "undo"})
+                alice.send_json({"type": "redo"})
+                redo = receive_until(bob, "batch")
+                assert (redo["origin"], redo["version"]) == ("redo", 6)
+                assert redo["payload"] == [{"type": "delete_block", "payload": {"blockId": "container-1"}}]
+
+            state = rooms_module.rooms["undo"].state
+            assert [block["id"] for block in state["blocks"]] == ["text-1", "grid-1"]
+            assert state["blocks"][0]["content"] == "Bob"
+            # История ушедшего анонима удалена вместе с его соединением
+            assert client.get("/rooms/undo/info").json()["undo_users"] == 1
+    rooms_module.rooms.clear()
+
+
+def test_undo_history_evicts_least_recently_used_users():
+    history = UndoHistory(depth=10, max_users=2)
+    history.record("user:1", [{"type": "delete_block"}])
+    history.record("user:2", [{"type": "delete_block"}])
+    assert history.pop("user:1") == [{"type": "delete_block"}]
+    history.record("user:3", [{"type": "delete_block"}])
+    # Дольше всех не пользовался user:2 — его история вытеснена
+    assert history.users == 2
+    assert history.pop("user:2") is None
+    assert history.pop("user:3") == [{"type": "delete_block"}]
+    history.forget("user:3")
+    assert history.users == 1 and len(history) == 0
+
+
+def test_chunked_initial_sync_streams_head_then_block_windows(monkeypatch):
+    monkeypatch.setattr(rooms_module.settings, "WS_SYNC_CHUNK_BLOCKS", 2)
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/chunked?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+            alice.send_json({"type": "request_sync", "payload": {}})
+            receive_until(alice, "sync_state")
+
+            with client.websocket_connect("/ws/rooms/chunked?protocol=delta&name=Bob&sync=chunked") as bob:
+                begin = bob.receive_json()
+                assert begin["type"] == "sync_begin"
+                assert begin["payload"] == {"projectName": "Test", "theme": {"accent": "#ff0000"}}
+                assert begin["totalBlocks"] == 3
+                windows = [bob.receive_json(), bob.receive_json()]
+                assert [(w["type"], w["offset"], len(w["payload"])) for w in windows] == [
+                    ("sync_blocks", 0, 2), ("sync_blocks", 2, 1),
+                ]
+                end = bob.receive_json()
+                assert end["type"] == "sync_end" and end["version"] == begin["version"] == 1
+                blocks = windows[0]["payload"] + windows[1]["payload"]
+                assert dict(begin["payload"], blocks=blocks) == build_state()
+                receive_until(bob, "users_list")
+    rooms_module.rooms.clear()
+
+
+@pytest.mark.anyio
+async def test_chunked_sync_restarts_when_room_changes_mid_stream():
+    room = rooms_module.Room("chunked-restart")
+    room.replace_state(build_state())
+    ws = SlowWebSocket()
+    ws.released.set()
+    conn = Connection(ws)
+    conn.start()
+
+    sent_before = ws.sent.copy()
+    original_drain = conn.drain
+    calls = []
+
+    async def drain_and_edit():
+        await original_drain()
+        calls.append(1)
+        if len(calls) == 2:
+            # Правка между окнами: уже отправленные окна устарели
+            room.apply_op("update_block", {"blockId": "text-1", "data": {"content": "Hi"}}, "u")
+
+    conn.drain = drain_and_edit
+    await rooms_module.stream_snapshot(room, conn, chunk_blocks=1)
+    await original_drain()
+    frames = [json.loads(frame) for frame in ws.sent[len(sent_before):]]
+    types = [frame["type"] for frame in frames]
+    assert types == ["sync_begin", "sync_blocks", "sync_begin", "sync_blocks", "sync_blocks", "sync_blocks", "sync_end"]
+    assert frames[2]["version"] == frames[-1]["version"] == 2
+    assert frames[3]["payload"][0]["content"] == "Hi"
+    conn.close()
+    room.close()
+
+
+@pytest.mark.anyio
+async def test_room_actor_applies_queued_ops_in_order_and_fans_out_once(monkeypatch):
+    rooms_module.rooms.clear()
+    room = rooms_module.get_or_create_room("actor")
+    ws = SlowWebSocket()
+    ws.released.set()
+    conn = Connection(ws)
+    conn.start()
+    room.users["bob"] = {"id": "bob", "name": "Bob", "ws": ws, "conn": conn}
+    published = []
+    monkeypatch.setattr(rooms_module.room_bus, "publish", lambda room_id, envelope: published.append(envelope))
+    room.bus_attached = True
+
+    await rooms_module.submit_op(room, "sync_state", build_state(), "alice", wait=True)
+    for i in range(5):
+        await rooms_module.submit_op(
+            room, "update_block", {"blockId": "text-1", "data": {"content": f"v{i}"}}, f"user-{i % 2}",
+        )
+    # Операции пяти «соединений» ждут актора и применяются одним пакетом
+    assert len(room.inbox) == 5
+    await rooms_module.submit_op(room, "update_theme", {"accent": "#000"}, "user-0", wait=True)
+    await conn.drain()
+
+    assert room.version == 7
+    assert room.state["blocks"][0]["content"] == "v4"
+    ops = [json.loads(frame) for frame in ws.sent if json.loads(frame)["type"] != "sync_state"]
+    assert [op["version"] for op in ops] == [2, 3, 4, 5, 6, 7]
+    assert [len(envelope["ops"]) for envelope in published if envelope["event"] == "ops"] == [1, 6]
+
+    room.bus_attached = False
+    conn.close()
+    room.close()
+    rooms_module.rooms.clear()
+
+
+@pytest.mark.anyio
+async def test_journal_writes_in_background_and_coalesces_snapshots(monkeypatch, tmp_path):
+    monkeypatch.setattr(rooms_module.settings, "WS_JOURNAL_DIR", str(tmp_path))
+    monkeypatch.setattr(rooms_module.settings, "WS_JOURNAL_SNAPSHOT_DELAY_SECONDS", 0.05)
+    written = []
+    monkeypatch.setattr(RoomJournal, "_replace_snapshot", lambda self, data: written.append(json.loads(data)))
+    rooms_module.rooms.clear()
+    room = rooms_module.get_or_create_room("debounced")
+    for i in range(5):
+        state = build_state()
+        state["header"] = {"title": f"v{i}"}
+        await rooms_module.submit_op(room, "sync_state", state, "alice", wait=True)
+    # Пять sync_state подряд — один снимок, уже с последним состоянием
+    assert written == []
+    await asyncio.sleep(0.2)
+    assert [(snapshot["version"], snapshot["state"]["header"]) for snapshot in written] == [(5, {"title": "v4"})]
+    room.close()
+    rooms_module.rooms.clear()
+
+
+@pytest.mark.anyio
+async def test_rooms_are_restored_from_the_disk_journal(monkeypatch, tmp_path):
+    monkeypatch.setattr(rooms_module.settings, "WS_JOURNAL_DIR", str(tmp_path))
+    monkeypatch.setattr(rooms_module.settings, "WS_JOURNAL_SNAPSHOT_OPS", 3)
+    rooms_module.rooms.clear()
+    room = rooms_module.get_or_create_room("journaled")
+    await rooms_module.submit_op(room, "sync_state", build_state(), "alice", wait=True)
+    await room.journal.flush()
+    for i in range(5):
+        await rooms_module.submit_op(
+            room, "update_block", {"blockId": "text-1", "data": {"content": f"v{i}"}}, "alice", wait=True,
+        )
+        await room.journal.flush()
+    await rooms_module.submit_op(room, "delete_block", {"blockId": "container-1"}, "alice", wait=True)
+    await room.journal.flush()
+    # Снимок после трех операций, в журнале — две последние
+    assert room.journal.pending_ops == 2
+    with open(room.journal.ops_path) as journal:
+        assert [json.loads(line)["version"] for line in journal] == [room.version - 1, room.version]
+    state, version, epoch = to_json(room.state), room.version, room.epoch
+
+    # Сбой посреди записи: оборванная строка в конце журнала отбрасывается
+    with open(room.journal.ops_path, "a") as journal:
+        journal.write('{"type": "update_bl')
+    room.journal.close()
+    # Процесс «упал»: комнаты пропали из памяти без выгрузки
+    rooms_module.rooms.clear()
+
+    # Владелец комнаты — другой воркер: комната не поднимается, а его журнал
+    # (общий WS_JOURNAL_DIR) остается на диске
+    bus = rooms_module.room_bus
+    bus.broker.owners["journaled"] = "worker-b"
+    assert await rooms_module.restore_rooms() == 0
+    assert "journaled" not in rooms_module.rooms and "journaled" not in bus.broker.subscribers
+    del bus.broker.owners["journaled"]
+
+    assert await rooms_module.restore_rooms() == 1
+    restored = rooms_module.rooms["journaled"]
+    assert (to_json(restored.state), restored.version, restored.epoch) == (state, version, epoch)
+    # Поднятая комната слушает шину: участники других воркеров получат от нее снимок
+    assert restored.bus_attached and bus.is_owner("journaled") and bus.broker.owners["journaled"] == bus.worker_id
+    assert bus.worker_id in bus.broker.subscribers["journaled"]
+    # Переподключение с since догоняет по журналу, без полного снимка
+    catch_up = restored.catch_up_message(version - 2, epoch)
+    assert catch_up["type"] == "catch_up"
+    assert [op["version"] for op in catch_up["payload"]["ops"]] == [version - 1, version]
+
+    # Уборщик выгружает ее, снимая подписку и владение; после рестарта она не поднимается
+    assert await evict_room(restored, "ttl")
+    assert "journaled" not in bus.broker.owners and "journaled" not in bus.broker.subscribers
+    rooms_module.rooms.clear()
+    assert await rooms_module.restore_rooms() == 0
+
+
+def test_batch_is_applied_atomically_and_broadcast_once():
+    rooms_module.rooms.clear()
+    batch = [
+        {"type": "update_block", "payload": {"blockId": "text-1", "data": {"style": {"color": "red"}}}},
+        {"type": "add_block", "payload": {"block": {"id": "text-9", "type": "text"}, "afterId": "text-1"}},
+        {"type": "update_block", "payload": {"blockId": "text-9", "data": {"content": "Pasted"}}},
+        {"type": "update_block", "payload": {"blockId": "text-1", "data": {"style": {"color": "blue"}}}},
+    ]
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/batch?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+            with client.websocket_connect("/ws/rooms/batch?protocol=delta&name=Bob") as bob:
+                receive_until(bob, "users_list")
+                alice.send_json({"type": "batch", "payload": batch})
+                assert receive_until(alice, "op_ack")["payload"]["version"] == 2
+
+                message = bob.receive_json()
+                assert message["type"] == "batch" and message["version"] == 2
+                assert [op["type"] for op in message["payload"]] == [op["type"] for op in batch]
+                assert message["payload"][1]["payload"]["parentId"] is None
+
+                state = rooms_module.rooms["batch"].state
+                assert [block["id"] for block in state["blocks"]][:2] == ["text-1", "text-9"]
+                assert state["blocks"][0]["style"] == {"color": "blue"}
+                assert state["blocks"][1]["content"] == "Pasted"
+
+                # Реплика применяет разрешенный пакет с теми же штампами
+                replica = rooms_module.Room("batch-replica")
+                replica.replace_state(build_state())
+                assert replica.apply_replicated(message)
+                assert replica.state == state
+
+                # Одна неприменимая операция — пакет не применяется целиком
+                before = to_json(state)
+                alice.send_json({"type": "batch", "payload": [
+                    {"type": "delete_block", "payload": {"blockId": "text-9"}},
+                    {"type": "update_block", "payload": {"blockId": "missing", "data": {}}},
+                ]})
+                assert receive_until(alice, "sync_state")["version"] == 2
+                room = rooms_module.rooms["batch"]
+                assert room.state == before
+                assert "text-9" in room.index
+                alice.send_json({"type": "delete_block", "payload": {"blockId": "text-9"}})
+                assert receive_until(bob, "delete_block")["version"] == 3
+    rooms_module.rooms.clear()
+
+
+def test_token_bucket_refills_at_rate_up_to_burst():
+    bucket = TokenBucket(rate=2.0, burst=3.0)
+    now = bucket.updated
+    assert [bucket.take(now=now) for _ in range(4)] == [True, True, True, False]
+    assert bucket.retry_after() == pytest.approx(0.5)
+    assert bucket.take(now=now + 0.5)
+    assert not bucket.take(now=now + 0.5)
+    # Пакет дороже запаса проходит только при полном ведре
+    assert bucket.take(10, now=now + 60) and not bucket.take(now=now + 60)
+
+
+def test_flooding_client_is_throttled_and_bad_frames_are_rejected(monkeypatch):
+    from prometheus_client import REGISTRY
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    monkeypatch.setattr(rooms_module.settings, "WS_RATE_SYNC_BURST", 2.0)
+    monkeypatch.setattr(rooms_module.settings, "WS_RATE_SYNC_PER_SECOND", 0.01)
+    monkeypatch.setattr(rooms_module.settings, "WS_MAX_FRAME_BYTES", 10_000)
+    throttled = sample("ws_throttled_messages_total", **{"class": "sync", "scope": "connection"})
+    malformed = sample("ws_rejected_frames_total", reason="malformed")
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/flood?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            for _ in range(4):
+                alice.send_json({"type": "sync_state", "payload": build_state()})
+            notice = receive_until(alice, "throttled")
+            assert notice["payload"]["class"] == "sync"
+            assert notice["payload"]["retryAfter"] > 0
+            assert notice["payload"]["deferred"] is True
+
+            # Битые кадры отбрасываются, соединение продолжает работать
+            alice.send_text("[1, 2]")
+            alice.send_text("{not json")
+            alice.send_json({"type": "update_block", "payload": {"blockId": "text-1", "data": {"content": "Hi"}}})
+            assert receive_until(alice, "op_ack")["payload"]["version"] == 3
+            assert sample("ws_throttled_messages_total", **{"class": "sync", "scope": "connection"}) == throttled + 2
+            assert sample("ws_rejected_frames_total", reason="malformed") == malformed + 2
+
+            alice.send_text("x" * 20_000)
+            with pytest.raises(WebSocketDisconnect) as closed:
+                receive_until(alice, "never")
+            assert closed.value.code == 1009
+    rooms_module.rooms.clear()
+
+
+def test_room_rate_limits_scale_with_editors(monkeypatch):
+    monkeypatch.setattr(rooms_module.settings, "WS_ROOM_RATE_FACTOR", 4.0)
+    monkeypatch.setattr(rooms_module.settings, "WS_ROOM_RATE_PER_EDITOR", 0.75)
+    rate, burst = rooms_module.settings.WS_RATE_SYNC_PER_SECOND, rooms_module.settings.WS_RATE_SYNC_BURST
+    limiter = RateLimiter(room_rate_factor(0))
+    sync = limiter.buckets["sync"]
+    assert sync.rate == rate * 4
+
+    # Десять вкладок по два sync_state в секунду укладываются в лимит комнаты
+    limiter.scale(room_rate_factor(10))
+    assert sync.rate == pytest.approx(rate * 7.5) and sync.tokens == pytest.approx(burst * 7.5)
+    start = sync.updated
+    assert all(sync.take(now=start + tick * 0.05) for tick in range(100))
+
+    # Редакторы ушли — запас срезается до нового лимита
+    limiter.scale(room_rate_factor(1))
+    assert sync.rate == rate * 4 and sync.tokens <= burst * 4
+
+    monkeypatch.setattr(rooms_module.settings, "WS_ROOM_RATE_FACTOR", 1.0)
+    monkeypatch.setattr(rooms_module.settings, "WS_ROOM_RATE_PER_EDITOR", 3.0)
+    monkeypatch.setattr(rooms_module.settings, "WS_MAX_FRAME_BYTES", 10_000)
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/scaled?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            room = rooms_module.rooms["scaled"]
+            assert room.limiter.factor == 3.0
+            with client.websocket_connect("/ws/rooms/scaled?protocol=delta&name=Bob") as bob:
+                receive_until(bob, "users_list")
+                assert room.limiter.factor == 6.0
+                # Размер кадра считается в байтах: 6000 кириллических символов — 12000 байт
+                bob.send_text(json.dumps({"type": "cursor_update", "payload": {"name": "я" * 6_000}}, ensure_ascii=False))
+                bob.send_json({"type": "request_sync", "payload": {}})
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    bob.receive_json()
+                assert closed.value.code == 1009
+            receive_until(alice, "leave")
+            assert room.limiter.factor == 3.0
+    rooms_module.rooms.clear()
+
+
+def test_throttled_sync_state_is_applied_when_the_bucket_refills(monkeypatch):
+    monkeypatch.setattr(rooms_module.settings, "WS_RATE_SYNC_BURST", 1.0)
+    monkeypatch.setattr(rooms_module.settings, "WS_RATE_SYNC_PER_SECOND", 10.0)
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/deferred?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            states = []
+            for i in range(3):
+                state = build_state()
+                state["header"] = {"title": f"v{i}"}
+                states.append(state)
+                alice.send_json({"type": "sync_state", "payload": state})
+            assert receive_until(alice, "throttled")["payload"]["deferred"] is True
+
+            # Второй sync_state заменен третьим; третий применен после паузы
+            with client.websocket_connect("/ws/rooms/deferred?protocol=delta&name=Bob") as bob:
+                synced = receive_until(bob, "sync_state")
+                while synced["payload"] != states[2]:
+                    synced = receive_until(bob, "sync_state")
+                assert synced["version"] == 2
+    rooms_module.rooms.clear()
+
+
+@pytest.mark.anyio
+async def test_heartbeat_reaps_silent_connections_and_drain_sends_reconnect(monkeypatch):
+    monkeypatch.setattr(rooms_module, "draining", False)
+    rooms_module.rooms.clear()
+    room = rooms_module.get_or_create_room("beat")
+    room.replace_state(build_state())
+    sockets = {}
+    for user_id in ("alice", "bob", "idle", "zombie"):
+        ws = sockets[user_id] = SlowWebSocket()
+        ws.released.set()
+        conn = Connection(ws)
+        conn.start()
+        room.users[user_id] = {"id": user_id, "name": user_id, "ws": ws, "conn": conn}
+        rooms_module.CONNECTIONS.inc()
+    now = room.users["alice"]["conn"].last_seen
+    room.users["alice"]["conn"].last_seen = now + 30
+
+    # Bob молчит дольше интервала — ping; zombie отвечал на ping, но молчит
+    # дольше таймаута — отключен; idle не отвечал никогда — только ping
+    room.users["zombie"]["conn"].last_seen = now - 60
+    room.users["zombie"]["conn"].answers_ping = True
+    room.users["idle"]["conn"].last_seen = now - 600
+    assert heartbeat_sweep(interval=20, timeout=60, now=now + 30) == 1
+    await asyncio.sleep(0)
+    assert set(room.users) == {"alice", "bob", "idle"}
+    assert sockets["zombie"].close_code == HEARTBEAT_TIMEOUT_CLOSE_CODE
+    for user_id in ("bob", "idle"):
+        await room.users[user_id]["conn"].drain()
+        assert sorted(json.loads(frame)["type"] for frame in sockets[user_id].sent) == ["leave", "ping"]
+    assert [json.loads(frame)["type"] for frame in sockets["alice"].sent] == ["leave"]
+
+    # Остановка: reconnect с версией для catch_up, закрытие 1012, без рассылки leave
+    assert await rooms_module.drain_connections(timeout=1) == 3
+    await asyncio.sleep(0)
+    assert rooms_module.draining and not room.users
+    for user_id in ("alice", "bob", "idle"):
+        hint = json.loads(sockets[user_id].sent[-1])
+        assert hint["type"] == "reconnect"
+        assert (hint["payload"]["since"], hint["payload"]["epoch"]) == (room.version, room.epoch)
+        assert sockets[user_id].close_code == rooms_module.SERVICE_RESTART_CLOSE_CODE
+    rooms_module.rooms.clear()
+
+
+def test_pong_opts_connection_into_heartbeat_reaping():
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/pong?name=Alice") as alice:
+            receive_until(alice, "users_list")
+            (user_data,) = rooms_module.rooms["pong"].users.values()
+            assert not user_data["conn"].answers_ping
+            alice.send_json({"type": "pong", "payload": {}})
+            alice.send_json({"type": "ping", "payload": {}})
+            receive_until(alice, "pong")
+            assert user_data["conn"].answers_ping
+    rooms_module.rooms.clear()
+
+
+def test_collaboration_metrics_are_exported():
+    from prometheus_client import REGISTRY
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    received = sample("ws_messages_received_total", type="update_block")
+    other = sample("ws_messages_received_total", type="other")
+    applied = sample("ws_op_apply_seconds_count", type="update_block")
+    fanouts = sample("ws_fanout_recipients_count")
+    sent = sample("ws_sent_bytes_total", encoding="json")
+    rooms_module.rooms.clear()
+    with make_client() as client:
+        with client.websocket_connect("/ws/rooms/metrics?protocol=delta&name=Alice") as alice:
+            receive_until(alice, "users_list")
+            assert sample("ws_connections") >= 1
+            alice.send_json({"type": "sync_state", "payload": build_state()})
+            alice.send_json({"type": "made_up", "payload": {}})
+            alice.send_json({"type": "update_block", "payload": {"blockId": "text-1", "data": {"content": "Hi"}}})
+            receive_until(alice, "op_ack")
+    rooms_module.rooms.clear()
+
+    assert sample("ws_messages_received_total", type="update_block") == received + 1
+    assert sample("ws_messages_received_total", type="other") == other + 1
+    assert sample("ws_op_apply_seconds_count", type="update_block") == applied + 1
+    assert sample("ws_fanout_recipients_count") > fanouts
+    assert sample("ws_sent_bytes_total", encoding="json") > sent
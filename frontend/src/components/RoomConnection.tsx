@@ -27,6 +27,10 @@ export const RoomConnection = () => {
   const initialRoomId = (location.pathname.startsWith('/editor') && params.id)
     ? String(params.id)
     : (currentProjectId ? String(currentProjectId) : '');
+  // Комната редактора привязана к проекту: сервер сам загрузит его из БД
+  const roomProjectId = (location.pathname.startsWith('/editor') && params.id && /^\d+$/.test(params.id))
+    ? Number(params.id)
+    : null;
   const derivedName = (profile?.username || authUsername || (email ? email.split('@')[0] : '') || '').trim();
   const safeName = derivedName || 'Guest';
 
@@ -36,12 +40,12 @@ export const RoomConnection = () => {
     if (isConnected) {
       if (roomId !== targetRoom || (userName && userName !== safeName.trim())) {
         disconnect();
-        connect(targetRoom, safeName.trim(), undefined, token);
+        connect(targetRoom, safeName.trim(), undefined, token, roomProjectId);
       }
     } else if (!isConnecting) {
-      connect(targetRoom, safeName.trim(), undefined, token);
+      connect(targetRoom, safeName.trim(), undefined, token, roomProjectId);
     }
-  }, [isConnected, isConnecting, roomId, userName, initialRoomId, safeName, token, connect, disconnect, currentProjectId]);
+  }, [isConnected, isConnecting, roomId, userName, initialRoomId, safeName, token, connect, disconnect, currentProjectId, roomProjectId]);
 
   useEffect(() => {
     if (token && !profile) {
@@ -1,6 +1,7 @@
 import { useEffect, useRef } from 'react';
 import { useWebSocketStore } from '../store/useWebSocketStore';
 import { useProjectStore } from '../store/useProjectStore';
+import { applyDeltaOps, diffProjectOps, type DeltaOp } from '../store/websocket/deltaOps';
 import type { Project, Block } from '../types';
 
 /**
@@ -14,6 +15,8 @@ export function useWebSocketSync() {
   // Флаг для предотвращения циклических обновлений
   const isApplyingRemoteChange = useRef(false);
   const lastProjectHash = useRef<string>('');
+  // Состояние, которое уже есть в комнате: от него считаются отправляемые правки
+  const lastSyncedProject = useRef<Project | null>(null);
   const saveTimeoutRef = useRef<ReturnType<typeof setTimeout> | null>(null);
 
   // Вычисляем хеш проекта для отслеживания изменений
@@ -38,6 +41,16 @@ export function useWebSocketSync() {
     }
 
     lastProjectHash.current = currentHash;
+    const previous = lastSyncedProject.current;
+    lastSyncedProject.current = project;
+
+    // Правки полей без изменения структуры дерева уходят операциями: остальные
+    // участники получают дельты, а не проект целиком
+    const ops = previous ? diffProjectOps(previous, project) : null;
+    if (ops && ops.length > 0) {
+      sendMessage({ type: 'batch', payload: ops });
+      return;
+    }
 
     // Отправляем полное состояние проекта
     sendMessage({
@@ -75,18 +88,52 @@ export function useWebSocketSync() {
           isApplyingRemoteChange.current = true;
           setProject(updatedProject);
           lastProjectHash.current = getProjectHash(updatedProject);
+          lastSyncedProject.current = updatedProject;
           // Сбрасываем флаг после небольшой задержки
           setTimeout(() => {
             isApplyingRemoteChange.current = false;
           }, 100);
         }
       },
+      onProjectOps: (ops: DeltaOp[]) => {
+        const next = applyDeltaOps(useProjectStore.getState().project, ops);
+        if (!next) {
+          return false;
+        }
+        isApplyingRemoteChange.current = true;
+        setProject(next);
+        // Свои неотправленные правки остаются разницей с комнатой и уйдут со следующей отправкой
+        const synced = lastSyncedProject.current && applyDeltaOps(lastSyncedProject.current, ops);
+        lastSyncedProject.current = synced || next;
+        lastProjectHash.current = getProjectHash(lastSyncedProject.current);
+        setTimeout(() => {
+          isApplyingRemoteChange.current = false;
+        }, 100);
+        return true;
+      },
       onProjectSaved: (projectId: number) => {
         // Обновляем ID проекта после сохранения
         if (!currentProjectId) {
           setCurrentProjectId(projectId);
         }
       },
+      onThrottled: (messageType: string, retryAfter: number) => {
+        // Сообщение отклонено лимитом: после паузы отправляем актуальное состояние заново
+        setTimeout(() => {
+          const latest = useProjectStore.getState();
+          const send = useWebSocketStore.getState().sendMessage;
+          if (messageType === 'save_project') {
+            send({
+              type: 'save_project',
+              payload: { projectId: latest.currentProjectId, project: latest.project },
+            });
+          } else {
+            lastProjectHash.current = getProjectHash(latest.project);
+            lastSyncedProject.current = latest.project;
+            send({ type: 'sync_state', payload: latest.project });
+          }
+        }, retryAfter * 1000);
+      },
     });
 
     // Отправляем текущее состояние при подключении
@@ -95,7 +142,9 @@ export function useWebSocketSync() {
     return () => {
       useWebSocketStore.setState({
         onProjectUpdate: undefined,
+        onProjectOps: undefined,
         onProjectSaved: undefined,
+        onThrottled: undefined,
       });
     };
   }, [isConnected, currentProjectId, setCurrentProjectId]);
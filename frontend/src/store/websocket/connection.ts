@@ -37,6 +37,7 @@ export const createWebSocketConnection = (
   userName: string,
   serverUrl: string,
   token: string | null | undefined,
+  projectId: number | null,
   state: WebSocketStore,
   setState: (updates: Partial<WebSocketStore>) => void,
   getState: () => WebSocketStore,
@@ -45,10 +46,20 @@ export const createWebSocketConnection = (
   const userId = generateUserId();
   const base = normalize(serverUrl || WS_BASE_URL);
   const withWs = /\/ws$/.test(base) ? base : `${base}/ws`;
-  let wsUrl = `${withWs}/rooms/${roomId}?name=${encodeURIComponent(userName)}`;
+  // Дельта-протокол: сервер присылает операции с версиями, а не полное состояние на каждую правку
+  let wsUrl = `${withWs}/rooms/${roomId}?name=${encodeURIComponent(userName)}&protocol=delta`;
   if (token) {
     wsUrl += `&token=${encodeURIComponent(token)}`;
   }
+  if (projectId && token) {
+    // Комната сама читает проект из БД и привязывается к нему для автосохранения
+    wsUrl += `&projectId=${projectId}`;
+  }
+  const { version, epoch } = getState();
+  if (version != null && epoch) {
+    // Переподключение к той же комнате: пропущенные версии придут одним catch_up
+    wsUrl += `&since=${version}&epoch=${encodeURIComponent(epoch)}`;
+  }
 
   setState({
     isConnecting: true,
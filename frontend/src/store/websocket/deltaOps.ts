@@ -0,0 +1,209 @@
+import type { Block, Project } from '../../types';
+
+// Операция документа в том виде, в каком ее рассылает сервер (?protocol=delta)
+export interface DeltaOp {
+  type: string;
+  payload: any;
+  version?: number;
+}
+
+// Словарные поля блока: сервер сливает их по ключам, null удаляет ключ
+const MAP_FIELDS = ['style', 'props'];
+// Разделы проекта, которые обновляются слиянием по ключам
+const SECTION_OPS: Record<string, 'theme' | 'header' | 'footer'> = {
+  update_theme: 'theme',
+  update_header: 'header',
+  update_footer: 'footer',
+};
+// Больше операций сервер в одном batch не принимает (WS_BATCH_MAX_OPS)
+const MAX_BATCH_OPS = 500;
+
+const isObject = (value: unknown): value is Record<string, any> =>
+  typeof value === 'object' && value !== null && !Array.isArray(value);
+
+function mergeMap(target: unknown, values: Record<string, any>): Record<string, any> {
+  const next: Record<string, any> = { ...(isObject(target) ? target : {}) };
+  for (const [key, value] of Object.entries(values)) {
+    if (value === null) {
+      delete next[key];
+    } else {
+      next[key] = value;
+    }
+  }
+  return next;
+}
+
+// Заменить блок с blockId где угодно в дереве; null — блок не найден
+function replaceBlock(
+  blocks: Block[],
+  blockId: string,
+  replace: (block: Block) => Block | null
+): Block[] | null {
+  for (let i = 0; i < blocks.length; i++) {
+    const block = blocks[i] as any;
+    if (!block) continue;
+    if (block.id === blockId) {
+      const next = replace(block);
+      const copy = blocks.slice();
+      if (next) {
+        copy[i] = next;
+      } else {
+        copy.splice(i, 1);
+      }
+      return copy;
+    }
+    if (block.type === 'container' && Array.isArray(block.children)) {
+      const children = replaceBlock(block.children, blockId, replace);
+      if (children) {
+        const copy = blocks.slice();
+        copy[i] = { ...block, children };
+        return copy;
+      }
+    }
+    if (block.type === 'grid' && Array.isArray(block.cells)) {
+      for (let j = 0; j < block.cells.length; j++) {
+        const cell = block.cells[j];
+        if (!cell?.block) continue;
+        const inner = replaceBlock([cell.block], blockId, replace);
+        if (inner) {
+          const cells = block.cells.slice();
+          cells[j] = { ...cell, block: inner[0] ?? null };
+          const copy = blocks.slice();
+          copy[i] = { ...block, cells };
+          return copy;
+        }
+      }
+    }
+  }
+  return null;
+}
+
+function applyOp(project: Project, op: DeltaOp): Project | null {
+  if (op.type === 'batch') {
+    return Array.isArray(op.payload) ? applyDeltaOps(project, op.payload) : null;
+  }
+  const section = SECTION_OPS[op.type];
+  if (section) {
+    return isObject(op.payload) ? { ...project, [section]: mergeMap(project[section], op.payload) } : null;
+  }
+  if (op.type === 'update_block') {
+    const { blockId, data } = op.payload || {};
+    if (typeof blockId !== 'string' || !isObject(data)) return null;
+    const blocks = replaceBlock(project.blocks || [], blockId, (block) => {
+      const next: Record<string, any> = { ...block };
+      for (const [field, value] of Object.entries(data)) {
+        if (field === 'id') continue;
+        next[field] = MAP_FIELDS.includes(field) && isObject(value) ? mergeMap(next[field], value) : value;
+      }
+      return next as Block;
+    });
+    return blocks ? { ...project, blocks } : null;
+  }
+  if (op.type === 'delete_block') {
+    const blockId = op.payload?.blockId;
+    const blocks = typeof blockId === 'string' ? replaceBlock(project.blocks || [], blockId, () => null) : null;
+    return blocks ? { ...project, blocks } : null;
+  }
+  // add_block/move_block упорядочены ключами позиций, patch — по путям сервера:
+  // такие изменения клиент берет из снимка
+  return null;
+}
+
+/**
+ * Применить операции сервера к проекту по порядку.
+ * null — хотя бы одну операцию клиент применить не может, нужен снимок (request_sync).
+ */
+export function applyDeltaOps(project: Project, ops: DeltaOp[]): Project | null {
+  let next: Project | null = project;
+  for (const op of ops) {
+    next = applyOp(next, op);
+    if (!next) return null;
+  }
+  return next;
+}
+
+function diffMap(previous: unknown, current: unknown): Record<string, any> {
+  const before = isObject(previous) ? previous : {};
+  const after = isObject(current) ? current : {};
+  const changes: Record<string, any> = {};
+  for (const key of Object.keys(after)) {
+    if (JSON.stringify(before[key]) !== JSON.stringify(after[key])) {
+      changes[key] = after[key] ?? null;
+    }
+  }
+  for (const key of Object.keys(before)) {
+    if (!(key in after)) changes[key] = null;
+  }
+  return changes;
+}
+
+// Блоки дерева с их путем (id родителя и порядок) — структура должна совпасть
+function collectBlocks(blocks: Block[], parent: string, out: Map<string, { block: any; place: string }>) {
+  blocks.forEach((block: any, i) => {
+    if (!block?.id) return;
+    out.set(block.id, { block, place: `${parent}/${i}` });
+    if (block.type === 'container' && Array.isArray(block.children)) {
+      collectBlocks(block.children, block.id, out);
+    }
+    if (block.type === 'grid' && Array.isArray(block.cells)) {
+      block.cells.forEach((cell: any, j: number) => {
+        if (cell?.block) collectBlocks([cell.block], `${block.id}#${j}`, out);
+      });
+    }
+  });
+}
+
+/**
+ * Правки между двумя версиями проекта в виде операций для batch.
+ * null — изменилась структура дерева (добавление, удаление, перестановка):
+ * тогда отправляется полный sync_state.
+ */
+export function diffProjectOps(previous: Project, current: Project): DeltaOp[] | null {
+  const before = new Map<string, { block: any; place: string }>();
+  const after = new Map<string, { block: any; place: string }>();
+  collectBlocks(previous.blocks || [], '', before);
+  collectBlocks(current.blocks || [], '', after);
+  if (before.size !== after.size) return null;
+
+  const ops: DeltaOp[] = [];
+  for (const [blockId, { block, place }] of after) {
+    const old = before.get(blockId);
+    if (!old || old.place !== place) return null;
+    if (old.block === block) continue;
+    const data: Record<string, any> = {};
+    const fields = new Set([...Object.keys(old.block), ...Object.keys(block)]);
+    for (const field of fields) {
+      if (field === 'id') continue;
+      if (field === 'children' || field === 'cells') {
+        // Дети сравниваются по своим id; здесь важны только настройки ячеек сетки
+        if (field === 'cells' && JSON.stringify(stripCellBlocks(old.block.cells)) !== JSON.stringify(stripCellBlocks(block.cells))) {
+          return null;
+        }
+        continue;
+      }
+      if (JSON.stringify(old.block[field]) === JSON.stringify(block[field])) continue;
+      if (MAP_FIELDS.includes(field) && isObject(block[field])) {
+        data[field] = diffMap(old.block[field], block[field]);
+      } else {
+        data[field] = block[field] ?? null;
+      }
+    }
+    if (Object.keys(data).length > 0) {
+      ops.push({ type: 'update_block', payload: { blockId, data } });
+    }
+  }
+  for (const [type, section] of Object.entries(SECTION_OPS)) {
+    const changes = diffMap(previous[section], current[section]);
+    if (Object.keys(changes).length > 0) {
+      ops.push({ type, payload: changes });
+    }
+  }
+  if (previous.projectName !== current.projectName || ops.length > MAX_BATCH_OPS) {
+    return null;
+  }
+  return ops;
+}
+
+function stripCellBlocks(cells: unknown): unknown {
+  return Array.isArray(cells) ? cells.map((cell) => (isObject(cell) ? { ...cell, block: Boolean(cell.block) } : cell)) : cells;
+}
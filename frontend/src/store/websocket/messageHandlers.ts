@@ -1,14 +1,36 @@
 import type { Project } from '../../types';
+import type { DeltaOp } from './deltaOps';
 import type { WebSocketMessage, RoomUser, CursorPosition } from './useWebSocketStore';
 import { useWebSocketStore } from './useWebSocketStore';
 
 export interface WebSocketStore {
   userId: string | null;
   onProjectUpdate?: (project: Project) => void;
+  onProjectOps?: (ops: DeltaOp[]) => boolean;
   onUserJoin?: (user: RoomUser) => void;
   onUserLeave?: (userId: string) => void;
   onCursorUpdate?: (cursor: CursorPosition) => void;
   onProjectSaved?: (projectId: number) => void;
+  onThrottled?: (messageType: string, retryAfter: number) => void;
+}
+
+// Запомнить версию комнаты: с ней переподключение получает catch_up, а не снимок
+function trackVersion(message: WebSocketMessage) {
+  const updates: { version?: number; epoch?: string } = {};
+  if (typeof message.version === 'number') updates.version = message.version;
+  if (typeof message.epoch === 'string') updates.epoch = message.epoch;
+  if (updates.version !== undefined || updates.epoch !== undefined) {
+    useWebSocketStore.setState(updates);
+  }
+}
+
+// Применить операции других участников; то, что клиент применить не может, придет снимком
+function applyRemoteOps(ops: DeltaOp[], state: WebSocketStore) {
+  if (state.onProjectOps && state.onProjectOps(ops)) {
+    return;
+  }
+  // Без версии сервер отвечает полным sync_state
+  useWebSocketStore.getState().sendMessage({ type: 'request_sync', payload: {} });
 }
 
 export function handleIncomingMessage(
@@ -45,6 +67,7 @@ export function handleIncomingMessage(
     }
 
     case 'sync_state': {
+      trackVersion(message);
       const project = message.payload as Project;
       if (project && state.onProjectUpdate) {
         // Обновляем только если это не наше собственное сообщение
@@ -74,10 +97,32 @@ export function handleIncomingMessage(
     case 'move_block':
     case 'update_theme':
     case 'update_header':
-    case 'update_footer': {
-      // Эти события должны привести к обновлению проекта
-      // Для простоты запрашиваем полное состояние или обрабатываем через sync_state
-      // В реальности сервер должен отправлять обновленное состояние
+    case 'update_footer':
+    case 'batch':
+    case 'patch': {
+      // Дельта с версией (?protocol=delta): сервер рассылает операции по порядку версий,
+      // свои правки автор получает только как результат undo/redo
+      trackVersion(message);
+      applyRemoteOps([{ type: message.type, payload: message.payload }], state);
+      break;
+    }
+
+    case 'catch_up': {
+      // Операции, пропущенные за время разрыва соединения
+      trackVersion(message);
+      const ops = (message.payload?.ops || []) as DeltaOp[];
+      if (ops.length > 0) {
+        applyRemoteOps(ops, state);
+      }
+      break;
+    }
+
+    case 'op_ack': {
+      // Версия, присвоенная нашей операции
+      const version = message.payload?.version;
+      if (typeof version === 'number') {
+        useWebSocketStore.setState({ version });
+      }
       break;
     }
 
@@ -96,6 +141,25 @@ export function handleIncomingMessage(
       break;
     }
 
+    case 'presence': {
+      // Пакетный кадр присутствия: последние позиции курсоров за тик сервера
+      const cursors = (message.payload?.cursors || []) as CursorPosition[];
+      const remote = cursors.filter((c) => c && c.userId && c.userId !== state.userId);
+      if (remote.length > 0) {
+        useWebSocketStore.setState((s) => {
+          const newCursors = new Map(s.cursors);
+          for (const cursor of remote) {
+            newCursors.set(cursor.userId, cursor);
+          }
+          return { cursors: newCursors };
+        });
+        if (state.onCursorUpdate) {
+          remote.forEach((cursor) => state.onCursorUpdate!(cursor));
+        }
+      }
+      break;
+    }
+
     case 'project_saved': {
       // Обработка ответа об успешном сохранении проекта
       const { projectId } = message.payload || {};
@@ -108,6 +172,36 @@ export function handleIncomingMessage(
       break;
     }
 
+    case 'ping': {
+      // Heartbeat сервера: ответ подтверждает, что вкладка жива, даже если она простаивает
+      useWebSocketStore.getState().sendMessage({ type: 'pong', payload: {} });
+      break;
+    }
+
+    case 'pong':
+      break;
+
+    case 'reconnect': {
+      // Сервер перезапускается и скоро закроет соединение: переподключаемся
+      // через выданную им случайную задержку, а не все разом
+      const { retryAfter, since, epoch } = message.payload || {};
+      useWebSocketStore.setState({ reconnectAfter: Math.max(Number(retryAfter) || 0, 0) });
+      if (typeof since === 'number' && typeof epoch === 'string') {
+        useWebSocketStore.setState({ version: since, epoch });
+      }
+      break;
+    }
+
+    case 'throttled': {
+      // Сервер не принял сообщение из-за лимита частоты. Последний sync_state он
+      // применит сам (deferred), остальное нужно повторить через retryAfter секунд
+      const { messageType, retryAfter, deferred } = message.payload || {};
+      if (!deferred && messageType && state.onThrottled) {
+        state.onThrottled(messageType, Number(retryAfter) || 1);
+      }
+      break;
+    }
+
     default:
       console.warn('Неизвестный тип сообщения:', message.type);
   }
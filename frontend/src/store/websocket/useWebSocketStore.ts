@@ -1,6 +1,7 @@
 import { create } from 'zustand';
 import type { Project } from '../../types';
 import { createWebSocketConnection, WS_BASE_URL } from './connection';
+import type { DeltaOp } from './deltaOps';
 
 export type WebSocketEventType =
   | 'join'
@@ -10,13 +11,23 @@ export type WebSocketEventType =
   | 'delete_block'
   | 'move_block'
   | 'cursor_update'
+  | 'presence'
   | 'sync_state'
   | 'update_theme'
   | 'update_header'
   | 'update_footer'
+  | 'batch'
+  | 'patch'
+  | 'catch_up'
+  | 'op_ack'
+  | 'request_sync'
   | 'users_list'
   | 'save_project'
-  | 'project_saved';
+  | 'project_saved'
+  | 'throttled'
+  | 'ping'
+  | 'pong'
+  | 'reconnect';
 
 export interface WebSocketMessage {
   type: WebSocketEventType;
@@ -24,6 +35,9 @@ export interface WebSocketMessage {
   userId?: string;
   userName?: string;
   timestamp?: number;
+  // Версия комнаты и ее epoch (дельта-протокол)
+  version?: number;
+  epoch?: string;
 }
 
 export interface RoomUser {
@@ -50,9 +64,17 @@ export interface WebSocketStore {
   reconnectDelay: number;
   reconnectTimerId?: number | null;
   lastReconnectAt?: number | null;
+  // Задержка переподключения (с) из подсказки reconnect при перезапуске сервера
+  reconnectAfter?: number | null;
 
   // Room state
   roomId: string | null;
+  // Проект, к которому привязана комната (?projectId)
+  projectId: number | null;
+  // Последняя известная версия комнаты и ее epoch: с ними переподключение
+  // получает catch_up с пропущенными операциями вместо снимка
+  version: number | null;
+  epoch: string | null;
   userName: string | null;
   userId: string | null;
   token: string | null;
@@ -68,7 +90,8 @@ export interface WebSocketStore {
     roomId: string,
     userName: string,
     serverUrl?: string,
-    token?: string | null
+    token?: string | null,
+    projectId?: number | null
   ) => void;
   disconnect: () => void;
   sendMessage: (
@@ -77,10 +100,13 @@ export interface WebSocketStore {
 
   // Event handlers (set from outside)
   onProjectUpdate?: (project: Project) => void;
+  // Применить операции других участников; false — нужен снимок
+  onProjectOps?: (ops: DeltaOp[]) => boolean;
   onUserJoin?: (user: RoomUser) => void;
   onUserLeave?: (userId: string) => void;
   onCursorUpdate?: (cursor: CursorPosition) => void;
   onProjectSaved?: (projectId: number) => void;
+  onThrottled?: (messageType: string, retryAfter: number) => void;
 }
 
 export const useWebSocketStore = create<WebSocketStore>((set, get) => ({
@@ -93,8 +119,12 @@ export const useWebSocketStore = create<WebSocketStore>((set, get) => ({
   reconnectDelay: 1000,
   reconnectTimerId: null,
   lastReconnectAt: null,
+  reconnectAfter: null,
 
   roomId: null,
+  projectId: null,
+  version: null,
+  epoch: null,
   userName: null,
   userId: null,
   token: null,
@@ -135,7 +165,13 @@ export const useWebSocketStore = create<WebSocketStore>((set, get) => ({
     return color;
   },
 
-  connect: (roomId: string, userName: string, serverUrl = WS_BASE_URL, token?: string | null) => {
+  connect: (
+    roomId: string,
+    userName: string,
+    serverUrl = WS_BASE_URL,
+    token?: string | null,
+    projectId?: number | null
+  ) => {
     const state = get();
     const now = Date.now();
     if (state.lastReconnectAt && now - state.lastReconnectAt < 5000) {
@@ -149,18 +185,48 @@ export const useWebSocketStore = create<WebSocketStore>((set, get) => ({
 
     try {
       // Предотвращаем гонку одновременных вызовов connect
-      set({ isConnecting: true, connectionError: null, roomId, userName, token: token || null });
+      const sameRoom = state.roomId === roomId;
+      set({
+        isConnecting: true,
+        connectionError: null,
+        roomId,
+        userName,
+        token: token || null,
+        projectId: projectId ?? null,
+        // Версия другой комнаты для catch_up бесполезна
+        version: sameRoom ? state.version : null,
+        epoch: sameRoom ? state.epoch : null,
+      });
       const ws = createWebSocketConnection(
         roomId,
         userName,
         serverUrl,
         token,
+        projectId ?? null,
         state,
         (updates) => set(updates),
         () => get(),
         () => {
           // Reconnect handler
           const currentState = get();
+          if (currentState.reconnectAfter != null && currentState.roomId && currentState.userName) {
+            // Сервер перезапускается и сам назначил задержку: клиенты возвращаются
+            // вразброс, без backoff и без траты попыток
+            if (!currentState.reconnectTimerId) {
+              const timerId = window.setTimeout(() => {
+                set({ reconnectTimerId: null, reconnectAfter: null, lastReconnectAt: null });
+                get().connect(
+                  currentState.roomId!,
+                  currentState.userName!,
+                  serverUrl,
+                  currentState.token,
+                  currentState.projectId
+                );
+              }, currentState.reconnectAfter * 1000);
+              set({ reconnectTimerId: timerId });
+            }
+            return;
+          }
           if (
             currentState.reconnectAttempts < currentState.maxReconnectAttempts &&
             currentState.roomId &&
@@ -175,7 +241,13 @@ export const useWebSocketStore = create<WebSocketStore>((set, get) => ({
               const timerId = window.setTimeout(() => {
                 // Очистим таймер перед новым подключением
                 set({ reconnectTimerId: null, reconnectAttempts: currentState.reconnectAttempts + 1 });
-                get().connect(currentState.roomId!, currentState.userName!, serverUrl, currentState.token);
+                get().connect(
+                  currentState.roomId!,
+                  currentState.userName!,
+                  serverUrl,
+                  currentState.token,
+                  currentState.projectId
+                );
               }, delay);
               set({ reconnectTimerId: timerId, lastReconnectAt: Date.now() });
             }
@@ -220,6 +292,10 @@ export const useWebSocketStore = create<WebSocketStore>((set, get) => ({
       reconnectAttempts: 0,
       reconnectTimerId: null,
       lastReconnectAt: null,
+      reconnectAfter: null,
+      projectId: null,
+      version: null,
+      epoch: null,
     });
   },
 